@@ -0,0 +1,544 @@
+"""
+Python Version: 3.9
+
+Summary: Measure the image classifier's throughput, latency and memory use.
+
+Description:
+Generates synthetic JPEGs at several resolutions (see benchmark.synthetic) and runs them through the classifier in a
+number of scenarios:
+    stages:    Each step of the predictor run one after the other on a single thread, timed separately: decode,
+               resize, preprocess, inference and topk.  Shows where the time goes.
+    predictor: img_classifier.predictor.predict_iter() fed by the prefetch pipeline, as the applications use it.
+    cli:       cli.predict_from_folder.main() on a folder of images, including writing the results file.
+    service:   The Flask application's POST /predict endpoint, called through Flask's test client.
+    soak:      The same batch run through predictor.predict_batch() over and over while tracemalloc watches memory.
+               Memory that grows from the start of the soak to the end is a leak.
+    cascade:   The model cascade (see img_classifier.cascade) at each of the --cascade-thresholds, compared with running
+               the main model on every image.
+    decoder:   Decoding and resizing each image with a full decode, and with the fast decoder (see
+               img_classifier.decoder) using reduced-scale JPEG decoding.  The model isn't run.
+
+The predictor and cli scenarios are repeated for each batch size, prefetch worker count and worker process count given.
+The service scenario sends one request for every batch size's worth of images.
+
+Each result reports:
+    images_per_second: Images classified per second of wall time
+    latency_ms:        The p50, p95 and p99 latency.  For 'stages' and 'soak' this is per batch, for 'predictor' it is
+                       per image - from when the image starts loading until its result comes out - and for 'service' it
+                       is per request.  The cli scenario only reports throughput.
+    max_rss_mb:        The process' peak resident memory so far (not available on Windows).  This only ever goes up, so
+                       it is most useful for the first scenario run or when scenarios are run on their own.
+    stages_ms:         For 'stages' and 'predictor', the average milliseconds per image spent in each step.  The
+                       predictor's are recorded by img_classifier.metrics.StageMetrics.
+    tracemalloc_mb:    For 'soak', the traced memory after the first batch and at the end, its peak, and the growth.
+    escalated:         For 'cascade', the fraction of images escalated to the main model.
+    compute_saved:     For 'cascade', the fraction of the main model's inference time the cascade saved.
+    agreement:         For 'cascade', the fraction of images where the cascade's top-1 label matches the main model's.
+    speedup:           For 'decoder', how many times faster the decode and resize was than with a full decode.
+    pixel_difference:  For 'decoder', the mean absolute difference of the resized pixels from a full decode's, from 0
+                       to 255.
+
+Results are written as JSON, along with a description of the machine and model they were measured on.  Give the
+results from an earlier run with --compare to print the change in throughput for each matching result.
+
+The benchmark does not need a network connection once the model's weights and the ImageNet class index have been
+downloaded - run the classifier once to fetch them.  Run it from the top of the repository:
+`> python -m benchmark.run_benchmark --output benchmark.json --batch-sizes 1 8 32 --workers 1 4 --processes 0 2`
+"""
+import argparse
+import functools
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from benchmark import synthetic
+from img_classifier import backends
+from img_classifier import cascade
+from img_classifier import decoder
+from img_classifier import labels
+from img_classifier import pipeline
+from img_classifier import predictor
+from img_classifier.buffers import preprocess_pixels
+from img_classifier.metrics import StageMetrics, timed
+from img_classifier.worker_pool import WorkerPool
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+SCENARIOS = ('stages', 'predictor', 'cli', 'service', 'soak', 'cascade', 'decoder')
+STAGES = ('decode', 'resize', 'preprocess', 'inference', 'topk')
+DEFAULT_IMAGE_COUNT = 64  # images per resolution
+DEFAULT_BATCH_SIZES = (1, 8, predictor.DEFAULT_BATCH_SIZE)
+DEFAULT_WORKERS = (1, pipeline.DEFAULT_WORKERS)
+DEFAULT_SOAK_BATCHES = 500
+DEFAULT_CASCADE_THRESHOLDS = (0.3, 0.5, 0.7)
+DEFAULT_IMAGE_DIR = os.path.join(tempfile.gettempdir(), 'img_classifier_benchmark')
+
+# The fields that identify a result, used to match results between runs
+RESULT_KEY = ('scenario', 'resolution', 'batch_size', 'workers', 'processes', 'threshold', 'decoder')
+
+
+def max_rss_mb():
+    """
+    :return: The peak resident memory of this process so far in MB, or None if it can't be measured here
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def percentiles(seconds):
+    """
+    :param seconds: A list of latencies in seconds
+    :return: A dict of the 'p50', 'p95' and 'p99' latencies in milliseconds, or None if there are no latencies
+    """
+    if len(seconds) == 0:
+        return None
+    milliseconds = np.asarray(seconds) * 1000
+    return {name: round(float(np.percentile(milliseconds, q)), 3)
+            for name, q in (('p50', 50), ('p95', 95), ('p99', 99))}
+
+
+def summarize(scenario, count, seconds, latencies=(), **details):
+    """
+    Make the result for a scenario.
+    :param scenario: The name of the scenario
+    :param count: The number of images classified
+    :param seconds: The wall time taken
+    :param latencies: The latencies measured, in seconds
+    :param details: Anything else to report, such as the batch size
+    :return: The result as a dict
+    """
+    result = {'scenario': scenario}
+    result.update(details)
+    result.update({
+        'images': count,
+        'seconds': round(seconds, 3),
+        'images_per_second': round(count / seconds, 2) if seconds > 0 else None,
+        'latency_ms': percentiles(list(latencies)),
+        'max_rss_mb': max_rss_mb()
+    })
+    return result
+
+
+def decode_image(path):
+    """
+    :param path: Full path to an image file
+    :return: The image as an RGB PIL image
+    """
+    with Image.open(path) as img:
+        return img.convert('RGB')
+
+
+def run_stages(paths, batch_size, top_k):
+    """
+    Run images through each step of the predictor on this thread, timing each step.
+    :param paths: The images to classify
+    :param batch_size: The number of images per forward pass
+    :param top_k: The number of labels to find for each image
+    :return: The result, with the average time per image for each stage
+    """
+    stage_seconds = dict.fromkeys(STAGES, 0.0)
+    latencies = []
+
+    start = time.perf_counter()
+    for first in range(0, len(paths), batch_size):
+        batch_start = time.perf_counter()
+        batch = []
+        for path in paths[first:first + batch_size]:
+            step_start = time.perf_counter()
+            img_pixels = decode_image(path)
+            stage_seconds['decode'] += time.perf_counter() - step_start
+
+            step_start = time.perf_counter()
+            batch.append((path, predictor.resize_image(img_pixels)))
+            stage_seconds['resize'] += time.perf_counter() - step_start
+
+        backend = predictor.model.get()
+        with predictor.buffer_pool.acquire(len(batch)) as buffer:
+            step_start = time.perf_counter()
+            _, valid = predictor.stage_batch(batch, buffer.pixels)
+            inputs = preprocess_pixels(buffer.pixels[:len(valid)], buffer.inputs[:len(valid)], backend.preprocessing)
+            stage_seconds['preprocess'] += time.perf_counter() - step_start
+
+            step_start = time.perf_counter()
+            probabilities = backend.predict_on_batch(inputs)
+            stage_seconds['inference'] += time.perf_counter() - step_start
+
+            step_start = time.perf_counter()
+            labels.top_k(probabilities, top_k)
+            stage_seconds['topk'] += time.perf_counter() - step_start
+
+        latencies.append(time.perf_counter() - batch_start)
+    seconds = time.perf_counter() - start
+
+    stages_ms = {stage: round(total * 1000 / len(paths), 3) for stage, total in stage_seconds.items()}
+    return summarize('stages', len(paths), seconds, latencies, batch_size=batch_size, stages_ms=stages_ms)
+
+
+def run_predictor(paths, batch_size, workers, top_k, pool=None):
+    """
+    Run images through predict_iter(), loading them on the prefetch pipeline.
+    :param paths: The images to classify
+    :param batch_size: The number of images per forward pass
+    :param workers: The number of prefetch threads
+    :param top_k: The number of labels to find for each image
+    :param pool: An optional WorkerPool to run inference on
+    :return: The result, with per-image latencies and the time spent in each stage
+    """
+    started = {}
+    metrics = StageMetrics()
+
+    def load(path):
+        started[path] = time.perf_counter()
+        with timed(metrics, 'decode'):
+            img_pixels = decode_image(path)
+        with timed(metrics, 'resize'):
+            return predictor.resize_image(img_pixels)
+
+    def get_images():
+        queue_depth = max(pipeline.DEFAULT_QUEUE_DEPTH, batch_size * 2)
+        yield from pipeline.prefetch(paths, load, workers=workers, queue_depth=queue_depth)
+
+    latencies = []
+    start = time.perf_counter()
+    inferences = predictor.predict_iter(get_images, batch_size=batch_size, top_k=top_k, pool=pool, metrics=metrics)
+    for path, _ in inferences:
+        latencies.append(time.perf_counter() - started.pop(path))
+    seconds = time.perf_counter() - start
+
+    stages_ms = {stage: totals['ms_per_image'] for stage, totals in metrics.summary()['stages'].items()}
+    return summarize('predictor', len(paths), seconds, latencies, batch_size=batch_size, workers=workers,
+                     processes=pool.processes if pool is not None else 0, stages_ms=stages_ms)
+
+
+def run_cli(folder, count, batch_size, workers, top_k, pool=None):
+    """
+    Run the command line application's main() on a folder of images.
+    :param folder: The folder of images.  The results file is written to it.
+    :param count: The number of images in the folder
+    :param batch_size: The number of images per forward pass
+    :param workers: The number of prefetch threads
+    :param top_k: The number of labels to find for each image
+    :param pool: An optional WorkerPool to run inference on
+    :return: The result
+    """
+    from cli import predict_from_folder
+
+    start = time.perf_counter()
+    with open(os.devnull, mode='w') as quiet, redirect_stdout(quiet):
+        predict_from_folder.main(folder, batch_size=batch_size, top_k=top_k, workers=workers,
+                                 queue_depth=max(pipeline.DEFAULT_QUEUE_DEPTH, batch_size * 2), pool=pool)
+    seconds = time.perf_counter() - start
+
+    return summarize('cli', count, seconds, batch_size=batch_size, workers=workers,
+                     processes=pool.processes if pool is not None else 0)
+
+
+def run_service(paths, images_per_request):
+    """
+    Send images to the microservice's POST /predict endpoint through Flask's test client.
+    :param paths: The images to classify
+    :param images_per_request: The number of images uploaded in each request
+    :return: The result, with per-request latencies
+    """
+    # Measure the classifier, not the prediction cache.  This has to be set before the service is first imported.
+    os.environ['CLASSIFIER_CACHE_PATH'] = ''
+    from microservice import predict_service
+
+    client = predict_service.app.test_client()
+    contents = []
+    for path in paths:
+        with open(path, mode='rb') as image_file:
+            contents.append((os.path.basename(path), image_file.read()))
+
+    latencies = []
+    start = time.perf_counter()
+    for first in range(0, len(contents), images_per_request):
+        request_start = time.perf_counter()
+        files = {f'image{index}': (io.BytesIO(content), name)
+                 for index, (name, content) in enumerate(contents[first:first + images_per_request], start=first)}
+        with open(os.devnull, mode='w') as quiet, redirect_stdout(quiet):
+            response = client.post('/predict', data=files, content_type='multipart/form-data')
+            response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError(f'POST /predict returned {response.status_code}')
+        latencies.append(time.perf_counter() - request_start)
+    seconds = time.perf_counter() - start
+
+    return summarize('service', len(paths), seconds, latencies, batch_size=images_per_request)
+
+
+def run_soak(paths, batch_size, batches, top_k):
+    """
+    Run the same batch through predict_batch() many times, tracing memory allocations as it goes.
+    :param paths: The images to make the batch from
+    :param batch_size: The number of images in the batch
+    :param batches: The number of times to run the batch
+    :param top_k: The number of labels to find for each image
+    :return: The result, with the traced memory
+    """
+    batch = [(path, predictor.resize_image(decode_image(path))) for path in paths[:batch_size]]
+
+    tracemalloc.start()
+    latencies = []
+    baseline = None
+    start = time.perf_counter()
+    for _ in range(batches):
+        batch_start = time.perf_counter()
+        predictor.predict_batch(batch, top_k=top_k)
+        latencies.append(time.perf_counter() - batch_start)
+        if baseline is None:
+            # Measure from after the first batch, once the reusable buffers exist
+            baseline = tracemalloc.get_traced_memory()[0]
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    megabyte = 1024 * 1024
+    traced = {
+        'start': round(baseline / megabyte, 3),
+        'end': round(current / megabyte, 3),
+        'peak': round(peak / megabyte, 3),
+        'growth': round((current - baseline) / megabyte, 3)
+    }
+    return summarize('soak', batches * len(batch), seconds, latencies, batch_size=len(batch), tracemalloc_mb=traced)
+
+
+def run_cascade(paths, batch_size, thresholds):
+    """
+    Run images through the main model alone, then through the cascade at each threshold, and compare them.  The images
+    are decoded and staged up front so only the models are timed.
+    :param paths: The images to classify
+    :param batch_size: The number of images per forward pass
+    :param thresholds: The cascade thresholds to test
+    :return: Yields a result for each threshold
+    """
+    main_backend = predictor.model.get()
+    if predictor.first_model is not None:
+        first_backend = predictor.first_model.get()
+    else:
+        first_backend = backends.create_backend(cascade.first_settings(predictor.settings))
+
+    pixels = np.stack([np.asarray(predictor.resize_image(decode_image(path))) for path in paths])
+    inputs = np.empty((batch_size,) + pixels.shape[1:], dtype=np.float32)
+
+    def classify_all(first, threshold):
+        top1 = []
+        escalated_count = 0
+        latencies = []
+        for first_image in range(0, len(pixels), batch_size):
+            batch_start = time.perf_counter()
+            probabilities, escalated = cascade.classify(pixels[first_image:first_image + batch_size], inputs,
+                                                        main_backend, first, threshold)
+            latencies.append(time.perf_counter() - batch_start)
+            top1.append(np.argmax(probabilities, axis=1))
+            escalated_count += len(probabilities) if escalated is None else int(np.count_nonzero(escalated))
+        return np.concatenate(top1), escalated_count, latencies
+
+    # Warm the first model up so its graph compilation isn't counted
+    classify_all(first_backend, 0.0)
+
+    expected, _, main_latencies = classify_all(None, 0.0)
+    main_seconds = sum(main_latencies)
+    for threshold in thresholds:
+        actual, escalated_count, latencies = classify_all(first_backend, threshold)
+        seconds = sum(latencies)
+        yield summarize('cascade', len(paths), seconds, latencies, batch_size=batch_size, threshold=threshold,
+                        escalated=round(escalated_count / len(paths), 4),
+                        compute_saved=round(1 - seconds / main_seconds, 4) if main_seconds > 0 else None,
+                        agreement=round(float(np.mean(actual == expected)), 4),
+                        main_model_seconds=round(main_seconds, 3))
+
+
+def run_decoder(paths):
+    """
+    Decode and resize images with a full decode, then with the fast decoder, and compare them.
+    :param paths: The images to decode
+    :return: Yields a result for the full decode, and one for the fast decoder
+    """
+    target_size = (predictor.MODEL_IMG_SIZE, predictor.MODEL_IMG_SIZE)
+    decoders = (
+        ('full', decode_image),
+        ('draft', functools.partial(decoder.decode, target_size=target_size, draft=True, orientation=False))
+    )
+
+    expected = None
+    full_seconds = None
+    for name, decode in decoders:
+        resized = []
+        latencies = []
+        start = time.perf_counter()
+        for path in paths:
+            image_start = time.perf_counter()
+            resized.append(np.asarray(predictor.resize_image(decode(path)), dtype=np.int16))
+            latencies.append(time.perf_counter() - image_start)
+        seconds = time.perf_counter() - start
+
+        if expected is None:
+            expected, full_seconds = resized, seconds
+        difference = float(np.mean([np.abs(actual - full).mean() for actual, full in zip(resized, expected)]))
+        yield summarize('decoder', len(paths), seconds, latencies, decoder=name,
+                        speedup=round(full_seconds / seconds, 2) if seconds > 0 else None,
+                        pixel_difference=round(difference, 3))
+
+
+def describe_environment():
+    """
+    :return: A dict describing the machine and model the benchmark was run on
+    """
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'model_id': predictor.MODEL_ID
+    }
+
+
+def compare(baseline, results):
+    """
+    Print the change in throughput between an earlier run and this one, for each result found in both.
+    :param baseline: The report from the earlier run, as written by main()
+    :param results: This run's results
+    :return: Nothing
+    """
+    def key(result):
+        return tuple(result.get(field) for field in RESULT_KEY)
+
+    earlier = {key(result): result for result in baseline['results']}
+    for result in results:
+        before = earlier.get(key(result), {}).get('images_per_second')
+        after = result.get('images_per_second')
+        if before and after:
+            change = (after - before) / before
+            name = ', '.join(f'{field}={value}' for field, value in zip(RESULT_KEY, key(result)) if value is not None)
+            print(f'{name}: {before} -> {after} images/sec ({change:+.1%})')
+
+
+def run(resolution, paths, folder, arguments, pools):
+    """
+    Run the chosen scenarios on one resolution of images.
+    :param resolution: The (width, height) of the images
+    :param paths: The images
+    :param folder: The folder holding the images
+    :param arguments: The parsed command line arguments
+    :param pools: A dict of WorkerPools keyed by process count, with None for running in this process
+    :return: Yields the results, one at a time
+    """
+    details = {'resolution': f'{resolution[0]}x{resolution[1]}'}
+    top_k = arguments.top_k
+
+    for batch_size in arguments.batch_sizes:
+        if 'stages' in arguments.scenarios:
+            yield dict(details, **run_stages(paths, batch_size, top_k))
+        for workers in arguments.workers:
+            for pool in pools.values():
+                if 'predictor' in arguments.scenarios:
+                    yield dict(details, **run_predictor(paths, batch_size, workers, top_k, pool))
+                if 'cli' in arguments.scenarios:
+                    yield dict(details, **run_cli(folder, len(paths), batch_size, workers, top_k, pool))
+        if 'service' in arguments.scenarios:
+            yield dict(details, **run_service(paths, batch_size))
+        if 'cascade' in arguments.scenarios:
+            for result in run_cascade(paths, batch_size, arguments.cascade_thresholds):
+                yield dict(details, **result)
+
+    if 'decoder' in arguments.scenarios:
+        for result in run_decoder(paths):
+            yield dict(details, **result)
+
+    if 'soak' in arguments.scenarios:
+        yield dict(details, **run_soak(paths, max(arguments.batch_sizes), arguments.soak_batches, top_k))
+
+
+def main(arguments):
+    report = {'environment': describe_environment(), 'results': []}
+
+    print('Loading the model')
+    report['environment']['model'] = predictor.warm_up(max(arguments.batch_sizes))
+
+    pools = {0: None}
+    try:
+        for processes in arguments.processes:
+            if processes > 0:
+                pools[processes] = WorkerPool(processes)
+
+        for resolution in arguments.resolutions:
+            folder = os.path.join(arguments.image_dir, f'{resolution[0]}x{resolution[1]}')
+            print(f'Generating {arguments.images} images at {resolution[0]}x{resolution[1]} in {folder}')
+            paths = synthetic.write_images(folder, resolution, arguments.images, seed=arguments.seed)
+
+            for result in run(resolution, paths, folder, arguments, pools):
+                print(json.dumps(result))
+                report['results'].append(result)
+    finally:
+        for pool in pools.values():
+            if pool is not None:
+                pool.close()
+
+    with open(arguments.output, mode='w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f'Results written to {arguments.output}')
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as baseline_file:
+            compare(json.load(baseline_file), report['results'])
+
+
+def parse_arguments(args):
+    """
+    Parse the command line arguments.
+    :param args: The command line arguments, not including the script name
+    :return: The parsed arguments as an argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(prog='run_benchmark.py',
+                                     description='Benchmark the image classifier on synthetic images.')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='Path to write the JSON results to')
+    parser.add_argument('--compare',
+                        help='Path to the JSON results of an earlier run to compare throughput with')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS),
+                        help='The scenarios to run')
+    parser.add_argument('--resolutions', nargs='+', type=synthetic.parse_resolution,
+                        default=list(synthetic.DEFAULT_RESOLUTIONS),
+                        help='Image sizes to test, as <width>x<height>')
+    parser.add_argument('--images', type=int, default=DEFAULT_IMAGE_COUNT,
+                        help='Number of images at each resolution')
+    parser.add_argument('--image-dir', default=DEFAULT_IMAGE_DIR,
+                        help='Folder to generate the images in.  Images already there are reused.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the images\' content')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=list(DEFAULT_BATCH_SIZES),
+                        help='Batch sizes to test')
+    parser.add_argument('--workers', nargs='+', type=int, default=list(DEFAULT_WORKERS),
+                        help='Prefetch thread counts to test')
+    parser.add_argument('--processes', nargs='+', type=int, default=[0],
+                        help='Worker process counts to test, 0 runs the model in this process')
+    parser.add_argument('--top-k', type=int, default=predictor.TOP_K,
+                        help='Number of classifications to find for each image')
+    parser.add_argument('--soak-batches', type=int, default=DEFAULT_SOAK_BATCHES,
+                        help='Number of batches to run in the soak scenario')
+    parser.add_argument('--cascade-thresholds', nargs='+', type=float, default=list(DEFAULT_CASCADE_THRESHOLDS),
+                        help='Cascade thresholds to test in the cascade scenario')
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,69 @@
+"""
+Python Version: 3.9
+
+Summary: Generate synthetic JPEG images for benchmarking the image classifier.
+
+Description:
+The benchmarks need a repeatable set of images that can be made anywhere without downloading a data set.  The images
+are made from a coarse grid of random colours scaled up to the full resolution with a smooth filter, plus a little
+noise.  That gives the JPEG encoder (and so the decoder) a realistic amount of work, unlike flat colours which compress
+to almost nothing, or pure noise which is far harder than any photograph.
+
+The same seed always produces the same images, so results from different runs are comparable.
+"""
+import os
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_RESOLUTIONS = ((640, 480), (1920, 1080), (4000, 3000))  # (width, height) in pixels
+DEFAULT_QUALITY = 90  # JPEG quality, about what cameras and phones save at
+
+
+def make_image(width, height, rng):
+    """
+    Make a synthetic RGB image.
+    :param width: The width of the image in pixels
+    :param height: The height of the image in pixels
+    :param rng: The numpy random Generator to draw the image's content from
+    :return: The RGB PIL image
+    """
+    coarse = rng.integers(0, 256, size=(max(1, height // 32), max(1, width // 32), 3), dtype=np.uint8)
+    img = Image.fromarray(coarse, mode='RGB').resize((width, height), Image.BICUBIC)
+
+    pixels = np.asarray(img, dtype=np.int16) + rng.integers(-8, 9, size=(height, width, 3), dtype=np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), mode='RGB')
+
+
+def write_images(folder, resolution, count, seed=0, quality=DEFAULT_QUALITY):
+    """
+    Write a set of synthetic JPEGs to a folder.  Images that already exist are not made again.
+    :param folder: The folder to write the images to.  It is created if needed.
+    :param resolution: The (width, height) of the images
+    :param count: The number of images to write
+    :param seed: The seed for the images' content
+    :param quality: The JPEG quality to save the images at
+    :return: A list of the full paths to the images
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    width, height = resolution
+    paths = []
+    for index in range(count):
+        path = os.path.join(folder, f'synthetic_{width}x{height}_{index:05d}.jpg')
+        if not os.path.exists(path):
+            rng = np.random.default_rng([seed, width, height, index])
+            make_image(width, height, rng).save(path, format='JPEG', quality=quality)
+        paths.append(path)
+    return paths
+
+
+def parse_resolution(text):
+    """
+    Parse a resolution given on the command line.
+    :param text: The resolution as <width>x<height>, for example 1920x1080
+    :return: The (width, height) tuple
+    """
+    width, height = text.lower().split('x')
+    return int(width), int(height)
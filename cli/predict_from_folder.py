@@ -3,141 +3,672 @@ Author: Steven Luke (steven.luke@nuix.com)
 Date: 2022.04.05
 Python Version: 3.9
 
-Summary: Command line application to run a prediction on images stored in a folder.
+Summary: Command line application to run a prediction on images stored in a folder, or in a pack.
 
 Description:
-Run an inference on all JPG images in the input directory.  Write out an inference.json file with the results.  The
-JSON output will have two sections:
-{
-    "status": <progress of the analysis>,
-    "results": <results of the analysis>
-}
+Run an inference on all JPEG images in the input directory and its subfolders.  Images are found by their content (the
+first few bytes of each file) rather than their extension, so renamed files are still classified, and --formats can
+add PNG and TIFF images.  The folders are walked as the images are needed, so the first results are made before the
+whole tree has been seen.
+
+The input can also be a pack (see img_classifier.pack) - the images.pack data file, or a folder holding one - which
+holds every image in a single memory-mapped file.  Its images are named by their keys (their GUIDs) in the results, and
+the results are written to the folder the pack is in.  The results are written to the input directory as they
+are made (see img_classifier.results_log for the details of each file):
 
-The status will contain an object like this:
+inference.jsonl has one line of JSON for each image, appended as soon as the image's result is made:
+{"image": <image name>, "results": [{<classification_1>: <score_1>}, {<classification_2>: <score_2>}, ...]}
+or, if the image could not be classified:
+{"image": <image name>, "error": <the error>}
+With --skip-near-duplicates, images that are near-duplicates of an image already classified are not run through the
+model - they inherit that image's result, and their line has "duplicate_of": <name of the image whose result was
+inherited>.  If the model cascade is turned on in the classifier settings, each line has "model": <the model that
+classified the image>.
+
+status.json holds the progress of the run, and is replaced as a whole (at most every --status-interval seconds) so it
+can be read at any time:
 {
     "done": True|False,
     "progress":<percent complete>,
     "current_item": <index of item being worked on>
-    "total": <total count of items>
-    "errors": <list of encountered errors>
+    "total": <count of files found so far>
+    "discovering": <True while more files may still be found>
+    "classified": <count of images with results so far>
+    "error_count": <count of images with errors so far>
+    "skipped": <count of files that were not images>
 }
+When the run is done, the status also holds the prediction cache's hit and miss counts as "cache" (unless --no-cache is
+used), the number of probability vectors saved as "stored" (with --store) and, with --metrics, the time spent in each
+stage of the classification as "metrics".
 
-The results will be a map with the name of the image and a list of the classification results
+When the run is done the whole run is also compacted into inference.json, before status.json is marked done.  It has
+the same format this application has always written:
 {
-    <image name>: [
-        {<classification_1>: <score_1>},
-        {<classification_2>: <score_2>},
-        {<classification_3>: <score_3>}
-    ]
+    "status": <the final status, with "errors": <list of encountered errors>>,
+    "results": {<image name>: [{<classification_1>: <score_1>}, {<classification_2>: <score_2>}, ...], ...},
+    "duplicates": {<image name>: <name of the image whose result was inherited>, ...}  (with --skip-near-duplicates)
+    "models": {<image name>: <the model that classified the image>, ...}  (with the model cascade)
 }
+If the errors list is empty then there was no error and all images were successful.
+
+Every line of inference.jsonl also records the identity of the image file: its "size" and "mtime_ns", or with
+--identity hash its "sha256".  If a run is stopped, run it again with --resume to keep the results already in
+inference.jsonl and only classify the images without one - images that had an error, and images whose file no longer
+matches the identity recorded with its result.  The status counts the results kept as "resumed".
 
-The results file will be regularly updated with the status and progress, at which point the results section may
-be updated as well.  The results should not be considered correct until the "done" status returns true.  If the
-errors list is empty then there was no error and all images were successful.
+With --follow the images are classified while they are still being exported.  Rather than looking through the folder,
+the application reads the paths of finished files from the folder's manifest.txt as the exporter appends them, and
+stops once manifest.end appears and every listed file has been read (see img_classifier.discovery).  If the manifest
+doesn't grow for --follow-timeout seconds and hasn't been ended, the export is assumed to have failed and the run ends
+with the images listed so far.
+
+A folder can be split into shards classified at the same time, each in its own process with its own model.  Files are
+given to shards by a hash of their path within the folder, so the split is the same every time and on every machine.
+    --shards N:         Classify the folder in N processes on this machine, then merge their results
+    --shard I/N:        Classify only shard I (counting from 0) of N, for example on one of several machines sharing
+                        the folder.  Its results are written to inference.shard-I-of-N.jsonl and its progress to
+                        status.shard-I-of-N.json.
+    --shards N --merge: Once every shard is done, merge their results into inference.jsonl, inference.json and
+                        status.json without classifying anything.  The merged status adds up the shards' counts, and
+                        has each shard's own status under "shards".
+The options given to each shard apply to it alone: --processes worker processes are started for every shard, a
+--store is split into a folder for each shard, and near-duplicates are only found within a shard.  The prediction
+cache is shared by all of the shards, so an image classified by one is a cache hit for the others.
+
+With --daemon the application keeps running with the model loaded, and input_dir is used as a spool folder that jobs
+are dropped into (see img_classifier.spool for the protocol).  Each job is a folder of images, which is classified as if
+it were given as input_dir - its inference.jsonl, status.json and inference.json are written to the job's folder - and
+then the job's <job>.done marker is written next to it in the spool.  Loading TensorFlow and the model is only paid for
+once, so small jobs are done in seconds.  The spool is watched with inotify on Linux and polled every --poll-interval
+seconds elsewhere.  Stop the daemon with Ctrl+C.
 """
+import argparse
 import json
+import multiprocessing
 import os
+import sqlite3
 import sys
+from io import BytesIO
 
-from PIL import Image
+from img_classifier import decoder
+from img_classifier import dedupe
+from img_classifier import discovery
+from img_classifier import framing
+from img_classifier import pack
+from img_classifier import pipeline
 from img_classifier import predictor
+from img_classifier import results_log
+from img_classifier import spool
+from img_classifier.cache import PredictionCache, DEFAULT_CACHE_PATH, DEFAULT_MAX_ENTRIES
+from img_classifier.config import load_config
+from img_classifier.metrics import Profiler, StageMetrics, PROFILERS, timed
+from img_classifier.store import ProbabilityStore
+from img_classifier.worker_pool import WorkerPool
 
 
-def get_file_list(folder):
+def get_file_list(folder, shard=None, follow=False, follow_timeout=discovery.DEFAULT_FOLLOW_TIMEOUT):
     """
-    Generate a list of all the files in the folder which will be processed.  The folder itself, and all subfolders
-    recursively will be examined for JPEG files.  All found JPEG files will have their full path added to the list.
+    Find the files in the folder which will be processed.  The folder itself, and all subfolders recursively will be
+    examined as the files are needed.  Whether each file is an image is decided when it is read.
     :param folder: The root path to search for images to analyze
-    :return: A list of all JPEGs in the root folder or any of its children.
+    :param shard: The (index, count) of the shard to find the files of, or None for all of them
+    :param follow: True to take the files from the folder's manifest as they are exported, instead of looking for them
+    :param follow_timeout: The seconds to wait for the manifest to grow before giving up on it, when following it
+    :return: A FileDiscovery of the full paths of the files in the root folder or any of its children, leaving out the
+             files this application writes, or a ManifestFollower of the files listed in the manifest.
     """
-    file_paths = []
-    for root, dirs, names in os.walk(folder):
-        for name in names:
-            file_paths.append(os.path.join(root, name))
-    return [name for name in file_paths
-            if name.lower().endswith('.jpg') or name.lower().endswith('.jpeg')]
+    if follow:
+        return discovery.ManifestFollower(folder, shard, idle_timeout=follow_timeout)
+
+    shards = [None] if shard is None else [None] + [(index, shard[1]) for index in range(shard[1])]
+    output_files = [results_log.shard_filename(filename, output_shard) for output_shard in shards
+                    for filename in (results_log.LOG_FILENAME, results_log.STATUS_FILENAME)]
+    other_files = [results_log.COMPACT_FILENAME, discovery.MANIFEST_FILENAME, discovery.MANIFEST_END_FILENAME]
+    return discovery.FileDiscovery(folder, exclude=output_files + other_files, shard=shard)
+
+
+# Returned by the image loader in place of an image whose result was kept from the run being resumed
+ALREADY_CLASSIFIED = object()
+
+# Decodes images straight to about the size the model needs, as set in the 'decoder' settings
+decode_image = decoder.from_settings(predictor.settings, (predictor.MODEL_IMG_SIZE, predictor.MODEL_IMG_SIZE))
+
+
+def get_image_loader(cache=None, metrics=None, formats=discovery.DEFAULT_FORMATS, log=None, identity='stat',
+                     image_pack=None):
+    """
+    Make the function used to load images.  It is run on the prefetch pipeline's worker threads.
+    :param cache: An optional PredictionCache.  If provided, images whose content is already in the cache are not
+                  decoded - their cached result is returned instead.
+    :param metrics: An optional StageMetrics to record the time spent decoding and resizing images
+    :param formats: The names of the image formats to classify, from discovery.IMAGE_FORMATS
+    :param log: An optional ResultsLog to give each image file's identity to, and to check for results kept from the
+                run being resumed
+    :param identity: How image files are identified: 'stat' (size and modification time) or 'hash' (content)
+    :param image_pack: An optional ImagePack to read the images from, in which case the function is given their keys
+    :return: A function that takes the full path to an image file and returns the image as an RGB PIL image sized
+             for the model, the image's cached result, or ALREADY_CLASSIFIED.  Raises discovery.NotAnImage for files
+             that aren't one of the formats.
+    """
+    def load_image(image):
+        # The stat check is made before the file is read, so images that are already classified aren't read at all
+        if log is not None and 'stat' == identity:
+            file_id = results_log.file_identity(image) if image_pack is None else image_pack.identity(image)
+            if log.already_classified(image, file_id):
+                return ALREADY_CLASSIFIED
+
+        if image_pack is None:
+            image_bytes = discovery.read_image_file(image, formats)
+        else:
+            image_bytes = image_pack.read_image(image, formats)
+
+        if log is not None:
+            if 'hash' == identity:
+                file_id = results_log.file_identity(image, identity, image_bytes)
+                if log.already_classified(image, file_id):
+                    return ALREADY_CLASSIFIED
+            log.set_identity(image, file_id)
+
+        return load_image_bytes(image, image_bytes, cache, metrics)
+
+    return load_image
+
+
+def load_image_bytes(image, image_bytes, cache=None, metrics=None):
+    """
+    Decode an image that has been read, unless its result is already cached.
+    :param image: The image's name
+    :param image_bytes: The bytes of the image file
+    :param cache: An optional PredictionCache to look the image's result up in before decoding it
+    :param metrics: An optional StageMetrics to record the time spent decoding and resizing the image
+    :return: The image as an RGB PIL image sized for the model, or the image's cached result
+    """
+    if cache is not None:
+        cached = cache.lookup(image, image_bytes)
+        if cached is not None:
+            print(f'{image}: cached')
+            return cached
+
+    with timed(metrics, 'decode'):
+        img_pixels = decode_image(BytesIO(image_bytes))
+    print(f'{image}: {img_pixels.size}')
+    with timed(metrics, 'resize'):
+        return predictor.resize_image(img_pixels)
+
+
+def get_frame_generator(frames, workers=pipeline.DEFAULT_WORKERS, queue_depth=pipeline.DEFAULT_QUEUE_DEPTH, cache=None,
+                        metrics=None, formats=discovery.DEFAULT_FORMATS):
+    """
+    The Image Generator for images streamed in frames rather than read from files.
+    :param frames: An iterable of (<key>, <bytes of the image file>) tuples, such as framing.read_frames()
+    :param workers: The number of threads used to decode and resize images
+    :param queue_depth: The maximum number of images decoded ahead of the predictor
+    :param cache: An optional PredictionCache consulted before images are decoded
+    :param metrics: An optional StageMetrics to record the time spent decoding and resizing images
+    :param formats: The names of the image formats to classify.  Other images are given an error.
+    :return: A function which will yield (<key>, <image in PIL format>) tuples when called, or (<key>, <cached result>)
+             for images found in the cache.
+    """
+    def load_frame(frame):
+        image, image_bytes = frame
+        if discovery.sniff(image_bytes[:discovery.SNIFF_BYTES], formats) is None:
+            raise discovery.NotAnImage(f'{image} is not a {"/".join(formats)} image')
+        return load_image_bytes(image, image_bytes, cache, metrics)
+
+    def read_image():
+        # Every frame is yielded, even if it isn't an image, so the sender gets an answer for each
+        for (image, _), img_pixels in pipeline.prefetch(frames, load_frame, workers=workers, queue_depth=queue_depth):
+            yield image, img_pixels
+
+    return read_image
 
 
-def get_image_generator(file_list, output_obj, output_file):
+def get_image_generator(file_list, log,
+                        workers=pipeline.DEFAULT_WORKERS, queue_depth=pipeline.DEFAULT_QUEUE_DEPTH, cache=None,
+                        metrics=None, formats=discovery.DEFAULT_FORMATS, identity='stat', image_pack=None):
     """
     This is an enclosure for the Image Generator to be provided to the predictor.  This method holds the
     data source and returns the generator function.
-    :param file_list: List of files to predict
-    :param output_obj: The data object to use for storing status results in
-    :param output_file: The file to which status updates should be written
-    :return: A function which will yield images in PIL format when called.
+    :param file_list: The FileDiscovery (or any iterable) of files to predict, or the ImagePack of images to
+                      predict
+    :param log: The ResultsLog to report progress to
+    :param workers: The number of threads used to decode and resize images
+    :param queue_depth: The maximum number of images decoded ahead of the predictor
+    :param cache: An optional PredictionCache consulted before images are decoded
+    :param metrics: An optional StageMetrics to record the time spent decoding and resizing images
+    :param formats: The names of the image formats to classify.  Other files are skipped.
+    :param identity: How image files are identified: 'stat' (size and modification time) or 'hash' (content)
+    :param image_pack: The ImagePack to read the images from, if the file_list is an ImagePack's keys
+    :return: A function which will yield (<image path>, <image in PIL format>) tuples when called.  Images found in
+             the cache are yielded as (<image path>, <cached result>).
     """
-    status_obj = output_obj['status']
-    item_count = len(file_list)
-
     def read_image():
         """
         Open images from the provided list, turn them into PIL formatted RGB images, and
-        return them one at a time.
-        :return: Yields 1 RGB PIL image at a time.
+        return them one at a time.  The images are loaded on a pool of worker threads ahead of when they are needed.
+        If an image can't be loaded the error is passed on in its place so it is reported with the image's results.
+        :return: Yields tuples of the image's path and the 1 RGB PIL image, one at a time.
         """
-        for index, image in enumerate(file_list):
-            img_pixels = Image.open(image).convert('RGB')
-            print(f'{image}: {img_pixels.size}')
+        load_image = get_image_loader(cache, metrics, formats, log, identity, image_pack)
+        loaded_images = pipeline.prefetch(file_list, load_image, workers=workers, queue_depth=queue_depth)
+        for index, (image, img_pixels) in enumerate(loaded_images):
             sys.stdout.flush()
-            yield img_pixels
-            status_obj['current_item'] = index + 1
-            percent_complete = int((index / item_count) * 100)
-            status_obj['progress'] = percent_complete
-            with open(output_file, mode='w') as status:
-                json.dump(output_obj, status)
+            if isinstance(img_pixels, discovery.NotAnImage):
+                log.skip(image)
+            elif img_pixels is ALREADY_CLASSIFIED:
+                log.resumed(image)
+            else:
+                yield image, img_pixels
+            found = getattr(file_list, 'found', None)
+            log.set_progress(index + 1, found, not getattr(file_list, 'finished', True))
 
     return read_image
 
 
-def main(input_dir):
-    results = os.path.join(input_dir, 'inference.json')
+def main(input_dir, batch_size=predictor.DEFAULT_BATCH_SIZE, top_k=predictor.TOP_K,
+         workers=pipeline.DEFAULT_WORKERS, queue_depth=pipeline.DEFAULT_QUEUE_DEPTH, cache=None, pool=None,
+         metrics=None, profiler=None, near_duplicates=None, store=None,
+         status_interval=results_log.DEFAULT_STATUS_INTERVAL, formats=discovery.DEFAULT_FORMATS, resume=False,
+         identity='stat', shard=None, follow=False, follow_timeout=discovery.DEFAULT_FOLLOW_TIMEOUT):
+    # Read the images from a pack, if the input is one, and write the results next to it
+    pack_path = pack.find_pack(input_dir)
+    image_pack = None
+    if pack_path is not None:
+        image_pack = pack.ImagePack(pack_path, shard)
+        image_list = image_pack
+        output_dir = os.path.dirname(os.path.abspath(pack_path))
+    else:
+        # Find the files to predict as they are needed - the total grows as the folders are walked
+        image_list = get_file_list(input_dir, shard, follow, follow_timeout)
+        output_dir = input_dir
+
+    # Results are appended to inference.jsonl as they are made, and the progress is written to status.json
+    # With resume, the results already in inference.jsonl are kept and it is appended to
+    log = results_log.ResultsLog(output_dir, None, status_interval,
+                                 duplicates=near_duplicates is not None, models=predictor.first_model is not None,
+                                 resume=resume, model_id=predictor.model_id(top_k), shard=shard)
+
+    # Call the prediction, using the image generator as source, and log each prediction as soon as it is made
+    image_generator = get_image_generator(image_list, log, workers=workers, queue_depth=queue_depth, cache=cache,
+                                          metrics=metrics, formats=formats, identity=identity, image_pack=image_pack)
+    predict_arguments = {'batch_size': batch_size, 'top_k': top_k, 'pool': pool, 'metrics': metrics,
+                         'profiler': profiler, 'store': store}
+    try:
+        if near_duplicates is not None:
+            inferences = dedupe.predict_iter(image_generator, near_duplicates, **predict_arguments)
+        else:
+            inferences = ((img, inference, None) for img, inference in
+                          predictor.predict_iter(image_generator, **predict_arguments))
+        for img, inference, representative in inferences:
+            if cache is not None:
+                # A result inherited from a near-duplicate wasn't made from this image's content, so isn't cached
+                if representative is None:
+                    cache.record(img, inference)
+                else:
+                    cache.forget(img)
+            model = getattr(inference, 'model', None) if predictor.first_model is not None else None
+            log.record(img, inference, representative, model)
+    finally:
+        log.close()
+        if image_pack is not None:
+            image_pack.close()
+
+    totals = {}
+    print(f'Found {image_list.found} files, {log.status["skipped"]} of which were not {"/".join(formats)} images')
+    if resume:
+        print(f'Resumed: kept the results of {log.status["resumed"]} images from the earlier run')
+    if pool is None:
+        print(f'Model timings: {predictor.model.timings()}')
+    if cache is not None:
+        totals['cache'] = cache.stats()
+        print(f'Cache: {totals["cache"]}')
+    if store is not None:
+        totals['stored'] = store.rows
+        print(f'Stored the probabilities of {store.rows} images in {store.path}')
+    if metrics is not None:
+        totals['metrics'] = metrics.summary()
+        print(f'Stage timings: {json.dumps(totals["metrics"], indent=2)}')
+    if near_duplicates is not None:
+        classified = image_list.found - log.status['skipped'] - log.status['resumed']
+        print(f'Near-duplicates: {classified - near_duplicates.groups} images inherited results from '
+              f'{near_duplicates.groups} classified images')
+    if profiler is not None:
+        print(f'Profiled {profiler.samples} batches, saved to {profiler.output_path}')
+
+    # Signal the completion of work: write the compacted inference.json, then mark the status done.  The shards of a
+    # folder are compacted together when they are merged.
+    log.finish(compact=shard is None, **totals)
+
+
+def stream_main(input_stream, output_stream, batch_size=predictor.DEFAULT_BATCH_SIZE, top_k=predictor.TOP_K,
+                workers=pipeline.DEFAULT_WORKERS, queue_depth=pipeline.DEFAULT_QUEUE_DEPTH, cache=None, pool=None,
+                metrics=None, profiler=None, near_duplicates=None, store=None, formats=discovery.DEFAULT_FORMATS):
+    """
+    Classify images streamed to the input in frames (see img_classifier.framing), writing each result to the output as
+    a line of JSON as soon as it is made, in the same format as the lines of inference.jsonl.  Once the input ends a
+    last line is written with the run's status: {"status": {"done": true, "total": <count>, "classified": <count>,
+    "error_count": <count>, ...}}.  Nothing is written to disk.  If the input was cut off part way through a frame, the
+    whole frames before it are still classified, and the status has an "error" saying so.
+    :param input_stream: The binary stream the frames are read from
+    :param output_stream: The text stream the results are written to
+    :return: False if the input was cut off part way through a frame, otherwise True
+    """
+    cut_off = []
+
+    def whole_frames():
+        try:
+            yield from framing.read_frames(input_stream)
+        except ValueError as e:
+            cut_off.append(e)
+
+    image_generator = get_frame_generator(whole_frames(), workers=workers, queue_depth=queue_depth, cache=cache,
+                                          metrics=metrics, formats=formats)
+    predict_arguments = {'batch_size': batch_size, 'top_k': top_k, 'pool': pool, 'metrics': metrics,
+                         'profiler': profiler, 'store': store}
+    if near_duplicates is not None:
+        inferences = dedupe.predict_iter(image_generator, near_duplicates, **predict_arguments)
+    else:
+        inferences = ((img, inference, None) for img, inference in
+                      predictor.predict_iter(image_generator, **predict_arguments))
+
+    status = {'done': False, 'total': 0, 'classified': 0, 'error_count': 0, 'model_id': predictor.model_id(top_k)}
+    for img, inference, representative in inferences:
+        if cache is not None:
+            # A result inherited from a near-duplicate wasn't made from this image's content, so isn't cached
+            if representative is None:
+                cache.record(img, inference)
+            else:
+                cache.forget(img)
+        model = getattr(inference, 'model', None) if predictor.first_model is not None else None
+        entry = results_log.make_entry(img, inference, representative, model)
+        status['total'] += 1
+        status['error_count' if 'error' in entry else 'classified'] += 1
+        output_stream.write(json.dumps(entry) + '\n')
+        output_stream.flush()
+
+    status['done'] = True
+    if len(cut_off) > 0:
+        status['error'] = str(cut_off[0])
+    if cache is not None:
+        status['cache'] = cache.stats()
+    if store is not None:
+        status['stored'] = store.rows
+    if metrics is not None:
+        status['metrics'] = metrics.summary()
+    output_stream.write(json.dumps({'status': status}) + '\n')
+    output_stream.flush()
+    return len(cut_off) == 0
 
-    # Get the list of images to predict
-    image_list = get_file_list(input_dir)
 
-    # Build the objects that will hold results
-    errors = []
-    status_obj = {'total': len(image_list), 'done': False, 'progress': 0, 'current_item': 0, 'errors': errors}
-    inference_results = {}
-    output_obj = {'status': status_obj, 'results': inference_results}
+def parse_shard(text):
+    """
+    Parse the value of the --shard option.
+    :param text: The shard as '<index>/<count>', with the index counting from 0
+    :return: The shard as an (index, count) tuple
+    """
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected <index>/<count>, not {text}')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'the index must be from 0 to {count - 1}, not {index}')
+    return index, count
+
+
+def parse_arguments(args):
+    """
+    Parse the command line arguments.
+    :param args: The command line arguments, not including the script name
+    :return: The parsed arguments as an argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(prog='predict_from_folder.py',
+                                     description='Run an image classification on all images in a folder.')
+    parser.add_argument('input_dir', nargs='?',
+                        help='Absolute path to the folder of images to classify, or to a pack of images.  Not used '
+                             'with --stdin.')
+    parser.add_argument('--batch-size', type=int, default=predictor.DEFAULT_BATCH_SIZE,
+                        help='Number of images to run through the model at once')
+    parser.add_argument('--top-k', type=int, default=predictor.TOP_K,
+                        help='Number of classifications to report for each image')
+    parser.add_argument('--prefetch-workers', type=int, default=pipeline.DEFAULT_WORKERS,
+                        help='Number of threads used to decode and resize images')
+    parser.add_argument('--prefetch-depth', type=int, default=pipeline.DEFAULT_QUEUE_DEPTH,
+                        help='Maximum number of images decoded ahead of the model')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH,
+                        help='Path to the prediction cache database')
+    parser.add_argument('--cache-max-entries', type=int, default=DEFAULT_MAX_ENTRIES,
+                        help='Maximum number of predictions to keep in the cache')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not use the prediction cache')
+
+    settings = load_config()
+    pool_settings = settings['pool']
+    parser.add_argument('--processes', type=int, default=pool_settings['processes'],
+                        help='Number of worker processes to run the model in.  0 runs it in this process.')
+    parser.add_argument('--intra-op-threads', type=int, default=pool_settings['intra_op_threads'],
+                        help='Threads each worker process uses inside a single operation')
+    parser.add_argument('--inter-op-threads', type=int, default=pool_settings['inter_op_threads'],
+                        help='Threads each worker process uses to run independent operations at the same time')
+    parser.add_argument('--pin-cpus', action='store_true', default=pool_settings['pin_cpus'],
+                        help='Pin each worker process to its own share of the CPUs')
+    parser.add_argument('--skip-near-duplicates', action='store_true', default=settings['dedupe']['enabled'],
+                        help='Only classify one image from each group of near-duplicates, the rest inherit its result')
+    parser.add_argument('--near-duplicate-distance', type=int, default=settings['dedupe']['max_distance'],
+                        help='Maximum number of bits that may differ between the perceptual hashes of near-duplicates')
+    parser.add_argument('--store',
+                        help='Folder of a probability store to save every classified image\'s probabilities to.  '
+                             'Images found in the cache are not classified, so use --no-cache to store them all.')
+    parser.add_argument('--store-embeddings', action='store_true',
+                        help='Also save each image\'s embedding from the model\'s penultimate layer in the store')
+    parser.add_argument('--formats', nargs='+', choices=discovery.IMAGE_FORMATS,
+                        default=list(discovery.DEFAULT_FORMATS),
+                        help='Image formats to classify, identified by the content of each file rather than its name')
+    parser.add_argument('--resume', action='store_true',
+                        help='Keep the results of an earlier run of the folder and only classify the images it missed, '
+                             'had errors on, or that have changed since')
+    parser.add_argument('--identity', choices=results_log.IDENTITY_CHECKS, default='stat',
+                        help='How to tell whether an image has changed since its result was made: by its size and '
+                             'modification time (stat), or by its content (hash)')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the folder into this many shards and classify them in separate processes, each '
+                             'with its own model, then merge their results')
+    parser.add_argument('--shard', type=parse_shard,
+                        help='Classify only one shard of the folder, given as <index>/<count> with the index counting '
+                             'from 0, writing its results to files named for the shard')
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge the results of the --shards that have already classified the folder, without '
+                             'classifying anything')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep the model loaded and classify the jobs dropped into input_dir, used as a spool '
+                             'folder, until interrupted')
+    parser.add_argument('--poll-interval', type=float, default=spool.DEFAULT_POLL_INTERVAL,
+                        help='Most seconds between looks through the spool folder for jobs, with --daemon')
+    parser.add_argument('--poll', action='store_true',
+                        help='Only poll the spool folder, rather than watching it with inotify on Linux')
+    parser.add_argument('--stdin', action='store_true',
+                        help='Read the images from stdin as frames of <key, image bytes> and write the results to '
+                             'stdout as lines of JSON, instead of using a folder.  Everything else is printed to '
+                             'stderr.')
+    parser.add_argument('--follow', action='store_true',
+                        help='Classify the files listed in the folder\'s manifest.txt as they are exported, until '
+                             'manifest.end appears')
+    parser.add_argument('--follow-timeout', type=float, default=discovery.DEFAULT_FOLLOW_TIMEOUT,
+                        help='Seconds to wait for the manifest to grow before giving up on the export, or 0 to wait '
+                             'forever, with --follow')
+    parser.add_argument('--status-interval', type=float, default=results_log.DEFAULT_STATUS_INTERVAL,
+                        help='Minimum number of seconds between updates of the status.json file')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Time each stage of the classification and report the timings in the status')
+    parser.add_argument('--profile-rate', type=float, default=0.0,
+                        help='Fraction of batches to profile, from 0 to 1')
+    parser.add_argument('--profile-output', default='predict_from_folder.prof',
+                        help='File to save the profile of the sampled batches to')
+    parser.add_argument('--profiler', choices=PROFILERS, default='cprofile',
+                        help='The profiler to use.  pyinstrument needs the pyinstrument package and saves HTML.')
+    return parser.parse_args(args)
+
 
-    # Initialize the results file
-    with open(results, mode='w') as status:
-        json.dump(output_obj, status)
+def run(arguments, shard=None, job_spool=None, results_output=None):
+    """
+    Set up the cache, worker pool, metrics, profiler, near-duplicate index and store the arguments ask for, and classify
+    the folder (or one shard of it) with them.
+    :param arguments: The parsed command line arguments
+    :param shard: The (index, count) of the shard to classify, or None for the whole folder
+    :param job_spool: A Spool to take jobs from instead, keeping the model and everything else set up between jobs
+    :param results_output: The text stream to write the results to, with --stdin
+    :return: With --stdin, False if the input was cut off part way through a frame.  With a spool, this only returns if
+             it is interrupted.
+    """
+    prediction_cache = None
+    if not arguments.no_cache:
+        # Unlike the store, one cache is shared by every shard.  Each write to it is committed on its own, so a shard
+        # only waits for another's write, never for its classification (see img_classifier.cache).
+        try:
+            prediction_cache = PredictionCache(arguments.cache, predictor.model_id(arguments.top_k),
+                                               arguments.cache_max_entries)
+        except sqlite3.Error as e:
+            print(f'Classifying without the prediction cache, {arguments.cache} could not be opened: {e}')
 
-    # Call the prediction, using the image generator as source
-    inferences = predictor.predict(get_image_generator(image_list, output_obj, results))
+    worker_pool = None
+    if arguments.processes > 0:
+        worker_pool = WorkerPool(arguments.processes, intra_op_threads=arguments.intra_op_threads,
+                                 inter_op_threads=arguments.inter_op_threads, pin_cpus=arguments.pin_cpus)
 
-    # Write the predictions into the results file
-    for index, inference in enumerate(inferences):
-        img = image_list[index]
-        img_classes = []
+    batch_profiler = None
+    if arguments.profile_rate > 0:
+        profile_output = arguments.profile_output
+        if shard is not None:
+            profile_output = results_log.shard_filename(profile_output, shard)
+        batch_profiler = Profiler(arguments.profile_rate, profile_output, engine=arguments.profiler)
 
-        if 'ERROR' == inference[0]:
-            # If there was an error predicting an image, pass the error along with the image that caused it
-            errors.append(f'{img}: {inference[1]}')
+    probability_store = None
+    if arguments.store:
+        # A store is only written by one process, so each shard has its own
+        store_path = arguments.store
+        if shard is not None:
+            store_path = os.path.join(store_path, f'shard-{shard[0]}-of-{shard[1]}')
+        probability_store = ProbabilityStore(store_path, mode='a', model_id=predictor.PROBABILITIES_ID,
+                                             embeddings=arguments.store_embeddings)
+
+    def classify(folder):
+        # Near-duplicates are only looked for within a folder, and the metrics are reported for each folder
+        near_duplicate_index = None
+        if arguments.skip_near_duplicates:
+            near_duplicate_index = dedupe.NearDuplicateIndex(arguments.near_duplicate_distance,
+                                                             predictor.settings['dedupe']['hash_size'])
+        options = {'batch_size': arguments.batch_size, 'top_k': arguments.top_k, 'workers': arguments.prefetch_workers,
+                   'queue_depth': arguments.prefetch_depth, 'cache': prediction_cache, 'pool': worker_pool,
+                   'metrics': StageMetrics() if arguments.metrics else None, 'profiler': batch_profiler,
+                   'near_duplicates': near_duplicate_index, 'store': probability_store,
+                   'formats': tuple(arguments.formats)}
+        if arguments.stdin:
+            return stream_main(sys.stdin.buffer, results_output, **options)
         else:
-            # Add the predictions for each image to a list, and assign the list to the image's results
-            for result in inference:
-                img_classes.append({result[0]: str(result[1])})
-            inference_results[img] = img_classes
+            main(folder, status_interval=arguments.status_interval, resume=arguments.resume,
+                 identity=arguments.identity, shard=shard, follow=arguments.follow,
+                 follow_timeout=arguments.follow_timeout, **options)
 
-        # Output the results for the image
-        with open(results, mode='w') as status:
-            json.dump(output_obj, status)
+    try:
+        if job_spool is None:
+            return classify(arguments.input_dir)
+        else:
+            if worker_pool is None:
+                print(f'Model ready: {predictor.warm_up(arguments.batch_size)}')
+            print(f'Waiting for jobs in {job_spool.folder}')
+            for job_folder in job_spool.jobs():
+                print(f'Starting job {job_folder}')
+                try:
+                    if not os.path.isdir(job_folder):
+                        raise FileNotFoundError(f'Job folder not found: {job_folder}')
+                    classify(job_folder)
+                except Exception as e:
+                    print(f'Job {job_folder} failed: {e}')
+                    job_spool.finish(job_folder, e)
+                else:
+                    job_spool.finish(job_folder)
+                    print(f'Finished job {job_folder}')
+    finally:
+        if worker_pool is not None:
+            worker_pool.close()
+        if prediction_cache is not None:
+            prediction_cache.close()
+        if probability_store is not None:
+            probability_store.close()
 
-    # Signal the completion of work
-    output_obj['status']['done'] = True
-    output_obj['status']['progress'] = 100
 
-    with open(results, mode='w') as status:
-        json.dump(output_obj, status)
+def run_shards(arguments):
+    """
+    Classify the folder in arguments.shards processes at once, one for each shard, and wait for them to finish.
+    :param arguments: The parsed command line arguments
+    :return: The indices of the shards whose process failed
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run, args=(arguments, (index, arguments.shards)),
+                                 name=f'Shard {index} of {arguments.shards}')
+                 for index in range(arguments.shards)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [index for index, process in enumerate(processes) if process.exitcode != 0]
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print('Missing input directory argument.  Run this application as')
-        print('> python.exe predict_from_folder.py <absolute path to images>')
+    arguments = parse_arguments(sys.argv[1:])
+    if arguments.stdin:
+        if arguments.daemon or arguments.shard is not None or arguments.shards > 1 or arguments.merge or \
+                arguments.follow or arguments.resume:
+            print('--stdin can\'t be used with --daemon, --shard, --shards, --merge, --follow or --resume',
+                  file=sys.stderr)
+            sys.exit(1)
+        # Only the results go to stdout.  Everything else printed - by this process, its worker processes and the
+        # libraries they use - is sent to stderr by pointing the stdout file descriptor at it.
+        results_output = os.fdopen(os.dup(sys.stdout.fileno()), mode='w', encoding='utf-8')
+        sys.stdout.flush()
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        whole = run(arguments, results_output=results_output)
+        results_output.close()
+        if not whole:
+            print('The input ended part way through an image, so only the images before it were classified',
+                  file=sys.stderr)
+        sys.exit(0 if whole else 1)
+
+    if arguments.input_dir is None:
+        print('The input_dir is needed, unless --stdin is used')
+        sys.exit(1)
+    if not os.path.isdir(arguments.input_dir) and pack.find_pack(arguments.input_dir) is None:
+        print(f'Input directory or pack not found: {arguments.input_dir}')
+        sys.exit(1)
+    if arguments.shards < 1 or (arguments.shard is not None and (arguments.shards > 1 or arguments.merge)):
+        print('Use --shard to classify one shard, or --shards (with or without --merge) to classify or merge them all')
+        sys.exit(1)
+    if arguments.daemon and (arguments.shard is not None or arguments.shards > 1 or arguments.merge):
+        print('A --daemon classifies each job whole, so it can\'t be used with --shard, --shards or --merge')
+        sys.exit(1)
+
+    if arguments.daemon:
+        job_spool = spool.Spool(arguments.input_dir, arguments.poll_interval, use_inotify=not arguments.poll)
+        try:
+            run(arguments, job_spool=job_spool)
+        except KeyboardInterrupt:
+            print('Stopped watching for jobs')
+        finally:
+            job_spool.close()
+    elif arguments.shard is not None:
+        run(arguments, arguments.shard)
+    elif arguments.shards == 1 and not arguments.merge:
+        run(arguments)
     else:
-        main(sys.argv[1])
+        if not arguments.merge:
+            failed = run_shards(arguments)
+            if len(failed) > 0:
+                print(f'Shards {failed} of {arguments.shards} failed.  Run them again with --shard <index>/'
+                      f'{arguments.shards} (and --resume), then merge them with --shards {arguments.shards} --merge')
+                sys.exit(1)
+        output_folder = arguments.input_dir
+        if pack.find_pack(output_folder) is not None:
+            output_folder = os.path.dirname(os.path.abspath(pack.find_pack(output_folder)))
+        merged = results_log.merge_shards(output_folder, arguments.shards,
+                                          duplicates=arguments.skip_near_duplicates,
+                                          models=predictor.first_model is not None)
+        print(f'Merged {arguments.shards} shards: {merged["classified"]} classified, {merged["error_count"]} errors')
@@ -13,9 +13,10 @@ the results of the classification and add it as metadata to the images.
 This script will first export any selected JPGs to a file specified in this script.  It will
 then run an external Python process to do the classification.  The Python environment and
 application path are provided in this script.  Once the external Python application is started,
-this script will monitor a JSON file for progress and results.  When the Python application
-is finished it will read the results and add them to the appropriate image as custom metadata
-named 'image_classifications_top3'
+this script will monitor its small status JSON file for progress.  At each check it also reads the
+lines added to the JSON Lines results log since the last check, and adds each result to the appropriate
+image as custom metadata named 'image_classifications_top3', so a long run shows its results as they
+are made.  Each check reads on from where the last one stopped, so no part of the log is read twice.
 
 Requirements:
 A Python environment capable of running the image classification.  For this example, the
@@ -40,13 +41,44 @@ environment on the system path.
 Use the python_project_path variable to configure the path to the downloaded reposity.  It should
 point to the top level of the repository - it should have /cli and /img_classifier subfolders of the
 repository this script came in.
+
+Starting the Python application loads TensorFlow and the model, which takes longer than classifying a
+small selection.  To avoid paying for it every time, leave the application running as a daemon with the
+model loaded, watching a spool folder:
+    python cli\predict_from_folder.py C:\Projects\RestData\Spool --daemon
+and set the spool_path variable to the same folder.  The selected images are then exported to a new job
+folder in the spool instead of the working_path, the job is marked ready, and this script waits for the
+daemon to mark it done before reading its results and removing the job's folder and markers.
+
+Exporting each image to its own file is slow for large selections, especially to a network share, since
+most of the time goes to creating the files.  Set use_pack to True to write the selected images into a
+single pack instead (see img_classifier.pack): an images.pack file holding the bytes of every image, and
+an images.pack.idx index with the GUID, offset and length of each.  The classifier reads the pack in
+place of the folder, and names the results by GUID.
+
+Normally every image is exported before the classifier is started.  Set pipeline_export to True to start
+the classifier first (with its --follow option) and classify the images while they are being exported.
+The selection is exported export_chunk_size items at a time, each chunk to its own subfolder.  Once a
+chunk's export is finished the paths of its files are appended to a manifest.txt file the classifier
+reads as it grows, and once every chunk is exported a manifest.end file tells the classifier to stop.
+The results logged while each chunk is exported are added to their items before the next chunk starts.
+
+Set stream_transport to True to skip the disk altogether: the classifier is started with --stdin, each
+selected image is sent straight from the case to its stdin, and each result is read back from its stdout
+and added to the item as soon as it arrives.  Nothing is written to the working_path.
 """
 import json
 import os
 import re
+import shutil
+import struct
 import sys
 import time
+import uuid
 from threading import Thread
+
+from java.io import BufferedOutputStream, FileOutputStream
+import jarray
 from subprocess import Popen, PIPE
 
 # Where the images should be exported to.  Also where the results will be written to.
@@ -63,8 +95,41 @@ python_env_path = r'C:\Projects\Python\Python-On-The-Engine\env'
 
 # Amount of time between polls of the results file when monitoring for progress
 results_poll_time = 3  # in seconds
-# The name of the results file generated during image classification
-results_json_filename = 'inference.json'
+# The name of the status file the image classification keeps its progress in
+status_json_filename = 'status.json'
+# The name of the results log generated during image classification, one JSON object per line
+results_log_filename = 'inference.jsonl'
+
+# The spool folder watched by a predict_from_folder.py daemon.  If this is set, jobs are sent to the daemon rather than
+# starting a new Python process for each run.
+spool_path = None
+# The suffixes of a spool job's markers, next to its folder: one made here when the job is ready, one made by the daemon
+# when the job is done
+ready_marker_suffix = '.ready'
+done_marker_suffix = '.done'
+
+# If this is set to True, the selected images are written into one pack file rather than exported one file each
+use_pack = False
+# The name of the pack's data file.  Its index is the same name with pack_index_suffix added.
+pack_filename = 'images.pack'
+pack_index_suffix = '.idx'
+# The number of bytes copied into the pack at a time
+pack_buffer_size = 1024 * 1024
+
+# The most GUIDs ORed together in one search for the items results belong to
+guid_query_chunk_size = 500
+
+# If this is set to True, the images are sent to the classifier's stdin and its results read from its stdout, rather
+# than exporting the images to the working_path
+stream_transport = False
+
+# If this is set to True, the classifier is started before the export and classifies the images as they are exported
+pipeline_export = False
+# The number of items exported at a time when pipelining, before their files are added to the manifest
+export_chunk_size = 200
+# The manifest of exported files the classifier follows, and the marker made once every file is in it
+manifest_filename = 'manifest.txt'
+manifest_end_filename = 'manifest.end'
 
 # If this is set to True, then stdout from the image classifier will be displayed in Nuix Workstation
 view_img_classifier_output = False
@@ -116,18 +181,19 @@ def get_process_monitor(prediction_process):
     return monitor
 
 
-def execute_scoring(path_to_images):
+def execute_scoring(path_to_images, extra_args=()):
     """
     Start the external Python process for image classification.  This method is asynchronous - the process will be
     started and this method will return immediately.
 
     :param path_to_images:  Full path to the images that need to be classified.
+    :param extra_args: Any other command line arguments to give the classifier, such as '--follow'
     :return: The Process object inside which the Python application is run, incase it is needed for monitoring purposes.
              The stdout is PIPEd so it can be read from the returned Process object.
     """
     python_script = os.path.join(python_project_path, predict_script)
 
-    cmd_args = ['python.exe', python_script, path_to_images]
+    cmd_args = ['python.exe', python_script, path_to_images] + list(extra_args)
 
     predict_process = Popen(cmd_args, stdout=PIPE, universal_newlines=True, shell=True)
 
@@ -137,36 +203,89 @@ def execute_scoring(path_to_images):
     return predict_process
 
 
-def monitor_progress(path_to_results):
+def monitor_progress(path_to_results, done_marker_path=None, results_tail=None, process=None):
     """
-    Use the JSON file created by the classification tool to monitor the progress of the operation.  This does not read
-    the stdout of the process, rather it reads the JSON file and parses it for progress.  This method will block until
-    the JSON file signals the work is done.
-    :param path_to_results: Full path to where the results file will be stored (without the results file name).
+    Use the status file created by the classification tool to monitor the progress of the operation.  This does not
+    read the stdout of the process, rather it reads the small status JSON file and parses it for progress.  The file is
+    replaced as a whole each time it is updated, so it is always complete when read.  This method will block until the
+    status file signals the work is done.
+
+    If a results_tail is provided, the results appended to the log since the last poll are applied to their items at
+    each poll, so the items show their classifications while the rest are still being classified.  Once the work is
+    done the rest of the log is read and every remaining result applied before this method returns.
+    :param path_to_results: Full path to where the status file will be stored (without the status file name).
+    :param done_marker_path: Full path to a spool job's done marker.  If provided, monitoring also stops when it
+                             appears, in case the job failed before its status was marked done.
+    :param results_tail: The ResultsTail following the results log, or None to leave the results to be processed
+                         afterwards.
+    :param process: The classifier's Process, as returned by execute_scoring.  If provided, monitoring also stops when
+                    it exits, in case it failed before its status was marked done.
     :return: Nothing
     """
-    results_file = os.path.join(path_to_results, results_json_filename)
-    while not os.path.exists(results_file):
+    def marked_done():
+        return done_marker_path is not None and os.path.exists(done_marker_path)
+
+    def exited():
+        return process is not None and process.poll() is not None
+
+    def report_exit():
+        print('The classifier exited with code ' + str(process.returncode) + ' before it finished')
+
+    def apply_new_results():
+        if results_tail is not None:
+            results_tail.read_new()
+
+    def finish_results():
+        if results_tail is not None:
+            results_tail.read_new()
+            results_tail.applier.finish()
+            print('Applied ' + str(results_tail.applier.applied) + ' results')
+
+    status_path = os.path.join(path_to_results, status_json_filename)
+    while not os.path.exists(status_path):
+        if marked_done():
+            finish_results()
+            return
+        if exited():
+            # It may have made the status file just before exiting, so look once more
+            if not os.path.exists(status_path):
+                report_exit()
+                finish_results()
+                return
+            break
         # File not made yet, keep trying
         time.sleep(results_poll_time)
 
     done = False
+    status_done = False
+    stopped = False
 
     while not done:
-        with open(results_file, 'r') as status_file:
-            try:
+        # Checked before the status is read, so the status read after the process exits is its last
+        stopped = exited()
+        done = marked_done() or stopped
+        try:
+            with open(status_path, 'r') as status_file:
                 status = json.load(status_file)
 
-                done = status['status']['done']
-                if not done:
-                    print('Progress: ' + str(status['status']['progress']) + '% [' + str(
-                        status['status']['current_item']) +
-                          '/' + str(status['status']['total']) + ']')
-            except ValueError as err:
-                # Don't care, this happens when the file is written at same time as reading, just skip and continue
-                pass
-
-        time.sleep(results_poll_time)
+            status_done = status['done']
+            done = done or status_done
+            if not done:
+                apply_new_results()
+                progress = 'Progress: ' + str(status['progress']) + '% [' + str(status['current_item']) + \
+                           '/' + str(status['total']) + ']'
+                if results_tail is not None:
+                    progress += ', ' + str(results_tail.applier.applied) + ' results applied'
+                print(progress)
+        except (IOError, ValueError):
+            # The file was being replaced as it was opened, just skip and try again
+            pass
+
+        if not done:
+            time.sleep(results_poll_time)
+    if stopped and not status_done:
+        report_exit()
+    finish_results()
     print('Finished prediction')
 
 
@@ -198,17 +317,229 @@ def export_selection(output_dir):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    items_to_export = [item for item in current_selected_items if
-                       item.getCorrectedExtension().lower().endswith('jpg') or
-                       item.getCorrectedExtension().lower().endswith('jpeg')]
+    items_to_export = get_items_to_export()
     exporter = build_exporter(output_dir)
     exporter.exportItems(items_to_export)
     return len(items_to_export)
 
 
-# Images are stored on disk and in the results using the GUID as their name.  This regex parses the GUID
-# out of the name and returns is as Group 1.
-regex_for_GUID = r'^.*\\([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.[jJ][pP][eE]?[gG]$'
+def export_selection_pipelined(output_dir, results_tail=None):
+    """
+    Exports the selected JPEG images to the specified directory a chunk at a time, listing the files of each chunk in
+    the manifest as soon as the chunk is exported, so a classifier following the manifest can work on them while the
+    next chunk is exported.  Each chunk is exported to its own subfolder, so its files can be found without looking
+    through the files of the earlier chunks.  Like the exporter, only one copy of images with the same MD5 is exported.
+    The end marker is created when the export is done, even if it fails, so the classifier doesn't wait for more.
+    :param output_dir: The full path where images should be exported to.
+    :param results_tail: The ResultsTail following the classifier's results log, or None.  If provided, the results
+                         logged while each chunk was exported are applied to their items before the next chunk.
+    :return: The number of items exported.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    items_to_export = get_items_to_export()
+    exported_md5s = set()
+    count = 0
+
+    manifest_file = open(os.path.join(output_dir, manifest_filename), 'a')
+    try:
+        for chunk_index, start in enumerate(range(0, len(items_to_export), export_chunk_size)):
+            chunk = []
+            for item in items_to_export[start:start + export_chunk_size]:
+                md5 = item.getDigests().getMd5()
+                if md5 is None or md5 not in exported_md5s:
+                    chunk.append(item)
+                    if md5 is not None:
+                        exported_md5s.add(md5)
+            if len(chunk) == 0:
+                continue
+
+            chunk_dir = os.path.join(output_dir, 'chunk-%05d' % chunk_index)
+            exporter = build_exporter(chunk_dir)
+            exporter.exportItems(chunk)
+            count += len(chunk)
+
+            # The chunk's files are all finished now, so the classifier can have them
+            for root, dirs, files in os.walk(chunk_dir):
+                for file_name in files:
+                    manifest_file.write(os.path.relpath(os.path.join(root, file_name), output_dir) + '\n')
+            manifest_file.flush()
+
+            if results_tail is not None:
+                results_tail.read_new()
+    finally:
+        manifest_file.close()
+        with open(os.path.join(output_dir, manifest_end_filename), 'w'):
+            pass
+    return count
+
+
+def get_items_to_export():
+    """
+    :return: The selected items with the extension .jpg or .jpeg (case-insensitive)
+    """
+    return [item for item in current_selected_items if
+            item.getCorrectedExtension().lower().endswith('jpg') or
+            item.getCorrectedExtension().lower().endswith('jpeg')]
+
+
+def copy_binary_data(binary_data, buffer, write):
+    """
+    Copy the bytes of an item's binary a buffer at a time.
+    :param binary_data: The item's BinaryData
+    :param buffer: A Java byte array to copy the bytes through
+    :param write: The function to give each buffer of bytes to, as write(buffer, 0, <count of bytes in the buffer>)
+    :return: The number of bytes copied
+    """
+    length = binary_data.getLength()
+    position = 0
+    while position < length:
+        read = binary_data.read(position, buffer, 0, int(min(len(buffer), length - position)))
+        if read <= 0:
+            break
+        write(buffer, 0, read)
+        position += read
+    return position
+
+
+def write_pack(output_dir):
+    """
+    Write the selected JPEG images into a pack in the specified directory, rather than exporting a file for each.  Like
+    the exporter, only one copy of images with the same MD5 is written.  Each image's bytes are written to the data
+    file before its line is added to the index, so the index only ever lists complete images.  If the directory does
+    not exist yet it will be created.
+    :param output_dir: The full path where the pack should be written to.
+    :return: The full path to the pack's data file, and the number of images written to it.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    pack_path = os.path.join(output_dir, pack_filename)
+    buffer = jarray.zeros(pack_buffer_size, 'b')
+    written_md5s = set()
+    offset = 0
+    count = 0
+
+    data_stream = BufferedOutputStream(FileOutputStream(pack_path))
+    index_file = open(pack_path + pack_index_suffix, 'w')
+    try:
+        for item in get_items_to_export():
+            md5 = item.getDigests().getMd5()
+            if md5 is not None and md5 in written_md5s:
+                continue
+
+            binary = item.getBinary()
+            if binary is None:
+                print('No binary to pack for ' + item.getGuid())
+                continue
+            binary_data = binary.getBinaryData()
+            try:
+                position = copy_binary_data(binary_data, buffer, data_stream.write)
+            finally:
+                binary_data.close()
+
+            # The data must reach the file before the index says it is there
+            data_stream.flush()
+            index_file.write('%s\t%d\t%d\n' % (item.getGuid(), offset, position))
+            index_file.flush()
+            offset += position
+            count += 1
+            if md5 is not None:
+                written_md5s.add(md5)
+            print('Packed #' + str(count) + ': ' + item.getName())
+    finally:
+        data_stream.close()
+        index_file.close()
+    return pack_path, count
+
+
+# Images are stored on disk and in the results using the GUID as their name - either the path to the exported file, or
+# just the GUID when they are read from a pack.  This regex parses the GUID out of the name and returns is as Group 1.
+regex_for_GUID = r'^(?:.*[\\/])?([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?:\.\w+)?$'
+
+
+def stream_selection(stream):
+    """
+    Write the selected JPEG images to the classifier's stdin as frames (see img_classifier.framing): the length of the
+    GUID as 2 big-endian bytes, the GUID, the length of the image as 4 big-endian bytes, then the image's bytes.  Like
+    the exporter, only one copy of images with the same MD5 is sent.  The stream is closed once every image is sent,
+    which tells the classifier there are no more.
+    :param stream: The classifier process's stdin
+    :return: Nothing
+    """
+    buffer = jarray.zeros(pack_buffer_size, 'b')
+    sent_md5s = set()
+
+    def write(chunk, offset, count):
+        stream.write(chunk[offset:offset + count].tostring())
+
+    try:
+        for item in get_items_to_export():
+            md5 = item.getDigests().getMd5()
+            if md5 is not None and md5 in sent_md5s:
+                continue
+            binary = item.getBinary()
+            if binary is None:
+                print('No binary to send for ' + item.getGuid())
+                continue
+
+            binary_data = binary.getBinaryData()
+            try:
+                guid = str(item.getGuid())
+                length = binary_data.getLength()
+                stream.write(struct.pack('>H', len(guid)) + guid + struct.pack('>I', length))
+                copied = copy_binary_data(binary_data, buffer, write)
+                if copied < length:
+                    # Keep the stream in step with the lengths already sent - the image will fail to decode
+                    stream.write('\0' * int(length - copied))
+            finally:
+                binary_data.close()
+            if md5 is not None:
+                sent_md5s.add(md5)
+    finally:
+        stream.close()
+
+
+def get_stderr_monitor(prediction_process):
+    def monitor():
+        for line in iter(prediction_process.stderr.readline, ''):
+            if view_img_classifier_output:
+                print(line.rstrip())
+
+    return monitor
+
+
+def stream_scoring(item_map):
+    """
+    Classify the selected images without writing them to disk.  The classifier is started with --stdin, the images are
+    sent to its stdin on a separate thread, and each result is read from its stdout as a line of JSON and applied to
+    its item as soon as it arrives.  The classifier's other output comes on stderr.
+    :param item_map: A dict of the selected items by GUID, as made by build_item_map
+    :return: Nothing
+    """
+    python_script = os.path.join(python_project_path, predict_script)
+    cmd_args = ['python.exe', python_script, '--stdin']
+    predict_process = Popen(cmd_args, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True)
+
+    Thread(target=get_stderr_monitor(predict_process), name='Prediction Monitor').start()
+    Thread(target=stream_selection, args=(predict_process.stdin,), name='Image Sender').start()
+
+    applier = ResultsApplier(item_map)
+    for line in iter(predict_process.stdout.readline, ''):
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        if 'status' in entry:
+            print('Finished prediction: ' + str(entry['status']['classified']) + ' classified, ' +
+                  str(entry['status']['error_count']) + ' errors')
+            if 'error' in entry['status']:
+                print('Prediction stopped early: ' + entry['status']['error'])
+        else:
+            applier.apply(entry)
+            print('Classified #' + str(applier.applied + applier.errors) + ': ' + entry['image'])
+    applier.finish()
+    predict_process.wait()
 
 
 def get_item(item_guid):
@@ -222,7 +553,43 @@ def get_item(item_guid):
     return found.iterator().next()
 
 
-def process_image_metadata(image_data):
+def build_item_map(items):
+    """
+    Map the items that were sent for classification by their GUIDs, so their results can be applied without searching
+    for them.
+    :param items: The items that were exported or packed
+    :return: A dict of each Item by its GUID
+    """
+    return dict((item.getGuid(), item) for item in items)
+
+
+def find_items(item_guids):
+    """
+    Search for the items with the provided GUIDs, several at a time: each search ORs together up to
+    guid_query_chunk_size GUIDs, rather than making one search per GUID.
+    :param item_guids: The GUIDs of the items to find
+    :return: A dict of each found Item by its GUID.  GUIDs with no item are left out.
+    """
+    found_items = {}
+    for start in range(0, len(item_guids), guid_query_chunk_size):
+        query_string = 'guid:(' + ' OR '.join(item_guids[start:start + guid_query_chunk_size]) + ')'
+        for item in current_case.searchUnsorted(query_string):
+            found_items[item.getGuid()] = item
+    return found_items
+
+
+def get_image_guid(image_path):
+    """
+    :param image_path: The name of an image in the results: the path to the exported file, or its GUID
+    :return: The image's GUID, or None if the name doesn't have one
+    """
+    image_guid_match = re.match(regex_for_GUID, image_path)
+    if image_guid_match is None:
+        return None
+    return image_guid_match.group(1)
+
+
+def process_image_metadata(image_data, item_map=None):
     """
     Add the predicted classifications as custom metadata to the corresponding Item.
 
@@ -231,38 +598,180 @@ def process_image_metadata(image_data):
     format: "<classifier1>:<probability1>%;<classifier2>:<probability2>%;<classifier3>:<probability3>%"
 
     :param image_data: The data for a single image.  It should be a tuple:
-                       [0] = the full path to the exported image this data was created for.  The image should have its
-                             GUID for a name - as generated by a BatchExporter with naming='guid'
+                       [0] = the full path to the exported image this data was created for, or the GUID of the image in
+                             a pack.  The image should have its GUID for a name - as generated by a BatchExporter with
+                             naming='guid'
                        [1] = an array-like with the three dicts mapping the classification to its score.
+    :param item_map: A dict of Items by GUID to find the Item in.  If it isn't provided, or doesn't have the Item, the
+                     Item is searched for.
     :return: Nothing
     """
     image_path = image_data[0]
     predictions = image_data[1]
-    image_guid_match = re.match(regex_for_GUID, image_path)
-    if image_guid_match is not None:
-        image_guid = image_guid_match.group(1)
+    image_guid = get_image_guid(image_path)
+    if image_guid is not None:
         prediction_data = ';'.join([list(pred.items())[0][0] + ':' +
                                     str(round(float(list(pred.items())[0][1]) * 100, 2)) + '%'
                                     for pred in predictions]
                                    )
-        item_to_update = get_item(image_guid)
+        item_to_update = None
+        if item_map is not None:
+            item_to_update = item_map.get(image_guid)
+        if item_to_update is None:
+            item_to_update = get_item(image_guid)
         item_custom_metadata = item_to_update.getCustomMetadata()
         item_custom_metadata['image_classifications_top3'] = prediction_data
 
 
-def process_results(results_path):
+class ResultsApplier(object):
     """
-    After the classification is complete, parse the results file and assign each prediction to its corresponding image
-    as custom metadata.
-    :param results_path: The full path (not including the file name) where the results file will be found.
+    Apply each result to its item as soon as it is read, rather than waiting for the classification to finish.
+
+    Items are found in the item_map when they are in it.  The GUIDs of any others are collected and searched for
+    guid_query_chunk_size at a time (see find_items), so applying the results takes a few searches at most rather than
+    one for each image.  Call finish() once every result has been read to apply any that are still waiting for a
+    search.
+    """
+
+    def __init__(self, item_map=None):
+        """
+        :param item_map: A dict of the Items that were sent for classification, by GUID, as made by build_item_map
+        """
+        self.item_map = {} if item_map is None else item_map
+        self.unmapped = {}
+        self.applied = 0
+        self.errors = 0
+
+    def apply(self, image_entry):
+        """
+        Apply one entry of the results log, or report it if the image couldn't be classified.
+        :param image_entry: The entry, as a dict read from its line of JSON
+        :return: Nothing
+        """
+        if 'error' in image_entry:
+            self.errors += 1
+            print('Error classifying ' + image_entry['image'] + ': ' + image_entry['error'])
+            return
+
+        image_data = (image_entry['image'], image_entry['results'])
+        image_guid = get_image_guid(image_data[0])
+        if image_guid is None:
+            return
+        if image_guid in self.item_map:
+            process_image_metadata(image_data, self.item_map)
+            self.applied += 1
+        else:
+            self.unmapped[image_guid] = image_data
+            if len(self.unmapped) >= guid_query_chunk_size:
+                self.apply_unmapped()
+
+    def apply_unmapped(self):
+        """
+        Search for the items of the results that weren't in the item_map, and apply them.
+        :return: Nothing
+        """
+        self.item_map.update(find_items(list(self.unmapped.keys())))
+        for image_guid, image_data in self.unmapped.items():
+            if image_guid in self.item_map:
+                process_image_metadata(image_data, self.item_map)
+                self.applied += 1
+            else:
+                print('No item found for ' + image_data[0])
+        self.unmapped.clear()
+
+    def finish(self):
+        """
+        Apply the results still waiting for their items to be searched for.
+        :return: Nothing
+        """
+        if len(self.unmapped) > 0:
+            self.apply_unmapped()
+
+
+class ResultsTail(object):
+    """
+    Follow the results log as the classifier appends to it.  The position after the last complete line read is
+    remembered, so each read_new() only reads what was written since the one before, and a line that is only partly
+    written is left to be read in full next time.
+    """
+
+    def __init__(self, results_path, applier):
+        """
+        :param results_path: The full path (not including the file name) where the results log will be found
+        :param applier: The ResultsApplier to give each entry to
+        """
+        self.log_path = os.path.join(results_path, results_log_filename)
+        self.applier = applier
+        self.position = 0
+
+    def read_new(self):
+        """
+        Read and apply the entries appended to the log since the last read.
+        :return: The number of entries read
+        """
+        if not os.path.exists(self.log_path):
+            return 0
+
+        count = 0
+        with open(self.log_path, 'rb') as results_file:
+            results_file.seek(self.position)
+            while True:
+                line = results_file.readline()
+                if not line.endswith(b'\n'):
+                    break
+                self.position += len(line)
+                if not line.strip():
+                    continue
+                self.applier.apply(json.loads(line))
+                count += 1
+        return count
+
+
+def process_results(results_path, item_map=None):
+    """
+    After the classification is complete, read the whole results log and assign each prediction to its corresponding
+    image as custom metadata.  Images that could not be classified are reported.  To apply the results while the
+    classification is still running, give monitor_progress a ResultsTail instead.
+    :param results_path: The full path (not including the file name) where the results log will be found.
+    :param item_map: A dict of the Items that were sent for classification, by GUID, as made by build_item_map
     :return: Nothing
     """
-    with open(os.path.join(results_path, results_json_filename), 'r') as results_file:
-        process_results_data = json.load(results_file)
-        prediction_results = process_results_data['results']
+    applier = ResultsApplier(item_map)
+    ResultsTail(results_path, applier).read_new()
+    applier.finish()
+
+
+def submit_job(job_dir):
+    """
+    Mark a job exported to the spool as ready for the daemon to classify.
+    :param job_dir: The full path to the job's folder in the spool
+    :return: The full path to the done marker the daemon will create when the job is done
+    """
+    with open(job_dir + ready_marker_suffix, 'w'):
+        pass
+    return job_dir + done_marker_suffix
+
+
+def read_job_error(done_marker_path):
+    """
+    Read why a spool job failed from its done marker.
+    :param done_marker_path: The full path to the job's done marker
+    :return: The job's error, or None if it succeeded
+    """
+    with open(done_marker_path, 'r') as marker_file:
+        return json.load(marker_file)['error']
 
-        for image_results in prediction_results.items():
-            process_image_metadata(image_results)
+
+def remove_job(job_dir):
+    """
+    Remove a spool job's folder and markers once its results have been read.
+    :param job_dir: The full path to the job's folder in the spool
+    :return: Nothing
+    """
+    shutil.rmtree(job_dir, ignore_errors=True)
+    for marker_suffix in (ready_marker_suffix, done_marker_suffix):
+        if os.path.exists(job_dir + marker_suffix):
+            os.remove(job_dir + marker_suffix)
 
 
 def cleanup(output_dir):
@@ -288,13 +797,63 @@ if __name__ == "__builtin__":
     Console or Script menu in Nuix Workstation.  It will not be run from the command line, or run when this
     script is imported into another script as a module.
     """
-    count_to_export = export_selection(working_path)
-    if count_to_export == 0:
-        # No items to export
-        print('No items to export or analyze.')
+    if spool_path is not None:
+        # Send the selection to the daemon, which already has the model loaded
+        job_path = os.path.join(spool_path, 'job-' + str(uuid.uuid4()))
+        if use_pack:
+            # The daemon reads the pack in the job's folder
+            count_to_export = write_pack(job_path)[1]
+        else:
+            count_to_export = export_selection(job_path)
+        if count_to_export == 0:
+            print('No items to export or analyze.')
+        else:
+            done_marker = submit_job(job_path)
+            # Results the job logged before any failure are still applied
+            monitor_progress(job_path, done_marker,
+                             ResultsTail(job_path, ResultsApplier(build_item_map(get_items_to_export()))))
+            job_error = read_job_error(done_marker)
+            if job_error is not None:
+                print('The classification job failed: ' + job_error)
+        remove_job(job_path)
+    elif stream_transport:
+        if len(get_items_to_export()) == 0:
+            print('No items to analyze.')
+        else:
+            initialize_environment()
+            stream_scoring(build_item_map(get_items_to_export()))
+    elif pipeline_export:
+        if len(get_items_to_export()) == 0:
+            print('No items to export or analyze.')
+        else:
+            # Start the classifier first, so it is loading the model during the first chunk's export
+            initialize_environment()
+            # The classifier needs the folder to exist when it starts, before anything is exported to it
+            if not os.path.exists(working_path):
+                os.makedirs(working_path)
+            predict_process = execute_scoring(working_path, ['--follow'])
+            # Results are applied between the chunks of the export, then as they are logged until the classifier is done
+            results_tail = ResultsTail(working_path, ResultsApplier(build_item_map(get_items_to_export())))
+            export_selection_pipelined(working_path, results_tail)
+            monitor_progress(working_path, results_tail=results_tail, process=predict_process)
+            cleanup(working_path)
     else:
-        initialize_environment()
-        execute_scoring(working_path)
-        monitor_progress(working_path)
-        process_results(working_path)
-        cleanup(working_path)
+        if use_pack:
+            pack_path, count_to_export = write_pack(working_path)
+            images_path = pack_path
+        else:
+            count_to_export = export_selection(working_path)
+            images_path = working_path
+        if count_to_export == 0:
+            # No items to export
+            print('No items to export or analyze.')
+        else:
+            initialize_environment()
+            # The results are written to the working path either way - a pack's results go next to it
+            predict_process = execute_scoring(images_path)
+            # The results belong to the items that were exported, so they are found without searching, and are applied
+            # as they are logged
+            item_map = build_item_map(get_items_to_export())
+            monitor_progress(working_path, results_tail=ResultsTail(working_path, ResultsApplier(item_map)),
+                             process=predict_process)
+            cleanup(working_path)
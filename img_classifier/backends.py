@@ -0,0 +1,215 @@
+"""
+Python Version: 3.9
+
+Summary: Interchangeable inference backends for the image classifier.
+
+Description:
+The predictor does not talk to Keras directly - it hands a batch of preprocessed images to a backend and gets back the
+1000-way ImageNet probabilities for each one.  This lets the same predict() API run on different runtimes:
+
+keras:        The original ResNet50 Keras model with the ImageNet weights.
+onnx:         The same ResNet50 exported to ONNX (see img_classifier.export_onnx) and run with ONNX Runtime.  Optionally
+              an int8 quantized copy of the model can be used, which is considerably faster on CPU-only machines.
+mobilenet_v2: The much smaller Keras MobileNetV2 model with the ImageNet weights.  It is less accurate than ResNet50,
+              so it is mainly used as the first stage of a cascade (see img_classifier.cascade).
+
+The backend is selected with the 'backend' setting in the 'classifier' section of config.json.  All backends take a
+float32 array of shape (batch, 224, 224, 3), preprocessed in the style given by the backend's preprocessing attribute
+(see img_classifier.buffers.preprocess_pixels): 'caffe' for the ResNet50 models, 'tf' for MobileNetV2.
+
+A backend is built with create_backend() and exposes:
+    preprocessing: The style of preprocessing the backend's input needs.
+    predict_on_batch(inputs): Returns the (batch, 1000) array of probabilities for the inputs.
+The Keras backends also expose predict_with_embeddings(inputs), which returns the embeddings from the model's
+penultimate layer along with the probabilities (see img_classifier.store).
+Use backend_id() to find the identity of the configured backend without building it (for example to key a cache).
+"""
+import numpy as np
+
+from img_classifier.config import resolve_path
+
+
+def configure_tensorflow(settings):
+    """
+    Apply the TensorFlow thread settings.  This imports TensorFlow, and has to be done before TensorFlow runs anything
+    in this process.
+    :param settings: The classifier settings.  The 'keras' section provides the number of threads TensorFlow should use
+                     (0 lets it decide).
+    :return: Nothing
+    """
+    import tensorflow as tf
+
+    keras_settings = settings.get('keras', {})
+    intra_op_threads = int(keras_settings.get('intra_op_threads', 0))
+    inter_op_threads = int(keras_settings.get('inter_op_threads', 0))
+    if intra_op_threads > 0 and tf.config.threading.get_intra_op_parallelism_threads() != intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads > 0 and tf.config.threading.get_inter_op_parallelism_threads() != inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+class KerasBackend:
+    """
+    Runs the Keras ResNet50 model.
+    """
+    preprocessing = 'caffe'
+    # Built on first use by predict_with_embeddings()
+    _embedding_model = None
+
+    def __init__(self, settings):
+        """
+        :param settings: The classifier settings.  The 'keras' section provides the number of threads TensorFlow should
+                         use (0 lets it decide).
+        """
+        # TensorFlow is imported here so its cost is only paid when the model is actually needed
+        configure_tensorflow(settings)
+        from tensorflow.keras.applications.resnet50 import ResNet50
+
+        self.model = ResNet50(weights='imagenet')
+
+    @staticmethod
+    def identity(settings):
+        """
+        :param settings: The classifier settings
+        :return: A string identifying the model this backend runs
+        """
+        return 'resnet50-imagenet-keras'
+
+    def predict_on_batch(self, inputs):
+        """
+        :param inputs: The preprocessed batch of images
+        :return: The (batch, 1000) array of class probabilities
+        """
+        return np.asarray(self.model.predict_on_batch(inputs))
+
+    def predict_with_embeddings(self, inputs):
+        """
+        :param inputs: The preprocessed batch of images
+        :return: A tuple: [0] the (batch, 1000) array of class probabilities, [1] the (batch, width) array of embeddings
+                 from the model's penultimate layer (the global average pool feeding the classifier)
+        """
+        if self._embedding_model is None:
+            from tensorflow.keras import Model
+            self._embedding_model = Model(inputs=self.model.input,
+                                          outputs=[self.model.output, self.model.layers[-2].output])
+        probabilities, embeddings = self._embedding_model.predict_on_batch(inputs)
+        return np.asarray(probabilities), np.asarray(embeddings)
+
+
+class MobileNetV2Backend(KerasBackend):
+    """
+    Runs the Keras MobileNetV2 model.
+    """
+    preprocessing = 'tf'
+
+    def __init__(self, settings):
+        """
+        :param settings: The classifier settings.  The 'keras' section provides the number of threads TensorFlow should
+                         use (0 lets it decide).
+        """
+        configure_tensorflow(settings)
+        from tensorflow.keras.applications.mobilenet_v2 import MobileNetV2
+
+        self.model = MobileNetV2(weights='imagenet')
+
+    @staticmethod
+    def identity(settings):
+        """
+        :param settings: The classifier settings
+        :return: A string identifying the model this backend runs
+        """
+        return 'mobilenetv2-imagenet-keras'
+
+
+class OnnxBackend:
+    """
+    Runs an ONNX export of the ResNet50 model, or its int8 quantized copy, with ONNX Runtime on the CPU.
+    """
+    preprocessing = 'caffe'
+
+    def __init__(self, settings):
+        """
+        :param settings: The classifier settings.  The 'onnx' section provides the model paths, whether to use the
+                         quantized model, and the number of threads ONNX Runtime should use (0 lets it decide).
+        """
+        import onnxruntime
+
+        onnx_settings = settings['onnx']
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = int(onnx_settings.get('intra_op_threads', 0))
+        session_options.inter_op_num_threads = int(onnx_settings.get('inter_op_threads', 0))
+
+        self.session = onnxruntime.InferenceSession(resolve_path(OnnxBackend.model_path(settings)),
+                                                    sess_options=session_options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    @staticmethod
+    def model_path(settings):
+        """
+        :param settings: The classifier settings
+        :return: The path to the ONNX model file to run, which depends on if the quantized model is used
+        """
+        onnx_settings = settings['onnx']
+        return onnx_settings['quantized_model_path'] if onnx_settings['quantized'] else onnx_settings['model_path']
+
+    @staticmethod
+    def identity(settings):
+        """
+        :param settings: The classifier settings
+        :return: A string identifying the model this backend runs
+        """
+        return 'resnet50-imagenet-onnx-int8' if settings['onnx']['quantized'] else 'resnet50-imagenet-onnx'
+
+    def predict_on_batch(self, inputs):
+        """
+        :param inputs: The preprocessed batch of images
+        :return: The (batch, 1000) array of class probabilities
+        """
+        return self.session.run(None, {self.input_name: inputs})[0]
+
+
+BACKENDS = {
+    'keras': KerasBackend,
+    'onnx': OnnxBackend,
+    'mobilenet_v2': MobileNetV2Backend
+}
+
+
+def get_backend_type(settings):
+    """
+    Find the backend class named by the settings.
+    :param settings: The classifier settings
+    :return: The backend class
+    """
+    name = settings['backend']
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown classifier backend "{name}".  Expected one of: {", ".join(BACKENDS)}')
+    return BACKENDS[name]
+
+
+def create_backend(settings):
+    """
+    Build the backend named by the settings.
+    :param settings: The classifier settings, as loaded by img_classifier.config.load_config()
+    :return: The built backend, ready to make predictions
+    """
+    return get_backend_type(settings)(settings)
+
+
+def supports_embeddings(settings):
+    """
+    :param settings: The classifier settings
+    :return: True if the backend named by the settings can return embeddings with its probabilities
+    """
+    return hasattr(get_backend_type(settings), 'predict_with_embeddings')
+
+
+def backend_id(settings):
+    """
+    Identify the backend named by the settings without building it.
+    :param settings: The classifier settings, as loaded by img_classifier.config.load_config()
+    :return: A string identifying the model the backend runs
+    """
+    return get_backend_type(settings).identity(settings)
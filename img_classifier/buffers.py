@@ -0,0 +1,106 @@
+"""
+Python Version: 3.9
+
+Summary: Reusable, preallocated input tensors for the predictor's batches.
+
+Description:
+Turning a PIL image into model input the straightforward way allocates several arrays per image: one for the pixels,
+another when it is reshaped into a batch, and another when the ResNet50 preprocessing is applied.  Over millions of
+images that churn shows up in memory use and in time spent allocating and collecting.
+
+A BatchBuffer holds two arrays sized for a whole batch that are reused from batch to batch:
+    pixels: uint8 staging area the images' RGB pixels are copied into
+    inputs: float32 tensor given to the model
+The predictor copies the images into the staging area one at a time (see predictor.stage_batch), then preprocess_pixels
+converts the whole batch into the model input with a single operation, writing the result in place into the input
+tensor.  Two styles of preprocessing are supported, named as Keras names them:
+    caffe: Flip the channels from RGB to BGR and subtract the ImageNet mean, as ResNet50 expects
+    tf:    Scale the pixels to the range -1 to 1, as MobileNetV2 expects
+
+A BufferPool hands out buffers so that concurrent callers (such as the microservice's request threads) never share one.
+"""
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+# Per-channel ImageNet mean, in BGR order, subtracted by ResNet50's preprocessing
+IMAGENET_MEAN_BGR = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+PREPROCESSING_MODES = ('caffe', 'tf')
+
+
+def preprocess_pixels(pixels, out, mode='caffe'):
+    """
+    Convert a batch of RGB uint8 pixels into model input, writing the result into out without allocating any
+    intermediate arrays.
+    :param pixels: A uint8 array of shape (count, rows, columns, 3)
+    :param out: A float32 array the same shape as pixels to write the model input to
+    :param mode: 'caffe' to flip RGB to BGR and subtract the ImageNet mean, or 'tf' to scale the pixels to -1 to 1
+    :return: out
+    """
+    if mode == 'caffe':
+        return np.subtract(pixels[..., ::-1], IMAGENET_MEAN_BGR, out=out)
+    if mode == 'tf':
+        np.multiply(pixels, np.float32(1 / 127.5), out=out)
+        return np.subtract(out, np.float32(1.0), out=out)
+    raise ValueError(f'Unknown preprocessing mode "{mode}".  Expected one of: {", ".join(PREPROCESSING_MODES)}')
+
+
+class BatchBuffer:
+    """
+    A preallocated staging area and model input tensor for one batch of images.
+    """
+
+    def __init__(self, batch_size, image_shape):
+        """
+        :param batch_size: The maximum number of images the buffer can hold
+        :param image_shape: The shape of a single image: (rows, columns, 3)
+        """
+        self.batch_size = batch_size
+        self.pixels = np.empty((batch_size,) + tuple(image_shape), dtype=np.uint8)
+        self.inputs = np.empty((batch_size,) + tuple(image_shape), dtype=np.float32)
+
+
+class BufferPool:
+    """
+    A small pool of BatchBuffers.  Buffers are checked out for the duration of a batch and returned afterwards, so the
+    same few buffers are reused for the life of the process.
+    """
+
+    def __init__(self, image_shape, max_free=2):
+        """
+        :param image_shape: The shape of a single image: (rows, columns, 3)
+        :param max_free: The maximum number of idle buffers to keep for reuse
+        """
+        self._image_shape = tuple(image_shape)
+        self._max_free = max_free
+        self._free = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, batch_size):
+        """
+        Check out a buffer that can hold at least batch_size images.  Use as a context manager; the buffer goes back to
+        the pool when the context exits.
+        :param batch_size: The number of images the buffer needs to hold
+        :return: A BatchBuffer for the exclusive use of the caller
+        """
+        buffer = None
+        with self._lock:
+            for index, free in enumerate(self._free):
+                if free.batch_size >= batch_size:
+                    buffer = self._free.pop(index)
+                    break
+
+        if buffer is None:
+            buffer = BatchBuffer(batch_size, self._image_shape)
+
+        try:
+            yield buffer
+        finally:
+            with self._lock:
+                self._free.append(buffer)
+                if len(self._free) > self._max_free:
+                    # Keep the largest buffers, they can serve any batch size
+                    self._free.sort(key=lambda free: free.batch_size, reverse=True)
+                    del self._free[self._max_free:]
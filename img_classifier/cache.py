@@ -0,0 +1,186 @@
+"""
+Python Version: 3.9
+
+Summary: A persistent, content addressed cache of predictions.
+
+Description:
+Cases tend to hold many copies of the same image - email attachments, signatures, logos - and there is no need to run
+the model on each copy.  The PredictionCache stores the results for an image keyed by a hash of the image file's bytes
+plus the identity of the model that made the prediction, so the cache is consulted before an image is even decoded and
+results made by one model are never returned for another.
+
+The cache is kept in a local SQLite database in WAL mode, so it survives between runs and can be shared by several
+processes at once, such as the shards of a run or a daemon and the microservice.  Each write is committed on its own, so
+no process holds the database's write lock while it classifies images, and a process that finds the database locked
+waits up to BUSY_TIMEOUT seconds for it.  A read or write that still fails is counted as an error and otherwise
+ignored - the image is classified as though it wasn't cached, so the cache can never fail a run.  It is bounded to a
+maximum number of entries - when it grows past that the least recently used entries are evicted.
+
+The cache is used in two steps, which lets the lookup happen on the image loading threads while results are recorded by
+whoever consumes the predictions:
+    result = cache.lookup(key, image_bytes)  # returns the cached result, or None and remembers the image's hash
+    ...
+    cache.record(key, result)  # stores the result made for the image's hash
+or, when the image's result shouldn't be stored (such as a result inherited from a near-duplicate):
+    cache.forget(key)  # discards the image's remembered hash
+
+Hit, miss and error counts are kept for reporting with stats().
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.img_classifier', 'predictions.sqlite')
+DEFAULT_MAX_ENTRIES = 1000000
+BUSY_TIMEOUT = 5.0  # seconds to wait for another process to release the database
+EVICTION_FRACTION = 0.1  # fraction of max_entries removed when the cache overflows
+
+
+def digest(image_bytes):
+    """
+    Hash the content of an image file.
+    :param image_bytes: The bytes of the image file
+    :return: The hex digest of the content
+    """
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class PredictionCache:
+    """
+    A size bounded, least recently used cache of predictions stored in SQLite.  It is safe to use from multiple threads.
+    """
+
+    def __init__(self, path, model_id, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param path: Full path to the SQLite database file.  It, and its folder, will be created if needed.
+        :param model_id: Identifies the model (and settings) making the predictions.  Only results made with the same
+                         model_id are returned from the cache.
+        :param max_entries: The maximum number of results to keep.
+        """
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.path = path
+        self.model_id = model_id
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+        self._lock = threading.Lock()
+        self._pending = {}
+
+        # Autocommit (isolation_level=None): each statement is its own short transaction
+        self._connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS predictions ('
+                                 'key TEXT PRIMARY KEY, result TEXT NOT NULL, last_used REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self._entries = self._connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    def _key(self, content_digest):
+        return f'{self.model_id}:{content_digest}'
+
+    def lookup(self, key, image_bytes):
+        """
+        Find the cached result for an image.  If it isn't cached, the image's hash is remembered so the result can be
+        stored with record() once it has been made.
+        :param key: The key identifying the image in this run, such as its path or GUID
+        :param image_bytes: The bytes of the image file
+        :return: The cached result for the image, or None if there isn't one
+        """
+        content_digest = digest(image_bytes)
+        cache_key = self._key(content_digest)
+
+        with self._lock:
+            try:
+                row = self._connection.execute('SELECT result FROM predictions WHERE key = ?',
+                                               (cache_key,)).fetchone()
+            except sqlite3.Error as e:
+                self._failed('look up', e)
+                row = None
+            if row is None:
+                self.misses += 1
+                self._pending[key] = content_digest
+                return None
+
+            self.hits += 1
+            try:
+                self._connection.execute('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                         (time.time(), cache_key))
+            except sqlite3.Error as e:
+                # The result is still good, it just might be evicted a little sooner
+                self._failed('mark as used', e)
+
+        return tuple((label, score) for label, score in json.loads(row[0]))
+
+    def record(self, key, result):
+        """
+        Store the result made for an image that was looked up and missed.  Errors are not stored, and images that were
+        not looked up are ignored.
+        :param key: The key identifying the image, as given to lookup()
+        :param result: The image's prediction: a tuple of (<label>, <score>) tuples
+        :return: Nothing
+        """
+        with self._lock:
+            content_digest = self._pending.pop(key, None)
+            if content_digest is None or 'ERROR' == result[0]:
+                return
+
+            cache_key = self._key(content_digest)
+            value = json.dumps([[label, float(score)] for label, score in result])
+            try:
+                # Copies of the same image that missed together are all recorded, but only the first adds an entry
+                exists = self._connection.execute('SELECT 1 FROM predictions WHERE key = ?',
+                                                  (cache_key,)).fetchone() is not None
+                self._connection.execute(
+                    'INSERT INTO predictions (key, result, last_used) VALUES (?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET result = excluded.result, last_used = excluded.last_used',
+                    (cache_key, value, time.time())
+                )
+                if not exists:
+                    self._entries += 1
+                if self._entries > self.max_entries:
+                    self._evict()
+            except sqlite3.Error as e:
+                self._failed('record', e)
+
+    def forget(self, key):
+        """
+        Discard the hash remembered for an image that was looked up and missed, without storing a result for it.
+        :param key: The key identifying the image, as given to lookup()
+        :return: Nothing
+        """
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _failed(self, action, error):
+        # Another process held the database for longer than BUSY_TIMEOUT, or it couldn't be read - carry on without it
+        self.errors += 1
+        print(f'Could not {action} in the prediction cache {self.path}: {error}')
+
+    def _evict(self):
+        # Remove the least recently used entries, taking a chunk off at a time so this doesn't run on every insert
+        excess = self._entries - self.max_entries + max(1, int(self.max_entries * EVICTION_FRACTION))
+        self._connection.execute('DELETE FROM predictions WHERE key IN '
+                                 '(SELECT key FROM predictions ORDER BY last_used LIMIT ?)', (excess,))
+        self._entries = self._connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    def stats(self):
+        """
+        :return: A dict with the number of cache hits, misses, errors, and entries in the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors, 'entries': self._entries}
+
+    def close(self):
+        """
+        Close the database.  Every write has already been committed.
+        :return: Nothing
+        """
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,95 @@
+"""
+Python Version: 3.9
+
+Summary: A confidence gated cascade of models - a cheap model first, and ResNet50 only when it is needed.
+
+Description:
+Most images in a case are easy: screenshots, logos, scanned pages.  A small model such as MobileNetV2 classifies them
+just as well as ResNet50 for a fraction of the compute.  In a cascade every image is first run through the small model.
+Images whose top-1 confidence from the small model is below the threshold are escalated: they are run through the main
+model (the backend chosen by the 'backend' setting), and its answer replaces the small model's.
+
+The cascade is set up in the 'cascade' section of the classifier settings:
+    enabled:   Turn the cascade on
+    backend:   The backend to run first, from img_classifier.backends - 'mobilenet_v2' by default
+    threshold: The top-1 probability the first model needs for its answer to be kept, from 0 to 1
+
+The images are only staged once: each model's preprocessing is applied to the same uint8 pixels, so the two models can
+expect different preprocessing styles.  The predictor records which model answered for each image (see
+predictor.Prediction), and the identity of the whole cascade, including the threshold, is part of the model id used to
+key the prediction cache.
+"""
+import copy
+
+import numpy as np
+
+from img_classifier import backends
+from img_classifier.buffers import preprocess_pixels
+from img_classifier.metrics import timed
+
+
+def is_enabled(settings):
+    """
+    :param settings: The classifier settings
+    :return: True if the settings turn the cascade on
+    """
+    return bool(settings['cascade']['enabled'])
+
+
+def first_settings(settings):
+    """
+    Make the settings used to build the cascade's first model.
+    :param settings: The classifier settings
+    :return: A copy of the settings with the 'backend' set to the cascade's first backend
+    """
+    first = copy.deepcopy(settings)
+    first['backend'] = settings['cascade']['backend']
+    return first
+
+
+def cascade_id(settings):
+    """
+    Identify the models the settings run, including the cascade if it is on, without building them.
+    :param settings: The classifier settings
+    :return: A string identifying the model(s) and threshold
+    """
+    main_id = backends.backend_id(settings)
+    if not is_enabled(settings):
+        return main_id
+    return f'cascade-{backends.backend_id(first_settings(settings))}-' \
+           f'{float(settings["cascade"]["threshold"]):g}-{main_id}'
+
+
+def classify(pixels, inputs, backend, first_backend=None, threshold=0.0, metrics=None):
+    """
+    Preprocess and run a batch of staged pixels through the model, or through the cascade if a first model is given.
+    :param pixels: A uint8 array of shape (count, rows, columns, 3) of RGB pixels
+    :param inputs: A float32 array with room for at least count images to preprocess the pixels into
+    :param backend: The main backend
+    :param first_backend: The cascade's first backend, or None to run only the main backend
+    :param threshold: The top-1 probability the first backend needs for its answer to be kept
+    :param metrics: An optional StageMetrics to record the preprocess and inference times in
+    :return: A tuple: [0] the (count, classes) array of probabilities, [1] a boolean array which is True for the images
+             the main backend answered, or None if there was no first backend
+    """
+    count = len(pixels)
+    if first_backend is None:
+        with timed(metrics, 'preprocess', count):
+            batch_inputs = preprocess_pixels(pixels, inputs[:count], backend.preprocessing)
+        with timed(metrics, 'inference', count):
+            return np.asarray(backend.predict_on_batch(batch_inputs)), None
+
+    with timed(metrics, 'preprocess', count):
+        batch_inputs = preprocess_pixels(pixels, inputs[:count], first_backend.preprocessing)
+    with timed(metrics, 'inference', count):
+        probabilities = np.array(first_backend.predict_on_batch(batch_inputs), dtype=np.float32)
+
+    escalated = probabilities.max(axis=1) < threshold
+    escalated_count = int(np.count_nonzero(escalated))
+    if escalated_count > 0:
+        with timed(metrics, 'preprocess', escalated_count):
+            batch_inputs = preprocess_pixels(pixels[escalated], inputs[:escalated_count], backend.preprocessing)
+        with timed(metrics, 'inference', escalated_count):
+            probabilities[escalated] = backend.predict_on_batch(batch_inputs)
+
+    return probabilities, escalated
@@ -0,0 +1,97 @@
+"""
+Python Version: 3.9
+
+Summary: Reads the image classifier's settings from the repository's config.json file.
+
+Description:
+The classifier's settings live in the 'classifier' section of the config.json file at the top of the repository,
+alongside the settings for the other examples.  Any setting that is missing from the file falls back to the default
+defined here, so the file only needs to hold the settings that are changed.
+
+The file is found relative to this package rather than the working directory, since the classifier is run from
+wherever Workstation or Flask happen to start it.  Set the CLASSIFIER_CONFIG environment variable to the full path of a
+different JSON file to use it instead.
+"""
+import copy
+import json
+import os
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json')
+
+DEFAULTS = {
+    'top_k': 3,
+    'backend': 'keras',
+    'keras': {
+        'intra_op_threads': 0,
+        'inter_op_threads': 0
+    },
+    'onnx': {
+        'model_path': 'models/resnet50.onnx',
+        'quantized_model_path': 'models/resnet50.int8.onnx',
+        'quantized': False,
+        'intra_op_threads': 0,
+        'inter_op_threads': 0
+    },
+    'cascade': {
+        'enabled': False,
+        'backend': 'mobilenet_v2',
+        'threshold': 0.5
+    },
+    'decoder': {
+        'draft': True,
+        'orientation': True,
+        'exif_thumbnail': False
+    },
+    'dedupe': {
+        'enabled': False,
+        'max_distance': 4,
+        'hash_size': 8
+    },
+    'pool': {
+        'processes': 0,
+        'intra_op_threads': 1,
+        'inter_op_threads': 1,
+        'pin_cpus': False
+    }
+}
+
+
+def merge(defaults, overrides):
+    """
+    Recursively merge a dictionary of settings over the defaults.
+    :param defaults: The default settings
+    :param overrides: The settings to apply over the defaults
+    :return: A new dictionary with the merged settings
+    """
+    merged = copy.deepcopy(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def resolve_path(path):
+    """
+    Resolve a path from the settings.  Relative paths are relative to the top of the repository.
+    :param path: The path from the settings
+    :return: The absolute path
+    """
+    return path if os.path.isabs(path) else os.path.join(os.path.dirname(CONFIG_PATH), path)
+
+
+def load_config(path=None):
+    """
+    Load the classifier's settings.
+    :param path: Full path to the JSON file to read.  Defaults to the CLASSIFIER_CONFIG environment variable if set,
+                 else the repository's config.json.
+    :return: A dictionary of the classifier settings, with defaults filled in for anything not in the file
+    """
+    path = path or os.environ.get('CLASSIFIER_CONFIG', CONFIG_PATH)
+    if not os.path.exists(path):
+        return copy.deepcopy(DEFAULTS)
+
+    with open(path) as config_file:
+        classifier_config = json.load(config_file).get('classifier', {})
+    return merge(DEFAULTS, classifier_config)
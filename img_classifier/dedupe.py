@@ -0,0 +1,311 @@
+"""
+Python Version: 3.9
+
+Summary: Skip inference on near-duplicate images by reusing the result of a similar image.
+
+Description:
+The PredictionCache catches images whose bytes are identical, but cases also hold large numbers of copies that have been
+re-encoded, resized or lightly cropped along the way - the bytes differ but the picture is the same.  This module finds
+those near-duplicates with a perceptual hash and only runs the model on one representative image from each group.
+
+Each image's dHash is computed: the image is shrunk to a tiny greyscale thumbnail (9x8 for the default 64 bit hash) and
+each bit records whether a pixel is brighter than its neighbour to the right.  The hash depends on the structure of the
+picture rather than its exact pixels, so re-encoding, resizing and small crops or colour changes only flip a few bits.
+Two images are near-duplicates if their hashes differ in at most max_distance bits (their Hamming distance).
+
+The hashes of the representative images are kept in a BK-tree, which finds every hash within a distance of a new hash
+without comparing it to all of them.  The first image of a group to arrive becomes its representative and goes on to the
+model.  Later members of the group inherit the representative's result instead.
+
+Use predict_iter() from this module in place of the predictor's.  It takes the same image source and arguments, and
+yields (<key>, <result>, <representative key>) - the representative key is None for images the model ran on, or the key
+of the image whose result was inherited.  Results are yielded in the same order the images were provided.
+
+The results of the representative images are kept in the index, so an index can be reused across calls and a
+near-duplicate that arrives long after its representative - even in a later call - can still inherit its result.  A
+representative the model failed on has no result to give, so its near-duplicates are classified themselves, each
+becoming the representative of a new group, and later images aren't matched to it.
+"""
+from collections import deque
+
+import numpy as np
+from PIL import Image
+
+from img_classifier import predictor
+from img_classifier.metrics import timed
+
+DEFAULT_HASH_SIZE = 8  # the hash has hash_size * hash_size bits
+DEFAULT_MAX_DISTANCE = 4  # bits that may differ between near-duplicates
+
+
+def dhash(img_pixels, hash_size=DEFAULT_HASH_SIZE):
+    """
+    Compute the difference hash of an image.
+    :param img_pixels: A PIL image
+    :param hash_size: The hash has hash_size * hash_size bits
+    :return: The hash, as an int
+    """
+    thumbnail = img_pixels.convert('L').resize((hash_size + 1, hash_size), Image.BOX)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(first_hash, second_hash):
+    """
+    :param first_hash: A hash, as an int
+    :param second_hash: Another hash, as an int
+    :return: The number of bits that differ between the hashes
+    """
+    return bin(first_hash ^ second_hash).count('1')
+
+
+class BKTree:
+    """
+    A Burkhard-Keller tree of hashes, for finding all the hashes within a Hamming distance of another.  Each node's
+    children are keyed by their distance from the node, so by the triangle inequality a search only needs to visit the
+    children whose distance is within max_distance of the searched hash's distance to the node.
+    """
+
+    def __init__(self):
+        # Each node is a list of [<hash>, <value>, {<distance>: <child node>}]
+        self._root = None
+        self.size = 0
+
+    def add(self, item_hash, value):
+        """
+        Add a hash to the tree.
+        :param item_hash: The hash, as an int
+        :param value: The value to return when the hash is found
+        :return: Nothing
+        """
+        node = [item_hash, value, {}]
+        self.size += 1
+        if self._root is None:
+            self._root = node
+            return
+
+        current = self._root
+        while True:
+            distance = hamming_distance(current[0], item_hash)
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, item_hash, max_distance):
+        """
+        Find the hashes in the tree within a distance of a hash.
+        :param item_hash: The hash to search for, as an int
+        :param max_distance: The largest distance to match
+        :return: A list of (<distance>, <value>) tuples for the matching hashes, in no particular order
+        """
+        matches = []
+        if self._root is None:
+            return matches
+
+        nodes = [self._root]
+        while len(nodes) > 0:
+            node_hash, value, children = nodes.pop()
+            distance = hamming_distance(node_hash, item_hash)
+            if distance <= max_distance:
+                matches.append((distance, value))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return matches
+
+
+class NearDuplicateIndex:
+    """
+    Groups images into near-duplicates, remembering the representative image of each group and, once it is known, the
+    representative's result.  Groups are numbered in the order they are made, so images from different calls with the
+    same key don't share a group by accident.
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, hash_size=DEFAULT_HASH_SIZE):
+        """
+        :param max_distance: The largest Hamming distance between the hashes of images in the same group
+        :param hash_size: The hash has hash_size * hash_size bits
+        """
+        self.max_distance = max(0, int(max_distance))
+        self.hash_size = int(hash_size)
+        self._tree = BKTree()
+        # For each group: [<key of the representative>, <representative's result, or None until it is known>]
+        self._groups = []
+
+    def hash(self, img_pixels):
+        """
+        :param img_pixels: A PIL image
+        :return: The image's hash, as the index computes it
+        """
+        return dhash(img_pixels, self.hash_size)
+
+    def find(self, image_hash):
+        """
+        Find the group an image belongs to.  Groups whose representative failed are passed over.
+        :param image_hash: The image's hash, from hash()
+        :return: The number of the group with the closest representative, or None if there isn't one close enough
+        """
+        matches = [(distance, group) for distance, group in self._tree.search(image_hash, self.max_distance)
+                   if not self.failed(group)]
+        if len(matches) == 0:
+            return None
+        return min(matches)[1]
+
+    def add(self, image_hash, key):
+        """
+        Make an image the representative of a new group.
+        :param image_hash: The image's hash, from hash()
+        :param key: The key identifying the image
+        :return: The number of the new group
+        """
+        group = len(self._groups)
+        self._groups.append([key, None])
+        self._tree.add(image_hash, group)
+        return group
+
+    def find_or_add(self, key, img_pixels):
+        """
+        Find the group an image belongs to, or make the image the representative of a new group.
+        :param key: The key identifying the image
+        :param img_pixels: The PIL image
+        :return: A tuple: [0] the number of the image's group, [1] True if the image is the group's new representative
+        """
+        image_hash = self.hash(img_pixels)
+        group = self.find(image_hash)
+        if group is not None:
+            return group, False
+        return self.add(image_hash, key), True
+
+    def representative(self, group):
+        """
+        :param group: The number of a group
+        :return: The key of the group's representative image
+        """
+        return self._groups[group][0]
+
+    def result(self, group):
+        """
+        :param group: The number of a group
+        :return: The result of the group's representative, or None if it isn't known yet
+        """
+        return self._groups[group][1]
+
+    def set_result(self, group, result):
+        """
+        Remember the result of a group's representative, for the rest of the group to inherit.
+        :param group: The number of a group
+        :param result: The representative's result
+        :return: Nothing
+        """
+        self._groups[group][1] = result
+
+    def failed(self, group):
+        """
+        :param group: The number of a group
+        :return: True if the model failed on the group's representative, so its result can't be inherited
+        """
+        result = self._groups[group][1]
+        return result is not None and 'ERROR' == result[0]
+
+    @property
+    def groups(self):
+        """
+        :return: The number of groups, which is the number of images the model needed to run on
+        """
+        return len(self._groups)
+
+
+def predict_iter(get_images, index=None, **predict_arguments):
+    """
+    Make predictions on a sequence of images, running the model only on one representative of each group of
+    near-duplicates.  The rest of the group inherit the representative's result, unless the model failed on it.
+
+    :param get_images: The image source, as described by predictor.predict_iter()
+    :param index: The NearDuplicateIndex to group the images with.  Reuse the same index across calls to find
+                  near-duplicates of images from earlier calls.  Defaults to a new index with the default distance.
+    :param predict_arguments: Any other arguments for predictor.predict_iter(), such as batch_size or pool.  If metrics
+                              are given, the time spent hashing images is recorded as the 'hash' stage.
+    :return: Yields tuples of (<key>, <result>, <representative key>) in the same order the images were provided.  The
+             representative key is None if the model ran on the image, otherwise it is the key of the image whose result
+             was inherited.
+    """
+    index = index or NearDuplicateIndex()
+    metrics = predict_arguments.get('metrics')
+
+    # Every image in input order, as [<key>, <group>, <image>, <hash>], until its result is yielded.  The group is None
+    # for images sent to the model.  A near-duplicate keeps its image and hash until its representative's result is
+    # known, in case the representative fails and the image has to be classified itself.
+    pending = deque()
+    # Results from the model that haven't been yielded yet, and the groups of the images sent to the model
+    finished = {}
+    new_groups = {}
+    # Near-duplicates of failed representatives, waiting to be sent to the model
+    retry = deque()
+
+    def unique_images():
+        for position, item in enumerate(get_images()):
+            while len(retry) > 0:
+                yield retry.popleft()
+
+            key, img_pixels = item if isinstance(item, tuple) else (position, item)
+            if isinstance(img_pixels, Image.Image):
+                with timed(metrics, 'hash'):
+                    image_hash = index.hash(img_pixels)
+                    group = index.find(image_hash)
+                if group is not None:
+                    if index.result(group) is not None:
+                        pending.append([key, group, None, None])
+                    else:
+                        pending.append([key, group, img_pixels, image_hash])
+                    continue
+                new_groups[key] = index.add(image_hash, key)
+
+            pending.append([key, None, None, None])
+            yield key, img_pixels
+
+    def retried_images():
+        while len(retry) > 0:
+            yield retry.popleft()
+
+    def ready_results():
+        # Yield the pending images in order, up to the first one whose result isn't known yet.  A near-duplicate always
+        # comes after its representative, so the representative's result is known by the time it is reached.
+        while len(pending) > 0:
+            key, group, img_pixels, image_hash = pending[0]
+            if group is None:
+                if key not in finished:
+                    return
+                result = finished.pop(key)
+                representative = None
+            elif index.result(group) is None or index.failed(group):
+                # Nothing to inherit (the representative failed, or was left unfinished by an earlier call that was
+                # stopped), so the image is classified itself and represents a group of its own
+                new_groups[key] = index.add(image_hash, key)
+                pending[0] = [key, None, None, None]
+                retry.append((key, img_pixels))
+                return
+            else:
+                result = index.result(group)
+                representative = index.representative(group)
+            pending.popleft()
+            yield key, result, representative
+
+    def record(key, result):
+        finished[key] = result
+        if key in new_groups:
+            index.set_result(new_groups.pop(key), result)
+
+    for key, result in predictor.predict_iter(unique_images, **predict_arguments):
+        record(key, result)
+        yield from ready_results()
+    yield from ready_results()
+
+    # Near-duplicates of representatives that failed at the end of the images, after the last of them was sent
+    while len(retry) > 0:
+        for key, result in predictor.predict_iter(retried_images, **predict_arguments):
+            record(key, result)
+            yield from ready_results()
+        yield from ready_results()
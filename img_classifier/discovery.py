@@ -0,0 +1,230 @@
+"""
+Python Version: 3.9
+
+Summary: Find the image files in a folder tree as they are needed, identifying images by their content.
+
+Description:
+Walking a whole export into a list before classifying it delays the first result, and the list grows with the tree.
+FileDiscovery walks the folder tree with os.scandir as the files are asked for, holding only one open directory
+listing per level of the tree, so the memory it uses doesn't depend on the number of files.  It counts the files found
+so far, so progress can be reported against a running total while the walk is still going.
+
+Files are not chosen by their extension, since exported files are often renamed.  Instead read_image_file() looks at
+the first few bytes of each file (its magic number) and only accepts the image formats asked for - JPEG by default, and
+optionally PNG and TIFF.  The check is made on the same read that loads the file, so it costs no extra I/O, and only
+those first bytes are read from files that aren't images.
+
+A folder can also be split into shards, so several processes (or machines sharing the folder) can each classify part
+of it.  Each file belongs to one shard, chosen by a hash (BLAKE2b) of its path relative to the top of the folder tree,
+so every process walking the tree agrees on the split without talking to the others, wherever the folder is mounted.
+A CRC would be cheaper, but it is linear, so paths that differ in only a character or two - as exported file names do -
+can all fall into a few of the shards.
+Files in other shards are passed over, and not counted.
+
+When the files are still being exported, a ManifestFollower provides them as the exporter finishes them, so
+classification can run alongside the export.  The exporter appends the path of each finished file (relative to the
+folder) to manifest.txt, one per line, and creates manifest.end once every file is listed.  The follower reads the
+manifest as it grows, only taking complete lines, and stops once it has read everything listed before manifest.end
+appeared.  A listed file that can't be seen yet (as can happen for a while on a network share) is checked again a few
+times before it is passed on anyway, to fail when it is read.  If the manifest stops growing for idle_timeout seconds
+without being ended, the exporter is assumed to have failed and the follower stops.
+"""
+import hashlib
+import os
+import time
+
+# The magic numbers each format's files start with
+FORMAT_SIGNATURES = {
+    'jpeg': (b'\xff\xd8\xff',),
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'tiff': (b'II*\x00', b'MM\x00*')
+}
+IMAGE_FORMATS = tuple(FORMAT_SIGNATURES)
+DEFAULT_FORMATS = ('jpeg',)
+SNIFF_BYTES = max(len(signature) for signatures in FORMAT_SIGNATURES.values() for signature in signatures)
+
+MANIFEST_FILENAME = 'manifest.txt'
+MANIFEST_END_FILENAME = 'manifest.end'
+DEFAULT_FOLLOW_POLL_INTERVAL = 0.5  # seconds
+DEFAULT_FOLLOW_TIMEOUT = 600.0  # seconds
+FOLLOW_RETRIES = 5
+
+
+class NotAnImage(ValueError):
+    """
+    Raised when a file's content is not one of the accepted image formats.
+    """
+    pass
+
+
+def sniff(header, formats=DEFAULT_FORMATS):
+    """
+    Identify a file's format from its first bytes.
+    :param header: At least the first SNIFF_BYTES bytes of the file (or the whole file, if it is shorter)
+    :param formats: The names of the formats to accept, from IMAGE_FORMATS
+    :return: The name of the file's format, or None if it isn't one of the accepted formats
+    """
+    for image_format in formats:
+        if header.startswith(FORMAT_SIGNATURES[image_format]):
+            return image_format
+    return None
+
+
+def read_image_file(path, formats=DEFAULT_FORMATS):
+    """
+    Read an image file, if its content is one of the accepted formats.
+    :param path: Full path to the file
+    :param formats: The names of the formats to accept, from IMAGE_FORMATS
+    :return: The bytes of the file.  Raises NotAnImage, having read only the first few bytes, if the file's content
+             isn't one of the accepted formats.
+    """
+    with open(path, mode='rb') as image_file:
+        header = image_file.read(SNIFF_BYTES)
+        if sniff(header, formats) is None:
+            raise NotAnImage(f'{path} is not a {"/".join(formats)} image')
+        return header + image_file.read()
+
+
+def shard_of(relative_path, count):
+    """
+    :param relative_path: A file's path relative to the top of the folder tree
+    :param count: The number of shards
+    :return: The index of the shard the file belongs to, from 0 to count - 1
+    """
+    normalized = relative_path.replace(os.sep, '/').encode('utf-8', errors='surrogateescape')
+    return int.from_bytes(hashlib.blake2b(normalized, digest_size=8).digest(), 'big') % count
+
+
+class FileDiscovery:
+    """
+    An iterable of the full paths of the files in a folder tree, found as they are needed.  It can only be iterated
+    once.
+    """
+
+    def __init__(self, folder, exclude=(), shard=None):
+        """
+        :param folder: The top of the folder tree
+        :param exclude: File names to leave out wherever they are found, such as the application's own output files
+        :param shard: The (index, count) of the shard to find the files of, or None to find them all
+        """
+        self.folder = folder
+        self.exclude = frozenset(exclude)
+        self.shard = shard
+        self.found = 0
+        self.finished = False
+
+    def __iter__(self):
+        # Depth first, keeping only the open listing of each folder between here and the top
+        listings = [os.scandir(self.folder)]
+        try:
+            while len(listings) > 0:
+                entry = next(listings[-1], None)
+                if entry is None:
+                    listings.pop().close()
+                    continue
+
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        listings.append(os.scandir(entry.path))
+                        continue
+                    if not entry.is_file() or entry.name in self.exclude:
+                        continue
+                except OSError as e:
+                    # A folder or file that can't be read shouldn't stop the rest of the tree being found
+                    print(f'Skipping {entry.path}: {e}')
+                    continue
+
+                if self.shard is not None and \
+                        shard_of(os.path.relpath(entry.path, self.folder), self.shard[1]) != self.shard[0]:
+                    continue
+
+                self.found += 1
+                yield entry.path
+        finally:
+            for listing in listings:
+                listing.close()
+        self.finished = True
+
+
+class ManifestFollower:
+    """
+    An iterable of the full paths of the files listed in a folder's manifest, found as they are listed, as described
+    above.  It can only be iterated once.
+    """
+
+    def __init__(self, folder, shard=None, poll_interval=DEFAULT_FOLLOW_POLL_INTERVAL,
+                 idle_timeout=DEFAULT_FOLLOW_TIMEOUT):
+        """
+        :param folder: The folder the files are exported to, holding the manifest
+        :param shard: The (index, count) of the shard to find the files of, or None to find them all
+        :param poll_interval: The seconds to wait between looks at the manifest when there is nothing new in it
+        :param idle_timeout: The seconds to wait for the manifest to grow before giving up on it, or 0 to wait forever
+        """
+        self.folder = folder
+        self.shard = shard
+        self.poll_interval = max(0.01, float(poll_interval))
+        self.idle_timeout = max(0.0, float(idle_timeout))
+        self.manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+        self.end_path = os.path.join(folder, MANIFEST_END_FILENAME)
+        self.found = 0
+        self.finished = False
+
+    def _wait(self, idle_since):
+        """
+        Wait a while for the manifest to change.
+        :param idle_since: When something last happened, from time.monotonic()
+        :return: False if the manifest has been idle for longer than the idle timeout, otherwise True
+        """
+        if 0 < self.idle_timeout < time.monotonic() - idle_since:
+            print(f'{self.manifest_path} was not ended within {self.idle_timeout} seconds of its last change')
+            return False
+        time.sleep(self.poll_interval)
+        return True
+
+    def _visible(self, path):
+        """
+        Wait briefly for a listed file to be seen.
+        :param path: The full path to the file
+        :return: Nothing.  The file may still not exist, in which case the error is reported when it is read.
+        """
+        for attempt in range(FOLLOW_RETRIES):
+            if os.path.exists(path):
+                return
+            time.sleep(self.poll_interval)
+
+    def __iter__(self):
+        idle_since = time.monotonic()
+        while not os.path.exists(self.manifest_path):
+            if os.path.exists(self.end_path) or not self._wait(idle_since):
+                self.finished = True
+                return
+
+        with open(self.manifest_path, mode='rb') as manifest:
+            ended = False
+            while True:
+                position = manifest.tell()
+                line = manifest.readline()
+                if line.endswith(b'\n'):
+                    idle_since = time.monotonic()
+                    relative_path = line.decode('utf-8').strip()
+                    if not relative_path:
+                        continue
+                    if self.shard is not None and shard_of(relative_path, self.shard[1]) != self.shard[0]:
+                        continue
+                    path = os.path.join(self.folder, relative_path)
+                    self._visible(path)
+                    self.found += 1
+                    yield path
+                    continue
+
+                # Only a part of the next line has been written, so read it again once it is finished
+                manifest.seek(position)
+                if ended:
+                    break
+                if os.path.exists(self.end_path):
+                    # Everything was listed before the end marker was made - read to the end once more
+                    ended = True
+                    continue
+                if not self._wait(idle_since):
+                    break
+        self.finished = True
@@ -0,0 +1,161 @@
+"""
+Python Version: 3.9
+
+Summary: Export the ResNet50 model to ONNX, and make an int8 quantized copy of it, for the 'onnx' backend.
+
+Description:
+Converts the Keras ResNet50 model with its ImageNet weights to an ONNX model, then quantizes it to int8.  The files are
+written to the 'model_path' and 'quantized_model_path' set in the 'onnx' part of the 'classifier' section of
+config.json, where the 'onnx' backend will look for them.
+
+The exported model takes the same input as the Keras model - a float32 (batch, 224, 224, 3) array in BGR order with the
+ImageNet mean subtracted - so the predictor's preprocessing is shared by both backends.
+
+Quantization works best when it is calibrated: a folder of representative images is run through the model to measure
+the range of values in each layer, and the model's weights and activations are quantized to int8 (static quantization).
+If no calibration folder is provided only the weights are quantized (dynamic quantization), which is less accurate and
+gives less of a speed up for a convolutional model like ResNet50.
+
+This needs the tf2onnx, onnx, and onnxruntime packages in addition to TensorFlow.  Run it from the top of the
+repository:
+`> python -m img_classifier.export_onnx --calibration-dir C:\\Projects\\RestData\\Calibration`
+
+Use img_classifier.parity afterwards to check the exported models agree with the Keras model.
+"""
+import argparse
+import os
+import sys
+
+from PIL import Image
+
+from img_classifier.buffers import BatchBuffer, preprocess_pixels
+from img_classifier.config import load_config, resolve_path
+from img_classifier.predictor import MODEL_IMG_SIZE, stage_batch
+
+CALIBRATION_BATCH_SIZE = 16
+CALIBRATION_LIMIT = 512  # maximum number of calibration images to use
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def export_model(output_path, opset=13):
+    """
+    Export the Keras ResNet50 model to ONNX.
+    :param output_path: Full path to the ONNX file to write
+    :param opset: The ONNX opset to target
+    :return: Nothing
+    """
+    import tensorflow as tf
+    import tf2onnx
+    from tensorflow.keras.applications.resnet50 import ResNet50
+
+    model = ResNet50(weights='imagenet')
+    input_signature = (tf.TensorSpec((None, MODEL_IMG_SIZE, MODEL_IMG_SIZE, 3), tf.float32, name='input'),)
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=opset, output_path=output_path)
+
+
+def list_images(folder, limit=CALIBRATION_LIMIT):
+    """
+    Find images to use for calibration.
+    :param folder: The folder to search, including subfolders
+    :param limit: The maximum number of images to return
+    :return: A list of full paths to the images
+    """
+    images = []
+    for root, dirs, names in os.walk(folder):
+        for name in sorted(names):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                images.append(os.path.join(root, name))
+                if len(images) >= limit:
+                    return images
+    return images
+
+
+def iter_calibration_batches(images, batch_size=CALIBRATION_BATCH_SIZE):
+    """
+    Load and preprocess the calibration images the same way the predictor does.
+    :param images: Full paths to the images
+    :param batch_size: The number of images per batch
+    :return: Yields float32 arrays of preprocessed images, batch_size images at a time
+    """
+    buffer = BatchBuffer(batch_size, (MODEL_IMG_SIZE, MODEL_IMG_SIZE, 3))
+    for first in range(0, len(images), batch_size):
+        batch = [(image, Image.open(image).convert('RGB')) for image in images[first:first + batch_size]]
+        _, valid = stage_batch(batch, buffer.pixels)
+        if len(valid) > 0:
+            yield preprocess_pixels(buffer.pixels[:len(valid)], buffer.inputs[:len(valid)]).copy()
+
+
+def quantize_model(model_path, quantized_path, calibration_dir=None):
+    """
+    Make an int8 quantized copy of an ONNX model.
+    :param model_path: Full path to the ONNX model to quantize
+    :param quantized_path: Full path to write the quantized model to
+    :param calibration_dir: A folder of representative images.  If provided the model is statically quantized using
+                            these images for calibration, otherwise only its weights are quantized.
+    :return: Nothing
+    """
+    import onnxruntime
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType
+    from onnxruntime.quantization import quantize_dynamic, quantize_static
+
+    if calibration_dir is None:
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        return
+
+    images = list_images(calibration_dir)
+    if len(images) == 0:
+        raise ValueError(f'No calibration images found in {calibration_dir}')
+
+    input_name = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+
+    class ImageCalibrationReader(CalibrationDataReader):
+        """
+        Feeds the calibration images to the quantizer one batch at a time.
+        """
+
+        def __init__(self):
+            self.batches = iter_calibration_batches(images)
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {input_name: batch}
+
+    quantize_static(model_path, quantized_path, ImageCalibrationReader(),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+
+def main(calibration_dir=None, skip_quantize=False):
+    settings = load_config()
+    model_path = resolve_path(settings['onnx']['model_path'])
+    quantized_path = resolve_path(settings['onnx']['quantized_model_path'])
+
+    model_folder = os.path.dirname(model_path)
+    if model_folder and not os.path.exists(model_folder):
+        os.makedirs(model_folder)
+
+    print(f'Exporting ResNet50 to {model_path}')
+    export_model(model_path)
+
+    if not skip_quantize:
+        quantized_folder = os.path.dirname(quantized_path)
+        if quantized_folder and not os.path.exists(quantized_folder):
+            os.makedirs(quantized_folder)
+
+        print(f'Quantizing to {quantized_path} ({"static" if calibration_dir else "dynamic"})')
+        quantize_model(model_path, quantized_path, calibration_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='export_onnx.py',
+                                     description='Export the ResNet50 model to ONNX and quantize it to int8.')
+    parser.add_argument('--calibration-dir',
+                        help='Folder of representative images used to calibrate the int8 quantization')
+    parser.add_argument('--skip-quantize', action='store_true', help='Only export the float model')
+    arguments = parser.parse_args(sys.argv[1:])
+
+    if arguments.calibration_dir is not None and not os.path.isdir(arguments.calibration_dir):
+        print(f'Calibration directory not found: {arguments.calibration_dir}')
+        sys.exit(1)
+
+    main(arguments.calibration_dir, arguments.skip_quantize)
@@ -0,0 +1,74 @@
+"""
+Python Version: 3.9
+
+Summary: Read and write images as length-prefixed frames, to stream them between processes without writing them to disk.
+
+Description:
+Exporting images to a folder only for the classifier to read them back, and then deleting them, passes every image
+through the disk three times.  Instead the images can be written straight to the classifier's stdin, one frame each:
+    key length:  2 bytes, big-endian unsigned
+    key:         The image's key (such as its GUID), UTF-8 encoded
+    data length: 4 bytes, big-endian unsigned
+    data:        The bytes of the image file
+The stream ends when it is closed after a whole frame.  A stream that ends part way through a frame was cut off, and
+raises a ValueError once the frames before it have been read.
+"""
+import struct
+
+KEY_LENGTH = struct.Struct('>H')
+DATA_LENGTH = struct.Struct('>I')
+
+
+def read_exactly(stream, size):
+    """
+    Read a number of bytes from a stream, waiting for them all to arrive.
+    :param stream: A binary stream, such as sys.stdin.buffer
+    :param size: The number of bytes to read
+    :return: The bytes read.  Fewer than size bytes are returned only if the stream ended first.
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_frames(stream):
+    """
+    Read frames from a stream until it ends.
+    :param stream: A binary stream, such as sys.stdin.buffer
+    :return: Yields (<key>, <bytes of the image file>) tuples, one for each frame.  Raises ValueError if the stream
+             ends part way through a frame.
+    """
+    while True:
+        header = read_exactly(stream, KEY_LENGTH.size)
+        if len(header) == 0:
+            return
+
+        if len(header) == KEY_LENGTH.size:
+            key = read_exactly(stream, KEY_LENGTH.unpack(header)[0])
+            data_header = read_exactly(stream, DATA_LENGTH.size)
+            if len(data_header) == DATA_LENGTH.size:
+                data_length = DATA_LENGTH.unpack(data_header)[0]
+                data = read_exactly(stream, data_length)
+                if len(data) == data_length:
+                    yield key.decode('utf-8'), data
+                    continue
+        raise ValueError('The stream ended part way through a frame')
+
+
+def write_frame(stream, key, data):
+    """
+    Write a frame to a stream.
+    :param stream: A binary stream, such as a subprocess's stdin
+    :param key: The image's key
+    :param data: The bytes of the image file
+    :return: Nothing
+    """
+    encoded_key = key.encode('utf-8')
+    stream.write(KEY_LENGTH.pack(len(encoded_key)) + encoded_key + DATA_LENGTH.pack(len(data)))
+    stream.write(data)
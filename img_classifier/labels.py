@@ -0,0 +1,96 @@
+"""
+Python Version: 3.9
+
+Summary: The ImageNet label table, and vectorized top-k decoding of the model's probabilities.
+
+Description:
+Keras' decode_predictions() looks the class index up and sorts all 1000 probabilities in Python for every row it is
+given.  Instead, the label table is loaded once per process, and the top k classes for a whole batch are found with a
+single argpartition over the probability matrix - only the k winners of each row are sorted.
+
+The class index is the same imagenet_class_index.json file Keras uses, and it is kept in the same place Keras caches it
+(~/.keras/models), so an existing download is reused.  It is fetched without going through Keras, so backends that don't
+use TensorFlow don't need to import it.
+"""
+import hashlib
+import json
+import os
+import threading
+import urllib.request
+
+import numpy as np
+
+CLASS_INDEX_URL = 'https://storage.googleapis.com/download.tensorflow.org/data/imagenet_class_index.json'
+CLASS_INDEX_MD5 = 'c2c37ea517e94d9795004a39431a14cb'
+CLASS_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.keras', 'models', 'imagenet_class_index.json')
+CLASS_COUNT = 1000  # the number of ImageNet classes the models predict
+
+_label_table = None
+_label_lock = threading.Lock()
+
+
+def download_class_index(path=CLASS_INDEX_PATH):
+    """
+    Download the ImageNet class index and check it is intact.
+    :param path: Full path to save the class index to
+    :return: Nothing
+    """
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    with urllib.request.urlopen(CLASS_INDEX_URL) as response:
+        content = response.read()
+    if hashlib.md5(content).hexdigest() != CLASS_INDEX_MD5:
+        raise ValueError(f'The class index downloaded from {CLASS_INDEX_URL} is corrupt')
+
+    with open(path, mode='wb') as class_index_file:
+        class_index_file.write(content)
+
+
+def get_label_table():
+    """
+    Get the table of ImageNet labels, loading it the first time it is asked for.
+    :return: An array of the 1000 human-readable labels, indexed by class number
+    """
+    global _label_table
+    if _label_table is not None:
+        return _label_table
+
+    with _label_lock:
+        if _label_table is None:
+            if not os.path.exists(CLASS_INDEX_PATH):
+                download_class_index()
+
+            with open(CLASS_INDEX_PATH) as class_index_file:
+                class_index = json.load(class_index_file)
+
+            table = np.empty(len(class_index), dtype=object)
+            for index, (wordnet_id, label) in class_index.items():
+                table[int(index)] = label
+            _label_table = table
+
+    return _label_table
+
+
+def top_k(probabilities, k=3, names=None):
+    """
+    Find the k most likely labels for each row of a batch of probabilities.
+    :param probabilities: A (batch, classes) array of probabilities
+    :param k: The number of labels to return for each row
+    :param names: An optional array of the label for each column, in place of the ImageNet labels
+    :return: A list with one entry per row.  Each entry is a tuple of k (<label>, <score>) tuples, most likely first -
+             the same labels and scores Keras' decode_predictions() would give.
+    """
+    probabilities = np.asarray(probabilities)
+    k = max(1, min(int(k), probabilities.shape[1]))
+
+    # Find the k largest in each row without sorting the rest, then sort just those
+    top_indexes = np.argpartition(probabilities, -k, axis=1)[:, -k:]
+    top_scores = np.take_along_axis(probabilities, top_indexes, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top_indexes = np.take_along_axis(top_indexes, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    top_labels = (get_label_table() if names is None else np.asarray(names, dtype=object))[top_indexes]
+    return [tuple(zip(labels, scores)) for labels, scores in zip(top_labels, top_scores)]
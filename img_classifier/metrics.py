@@ -0,0 +1,234 @@
+"""
+Python Version: 3.9
+
+Summary: Per-stage timings and sampled profiling for the image classifier.
+
+Description:
+When a run is slow it helps to know where the time goes.  Classifying an image goes through these stages:
+    decode:     Reading the image file and decoding it into pixels (done by the application's image loader)
+    resize:     Scaling the image to the model's input size (done by the image loader, or by the predictor if the
+                loader didn't)
+    hash:       Computing the image's perceptual hash, when near-duplicates are skipped (see img_classifier.dedupe)
+    stage:      Copying the batch's pixels into the model's input buffer
+    preprocess: Flipping the channels and subtracting the ImageNet mean
+    inference:  Running the batch through the model
+    topk:       Finding the top labels for each image
+
+A StageMetrics object collects how long each stage took and how big the batches were.  Pass it to the predictor's
+predict_iter() (and to the image loader, for decode and resize) and read the totals with summary().  Give it a callback
+to also receive each measurement as it is made, for example to forward them to a monitoring system.  Anything with the
+same record() and record_batch() methods can be used in its place.
+
+When the predictor runs on a WorkerPool the preprocess and inference stages happen in the worker processes and are not
+timed - only the stages in the application's own process are.
+
+A Profiler captures a cProfile (or pyinstrument, if it is installed and chosen) profile of a sampled fraction of the
+batches, so profiling can be left on during a long run without slowing every batch down.  The profile of all the
+sampled batches is saved to a file after each one: a .prof file for cProfile, which can be read with pstats or snakeviz,
+or an HTML page for pyinstrument.
+"""
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+STAGES = ('decode', 'resize', 'hash', 'stage', 'preprocess', 'inference', 'topk')
+PROFILERS = ('cprofile', 'pyinstrument')
+
+
+class StageMetrics:
+    """
+    Collects the time spent in each stage of classifying images, and the size of the batches.  It is safe to share
+    between threads.
+    """
+
+    def __init__(self, callback=None):
+        """
+        :param callback: An optional function called with every measurement as it is recorded:
+                         callback(<stage>, <seconds>, <image count>).  Batch sizes are passed as
+                         callback('batch', None, <batch size>).
+        """
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._batches = 0
+        self._batch_images = 0
+        self._max_batch = 0
+
+    def record(self, stage, seconds, count=1):
+        """
+        Record the time spent in a stage.
+        :param stage: The name of the stage, one of STAGES
+        :param seconds: The time taken
+        :param count: The number of images the time was spent on
+        :return: Nothing
+        """
+        with self._lock:
+            totals = self._stages.setdefault(stage, {'calls': 0, 'images': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            totals['calls'] += 1
+            totals['images'] += count
+            totals['seconds'] += seconds
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+
+        if self._callback is not None:
+            self._callback(stage, seconds, count)
+
+    def record_batch(self, size):
+        """
+        Record the size of a batch run through the model.
+        :param size: The number of images in the batch
+        :return: Nothing
+        """
+        with self._lock:
+            self._batches += 1
+            self._batch_images += size
+            self._max_batch = max(self._max_batch, size)
+
+        if self._callback is not None:
+            self._callback('batch', None, size)
+
+    def summary(self):
+        """
+        :return: A dict with the totals so far:
+                 {'stages': {<stage>: {'calls': <count>, 'images': <count>, 'total_seconds': <seconds>,
+                                       'ms_per_image': <milliseconds>, 'max_call_ms': <milliseconds>}, ...},
+                  'batches': {'count': <count>, 'images': <count>, 'mean_size': <images>, 'max_size': <images>}}
+        """
+        with self._lock:
+            stages = {}
+            for stage, totals in self._stages.items():
+                stages[stage] = {
+                    'calls': totals['calls'],
+                    'images': totals['images'],
+                    'total_seconds': round(totals['seconds'], 6),
+                    'ms_per_image': round(totals['seconds'] * 1000 / totals['images'], 3) if totals['images'] else None,
+                    'max_call_ms': round(totals['max_seconds'] * 1000, 3)
+                }
+
+            return {
+                'stages': stages,
+                'batches': {
+                    'count': self._batches,
+                    'images': self._batch_images,
+                    'mean_size': round(self._batch_images / self._batches, 2) if self._batches else None,
+                    'max_size': self._max_batch
+                }
+            }
+
+    def reset(self):
+        """
+        Clear the totals.
+        :return: Nothing
+        """
+        with self._lock:
+            self._stages = {}
+            self._batches = 0
+            self._batch_images = 0
+            self._max_batch = 0
+
+
+@contextmanager
+def _timer(metrics, stage, count):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record(stage, time.perf_counter() - start, count)
+
+
+def timed(metrics, stage, count=1):
+    """
+    Time the code in a with block as a stage.
+    :param metrics: The StageMetrics to record the time in.  If None, nothing is timed.
+    :param stage: The name of the stage
+    :param count: The number of images being worked on
+    :return: A context manager
+    """
+    return nullcontext() if metrics is None else _timer(metrics, stage, count)
+
+
+class Profiler:
+    """
+    Profiles a sampled fraction of the batches, adding them all into one profile which is saved after each sample.
+    """
+
+    def __init__(self, sample_rate, output_path, engine='cprofile'):
+        """
+        :param sample_rate: The fraction of batches to profile, from 0 (none) to 1 (all)
+        :param output_path: The file to save the profile to
+        :param engine: 'cprofile', or 'pyinstrument' to use the pyinstrument package
+        """
+        if engine not in PROFILERS:
+            raise ValueError(f'Unknown profiler "{engine}".  Expected one of: {", ".join(PROFILERS)}')
+
+        self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        self.output_path = output_path
+        self.engine = engine
+        self.samples = 0
+
+        if engine == 'pyinstrument':
+            from pyinstrument import Profiler as PyinstrumentProfiler
+            self._profile = PyinstrumentProfiler()
+        else:
+            import cProfile
+            self._profile = cProfile.Profile()
+
+        self._credit = 0.0
+        self._lock = threading.Lock()
+        # Only one batch is profiled at a time, the profilers can't be started twice
+        self._running = threading.Lock()
+
+    def _should_sample(self):
+        # Spread the samples evenly: every batch adds sample_rate to the credit, and a whole credit buys a sample
+        with self._lock:
+            self._credit += self.sample_rate
+            if self._credit >= 1.0:
+                self._credit -= 1.0
+                return True
+            return False
+
+    @contextmanager
+    def sample(self):
+        """
+        Profile the code in a with block, if this is one of the sampled batches.
+        :return: A context manager
+        """
+        if not self._should_sample() or not self._running.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            if self.engine == 'pyinstrument':
+                self._profile.start()
+            else:
+                self._profile.enable()
+            try:
+                yield
+            finally:
+                if self.engine == 'pyinstrument':
+                    self._profile.stop()
+                else:
+                    self._profile.disable()
+                self.samples += 1
+                self.save()
+        finally:
+            self._running.release()
+
+    def save(self):
+        """
+        Save the profile of all the sampled batches so far to the output path.
+        :return: Nothing
+        """
+        if self.engine == 'pyinstrument':
+            with open(self.output_path, mode='w', encoding='utf-8') as profile_file:
+                profile_file.write(self._profile.output_html())
+        else:
+            self._profile.dump_stats(self.output_path)
+
+
+def profiled(profiler):
+    """
+    Profile the code in a with block if it is one of the profiler's sampled batches.
+    :param profiler: The Profiler to use.  If None, nothing is profiled.
+    :return: A context manager
+    """
+    return nullcontext() if profiler is None else profiler.sample()
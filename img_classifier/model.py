@@ -0,0 +1,120 @@
+"""
+Python Version: 3.9
+
+Summary: A lazily built, process-wide holder for the image classification model.
+
+Description:
+Building a Keras model (and importing TensorFlow to do it) takes several seconds and a lot of memory.  Rather than
+paying that cost when a module is imported, the model is wrapped in a ModelHolder which only builds it the first time it
+is needed.  This lets command line error paths exit right away, and lets the microservice answer health checks while the
+model is still loading.
+
+The first forward pass through a freshly built model is much slower than the ones after it because TensorFlow traces and
+compiles the graph on that call.  The warm_up() method runs a batch of blank images through the model so that cost is
+paid up front rather than by the first real request.
+
+The holder records how long the load and warm up took, and what state the model is in:
+    unloaded -> loading -> loaded -> warming -> ready
+or 'failed' if the model could not be built.  A model that failed to build isn't tried again: every later get() raises
+the same error straight away, so a bad model costs one attempt rather than one for each batch.
+"""
+import threading
+import time
+
+import numpy as np
+
+
+class ModelHolder:
+    """
+    Holds a single model instance that is built on first use.  It is safe to share a holder between threads: the model
+    will only be built once, and callers will wait for it to finish loading.
+    """
+
+    def __init__(self, build_model, input_shape):
+        """
+        :param build_model: A callable that takes no arguments and returns the built model
+        :param input_shape: The shape of a single input to the model, not including the batch dimension.  Used to make
+                            the dummy batch for warm up.
+        """
+        self._build_model = build_model
+        self._input_shape = tuple(input_shape)
+        self._lock = threading.RLock()
+        self._model = None
+        self._build_error = None
+
+        self.state = 'unloaded'
+        self.error = None
+        self.load_seconds = None
+        self.warm_up_seconds = None
+
+    @property
+    def is_ready(self):
+        """
+        :return: True if the model is loaded and has been warmed up
+        """
+        return self.state == 'ready'
+
+    def get(self):
+        """
+        Get the model, building it if this is the first time it has been asked for.  If the model is being built on
+        another thread this will block until it is done.
+        :return: The built model.  Raises the error the build failed with if it has already failed.
+        """
+        if self._model is not None:
+            return self._model
+
+        with self._lock:
+            if self._build_error is not None:
+                raise self._build_error
+            if self._model is None:
+                self.state = 'loading'
+                start = time.perf_counter()
+                try:
+                    model = self._build_model()
+                except Exception as e:
+                    self.state = 'failed'
+                    self.error = e
+                    self._build_error = e
+                    raise
+                self.load_seconds = time.perf_counter() - start
+                self._model = model
+                self.state = 'loaded'
+
+        return self._model
+
+    def warm_up(self, batch_size=1):
+        """
+        Load the model if needed, then run a batch of blank images through it to trigger graph compilation.  Calling
+        this again after the model has been warmed up does nothing.
+        :param batch_size: The number of blank images in the warm up batch.  Use the batch size real work will be done
+                           with to have the model prepared for it.
+        :return: This holder, so calls can be chained
+        """
+        model = self.get()
+
+        with self._lock:
+            if self.warm_up_seconds is None:
+                self.state = 'warming'
+                start = time.perf_counter()
+                try:
+                    dummy_batch = np.zeros((max(1, int(batch_size)),) + self._input_shape, dtype=np.float32)
+                    model.predict_on_batch(dummy_batch)
+                except Exception as e:
+                    self.state = 'failed'
+                    self.error = e
+                    raise
+                self.warm_up_seconds = time.perf_counter() - start
+                self.state = 'ready'
+
+        return self
+
+    def timings(self):
+        """
+        :return: A dict describing the model's state and how long it took to load and warm up, in seconds.  Times will
+                 be None if that step hasn't finished yet.
+        """
+        return {
+            'state': self.state,
+            'load_seconds': self.load_seconds,
+            'warm_up_seconds': self.warm_up_seconds
+        }
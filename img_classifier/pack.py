@@ -0,0 +1,144 @@
+"""
+Python Version: 3.9
+
+Summary: Read images from a pack: one data file holding many images, with an index of where each one is.
+
+Description:
+Exporting every image as its own file, then opening each of them again to classify it, spends most of its time creating
+and opening files when the images are small and the folder is on a network share.  A pack holds all of the images in
+two files instead:
+    images.pack:     The bytes of each image file, one after the other
+    images.pack.idx: One line of text for each image: <key>, <offset> and <length> separated by tabs, where the key is
+                     the image's GUID and the offset and length locate its bytes in the data file
+The data file is written before its index line, so a pack whose writer was stopped part way only loses the image being
+written.  An index line that wasn't completely written, or that points past the end of the data file, is ignored.
+cli.predict_selected writes packs from Nuix Workstation.
+
+The data file is memory-mapped, so reading an image is a slice of the map: no system call and no copy.  The slice can be
+hashed and checked for its format in place; PIL needs a file object to decode from, so the bytes are only copied once,
+into that.
+
+An ImagePack can be iterated for its keys in the order they were written, like a discovery.FileDiscovery, and has the
+same 'found' and 'finished' counts so progress can be reported the same way.  It can also be opened for just one shard
+of its images, chosen by the same hash of the key that shards the files of a folder.
+"""
+import mmap
+import os
+
+from img_classifier import discovery
+
+PACK_FILENAME = 'images.pack'
+INDEX_SUFFIX = '.idx'
+
+
+def find_pack(path):
+    """
+    Find the pack to read images from, if there is one.
+    :param path: A pack's data file, or a folder
+    :return: The path to the pack's data file if the path is a pack, or a folder holding images.pack, otherwise None
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, PACK_FILENAME)
+    if os.path.isfile(path) and os.path.isfile(path + INDEX_SUFFIX):
+        return path
+    return None
+
+
+class ImagePack:
+    """
+    The images in a pack, as described above.
+    """
+
+    def __init__(self, path, shard=None):
+        """
+        :param path: Full path to the pack's data file.  Its index is the same path with INDEX_SUFFIX added.
+        :param shard: The (index, count) of the shard of the images to read, or None to read them all
+        """
+        self.path = path
+        self.shard = shard
+        self._file = open(path, mode='rb')
+        size = os.fstat(self._file.fileno()).st_size
+        # An empty file can't be mapped, and has no images anyway
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        self._identity = {'mtime_ns': os.fstat(self._file.fileno()).st_mtime_ns}
+
+        self._entries = {}
+        with open(path + INDEX_SUFFIX, mode='r', encoding='utf-8') as index_file:
+            for line in index_file:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    key, offset, length = line.rstrip('\n').split('\t')
+                    offset, length = int(offset), int(length)
+                except ValueError:
+                    continue
+                if offset < 0 or length < 0 or offset + length > size:
+                    continue
+                if shard is not None and discovery.shard_of(key, shard[1]) != shard[0]:
+                    continue
+                self._entries[key] = (offset, length)
+
+        # For progress reporting, like discovery.FileDiscovery
+        self.found = len(self._entries)
+        self.finished = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def view(self, key):
+        """
+        :param key: The image's key
+        :return: A memoryview of the image's bytes in the data file, without copying them.  Raises KeyError if the pack
+                 has no image with the key.
+        """
+        offset, length = self._entries[key]
+        if length == 0:
+            return memoryview(b'')
+        return memoryview(self._map)[offset:offset + length]
+
+    def read_image(self, key, formats=discovery.DEFAULT_FORMATS):
+        """
+        Read an image, if its content is one of the accepted formats.  See discovery.read_image_file().
+        :param key: The image's key
+        :param formats: The names of the formats to accept, from discovery.IMAGE_FORMATS
+        :return: A memoryview of the image's bytes.  Raises discovery.NotAnImage if they aren't one of the formats.
+        """
+        image_bytes = self.view(key)
+        if discovery.sniff(bytes(image_bytes[:discovery.SNIFF_BYTES]), formats) is None:
+            raise discovery.NotAnImage(f'{key} in {self.path} is not a {"/".join(formats)} image')
+        return image_bytes
+
+    def identity(self, key):
+        """
+        Identify an image in the pack, like results_log.file_identity()'s 'stat' check.  The pack's modification time
+        stands in for the image's, so a pack that has been written again has all of its images classified again.
+        :param key: The image's key
+        :return: A dict of the fields identifying the image
+        """
+        return dict(self._identity, size=self._entries[key][1])
+
+    def close(self):
+        """
+        Close the pack's files.
+        :return: Nothing
+        """
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # A view of an image is still held somewhere, the map is closed when it is released
+                pass
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,140 @@
+"""
+Python Version: 3.9
+
+Summary: Check that the ONNX backend gives the same answers as the Keras backend.
+
+Description:
+Runs a reference set of images through both the Keras backend and the ONNX backend (using the float or the int8
+quantized model, as set in config.json or with --quantized) and compares their top 3 labels for each image.  Two
+agreement rates are reported:
+    top3: The fraction of images where both backends chose the same three labels (in any order)
+    top1: The fraction of images where both backends chose the same most likely label
+
+Images where the backends disagree are listed.  The application exits with a non-zero status if the top 3 agreement is
+below the --min-agreement threshold, so it can be used as a gate before switching backends.
+
+Run it from the top of the repository:
+`> python -m img_classifier.parity C:\\Projects\\RestData\\Reference --quantized --min-agreement 0.95`
+"""
+import argparse
+import copy
+import os
+import sys
+
+from PIL import Image
+
+from img_classifier import backends
+from img_classifier import predictor
+from img_classifier.config import load_config
+
+DEFAULT_MIN_AGREEMENT = 0.95
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def get_reference_images(folder):
+    """
+    :param folder: The folder of reference images, including subfolders
+    :return: A sorted list of the full paths to the reference images
+    """
+    images = []
+    for root, dirs, names in os.walk(folder):
+        images.extend(os.path.join(root, name) for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(images)
+
+
+def classify(backend, images, batch_size=predictor.DEFAULT_BATCH_SIZE):
+    """
+    Get the top 3 labels for each of the images using the given backend.
+    :param backend: The built backend to use
+    :param images: Full paths to the images
+    :param batch_size: The number of images per forward pass
+    :return: A list of results, in the same order as the images, in the format described by predictor.predict()
+    """
+    results = []
+    for start in range(0, len(images), batch_size):
+        batch = []
+        for image in images[start:start + batch_size]:
+            try:
+                batch.append((image, Image.open(image).convert('RGB')))
+            except Exception as e:
+                batch.append((image, e))
+        results.extend(predictor.predict_batch(batch, backend, top_k=3))
+    return results
+
+
+def compare(images, expected, actual):
+    """
+    Compare the results of two backends.
+    :param images: The images the results are for
+    :param expected: The results from the reference (Keras) backend
+    :param actual: The results from the backend being checked
+    :return: A dict with the number of images 'compared', the 'top3' and 'top1' agreement rates, and a list of
+             'mismatches': (<image>, <expected labels>, <actual labels>)
+    """
+    compared = 0
+    top3_matches = 0
+    top1_matches = 0
+    mismatches = []
+    for image, expected_result, actual_result in zip(images, expected, actual):
+        if 'ERROR' == expected_result[0] or 'ERROR' == actual_result[0]:
+            continue
+
+        compared += 1
+        expected_labels = [label for label, _ in expected_result]
+        actual_labels = [label for label, _ in actual_result]
+        if set(expected_labels) == set(actual_labels):
+            top3_matches += 1
+        else:
+            mismatches.append((image, expected_labels, actual_labels))
+        if expected_labels[0] == actual_labels[0]:
+            top1_matches += 1
+
+    return {
+        'compared': compared,
+        'top3': top3_matches / compared if compared else 0.0,
+        'top1': top1_matches / compared if compared else 0.0,
+        'mismatches': mismatches
+    }
+
+
+def main(reference_dir, quantized=None, min_agreement=DEFAULT_MIN_AGREEMENT):
+    images = get_reference_images(reference_dir)
+    if len(images) == 0:
+        print(f'No reference images found in {reference_dir}')
+        return False
+
+    keras_settings = copy.deepcopy(load_config())
+    keras_settings['backend'] = 'keras'
+    onnx_settings = copy.deepcopy(keras_settings)
+    onnx_settings['backend'] = 'onnx'
+    if quantized is not None:
+        onnx_settings['onnx']['quantized'] = quantized
+
+    print(f'Classifying {len(images)} images with {backends.backend_id(keras_settings)}')
+    expected = classify(backends.create_backend(keras_settings), images)
+    print(f'Classifying {len(images)} images with {backends.backend_id(onnx_settings)}')
+    actual = classify(backends.create_backend(onnx_settings), images)
+
+    comparison = compare(images, expected, actual)
+    for image, expected_labels, actual_labels in comparison['mismatches']:
+        print(f'Mismatch: {image}: keras={expected_labels} onnx={actual_labels}')
+    print(f'Compared {comparison["compared"]} images: top3 agreement {comparison["top3"]:.2%}, '
+          f'top1 agreement {comparison["top1"]:.2%}')
+
+    return comparison['compared'] > 0 and comparison['top3'] >= min_agreement
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='parity.py',
+                                     description='Check the ONNX backend agrees with the Keras backend.')
+    parser.add_argument('reference_dir', help='Folder of reference images')
+    parser.add_argument('--quantized', dest='quantized', action='store_true', default=None,
+                        help='Check the int8 quantized model')
+    parser.add_argument('--float', dest='quantized', action='store_false',
+                        help='Check the float model')
+    parser.add_argument('--min-agreement', type=float, default=DEFAULT_MIN_AGREEMENT,
+                        help='The minimum fraction of images whose top 3 labels must agree')
+    arguments = parser.parse_args(sys.argv[1:])
+
+    passed = main(arguments.reference_dir, arguments.quantized, arguments.min_agreement)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,70 @@
+"""
+Python Version: 3.9
+
+Summary: A bounded prefetch pipeline to load images on worker threads while the model works.
+
+Description:
+Decoding and resizing images is a large part of the cost of classifying them.  If it is done on the same thread as the
+inference then the CPU takes turns: decode a batch, then infer on it, then decode the next one.  The prefetch()
+generator hands the loading work to a pool of worker threads which stay up to queue_depth images ahead of the consumer,
+so the next batch is being decoded while the model works on the current one.
+
+Threads are used rather than processes because Pillow releases the GIL while decoding and resizing, and threads avoid
+having to pickle the decoded images back to the consumer.
+
+Results come out of the pipeline in the same order the items went in.  If loading an item fails the exception is passed
+along in place of the loaded image, so one bad image doesn't stop the rest.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)  # threads loading images
+DEFAULT_QUEUE_DEPTH = 64  # images loaded or being loaded ahead of the consumer
+
+
+def prefetch(items, load, workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH):
+    """
+    Load items on a pool of worker threads, keeping up to queue_depth items loaded ahead of the consumer.
+
+    :param items: An iterable of the items to load, such as image file paths
+    :param load: The function used to load a single item.  It will be called on a worker thread with the item as its
+                 only parameter.
+    :param workers: The number of worker threads to load items with
+    :param queue_depth: The maximum number of items loaded, or being loaded, that have not been consumed yet.  This
+                        bounds how much memory the pipeline uses.  It should be at least as large as the batch size
+                        the images are consumed in so the workers can stay a batch ahead.
+    :return: Yields tuples of (<item>, <loaded item>) in the same order the items were provided.  If loading an item
+             raised an exception then the exception is provided instead of the loaded item.
+    """
+    workers = max(1, int(workers))
+    queue_depth = max(1, int(queue_depth))
+
+    pending = deque()
+    item_iter = iter(items)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Image Loader') as executor:
+        try:
+            exhausted = False
+            while True:
+                # Top the queue up before waiting on the oldest item
+                while not exhausted and len(pending) < queue_depth:
+                    try:
+                        item = next(item_iter)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        pending.append((item, executor.submit(load, item)))
+
+                if len(pending) == 0:
+                    break
+
+                item, future = pending.popleft()
+                try:
+                    loaded = future.result()
+                except Exception as e:
+                    loaded = e
+                yield item, loaded
+        finally:
+            # If the consumer stops early, don't wait on work nobody will use
+            for _, future in pending:
+                future.cancel()
@@ -13,19 +13,424 @@ cases.  It is just meant as a sample use case.
 This is designed to be part of either a Command Line application (using the cli.predict_from_folder module) or
 Microservice application (using the microservice.predict_service module).  It does nothing on its own.
 
+Images are classified in batches: up to batch_size images are pulled from the image source, stacked into a single
+tensor, and run through the model in one forward pass.  The results are split back out in the same order the images
+were provided.  The top labels for the whole batch are found at once from the probability matrix using a cached label
+table (see img_classifier.labels).  The images are copied into a reusable input buffer and preprocessed in place (see
+img_classifier.buffers) rather than allocating new arrays for every image.
+
+Results can be consumed as they are made using the predict_iter() generator, which yields each image's result as soon as
+its batch is finished.  The predict() function collects those results into a list.
+
+To keep each image's full probability vector (and optionally its embedding) for later re-labelling without running the
+model again, pass predict_iter() a ProbabilityStore (see img_classifier.store).
+
+To find out where the time goes, pass predict_iter() a StageMetrics object to collect the time spent in each stage and
+the batch sizes, and a Profiler to profile a sampled fraction of the batches (see img_classifier.metrics).
+
+The model is run by one of the backends in img_classifier.backends - the Keras model, or an ONNX export of it run with
+ONNX Runtime - as chosen by the 'backend' setting in the 'classifier' section of config.json.  If the cascade is turned
+on in the settings, each batch is first run through a smaller model and only the images it isn't confident about are
+run through the main model (see img_classifier.cascade).  Each result is a Prediction, which records the model that
+answered.
+
+TensorFlow and the model are not loaded when this module is imported.  The model is built the first time a prediction
+is made, or when warm_up() is called.  Applications that want to pay the load cost up front (such as the microservice)
+should call warm_up() when they start.
 """
-from keras.preprocessing.image import img_to_array
-from tensorflow.keras.applications.resnet50 import preprocess_input
-from tensorflow.keras.applications.resnet50 import decode_predictions
-from tensorflow.keras.applications.resnet50 import ResNet50
+import numpy as np
+
+from img_classifier import backends
+from img_classifier import cascade
+from img_classifier import decoder
+from img_classifier import labels
+from img_classifier.buffers import BufferPool, preprocess_pixels
+from img_classifier.config import load_config
+from img_classifier.metrics import profiled, timed
+from img_classifier.model import ModelHolder
 
 MODEL_IMG_SIZE = 224  # in pixels
-model = ResNet50(weights='imagenet')
+DEFAULT_BATCH_SIZE = 32  # images per forward pass
+
+# The classifier settings from config.json, which choose the inference backend
+settings = load_config()
+
+# The number of labels returned for each image
+TOP_K = int(settings['top_k'])
+
+
+def probabilities_id():
+    """
+    Identify the model and settings probabilities are made with, used to check a ProbabilityStore is only added to by
+    the same model.
+    :return: A string identifying the backend's model (or the cascade of models) and how images are decoded
+    """
+    return f'{cascade.cascade_id(settings)}-{decoder.decoder_id(settings)}'
+
+
+def model_id(top_k=TOP_K):
+    """
+    Identify the model and settings results are made with, used to key cached results.
+    :param top_k: The number of labels returned for each image
+    :return: A string identifying the backend's model (or the cascade of models), how images are decoded and the number
+             of labels
+    """
+    return f'{probabilities_id()}-top{top_k}'
+
+
+MODEL_ID = model_id()
+PROBABILITIES_ID = probabilities_id()
+
+# The models' names, recorded with the predictions they make
+MODEL_NAME = backends.backend_id(settings)
+FIRST_MODEL_NAME = backends.backend_id(cascade.first_settings(settings)) if cascade.is_enabled(settings) else None
+
+# The top-1 probability the cascade's first model needs for its answer to be kept
+CASCADE_THRESHOLD = float(settings['cascade']['threshold'])
+
+
+class Prediction(tuple):
+    """
+    The labels predicted for an image: a tuple of (<label>, <score>) tuples, most likely first.  It can be used anywhere
+    a plain tuple of labels can, and adds the name of the model that made the prediction as its model attribute (None if
+    it isn't known).
+    """
+
+    def __new__(cls, image_labels, model=None):
+        prediction = super().__new__(cls, image_labels)
+        prediction.model = model
+        return prediction
+
+
+def build_model():
+    """
+    Build the inference backend chosen in the settings.  The backend's runtime (TensorFlow or ONNX Runtime) is imported
+    here so its cost is only paid when the model is actually needed.
+    :return: The built backend
+    """
+    return backends.create_backend(settings)
+
+
+def build_first_model():
+    """
+    Build the backend for the first stage of the cascade.
+    :return: The built backend
+    """
+    return backends.create_backend(cascade.first_settings(settings))
+
+
+# The process-wide model, built on first use
+model = ModelHolder(build_model, (MODEL_IMG_SIZE, MODEL_IMG_SIZE, 3))
+
+# The cascade's first model, if the cascade is turned on
+first_model = None
+if cascade.is_enabled(settings):
+    first_model = ModelHolder(build_first_model, (MODEL_IMG_SIZE, MODEL_IMG_SIZE, 3))
+
+# Reusable input tensors for the batches sent to the model
+buffer_pool = BufferPool((MODEL_IMG_SIZE, MODEL_IMG_SIZE, 3))
+
+
+def warm_up(batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Load the model and run a dummy batch through it so the first real prediction doesn't pay for graph compilation.
+    :param batch_size: The size of the dummy batch.  Use the batch size predictions will be made with.
+    :return: The model's load and warm up timings, as described by ModelHolder.timings()
+    """
+    if first_model is not None:
+        first_model.warm_up(batch_size)
+    return model.warm_up(batch_size).timings()
+
+
+def resize_image(img_pixels):
+    """
+    Resize a PIL image to the size the model expects.  Image loaders can call this on their own threads so the resize
+    is already done by the time the image reaches the predictor.
+    :param img_pixels: The RGB PIL image to resize
+    :return: The image, resized to MODEL_IMG_SIZE x MODEL_IMG_SIZE
+    """
+    if img_pixels.size == (MODEL_IMG_SIZE, MODEL_IMG_SIZE):
+        return img_pixels
+    return img_pixels.resize((MODEL_IMG_SIZE, MODEL_IMG_SIZE))
+
+
+def report_error(key, error):
+    """
+    Print an error that happened on an image and make the error result for it.
+    :param key: The key identifying the image
+    :param error: The exception raised for the image
+    :return: The error result for the image: ('ERROR', <error>)
+    """
+    print(f"Error in image: {key}")
+    print(f"Error: {error}")
+    return 'ERROR', error
+
+
+def stage_batch(batch, pixels):
+    """
+    Copy the images in a batch into a uint8 staging array, ready to be preprocessed for the model.  Images that are
+    errors, or whose results are already known, are not staged - their results are filled in right away.
+    :param batch: A list of tuples: [0] the key identifying the image in the input, [1] the RGB PIL image, the
+                  exception raised while loading the image, or the image's result if it is already known (for example
+                  from a cache).
+    :param pixels: A uint8 array with room for at least len(batch) images to copy the images to
+    :return: A tuple: [0] a list with the results for each position in the batch, None for images that were staged,
+             [1] the positions in the batch of the staged images, in the order they were copied into pixels
+    """
+    results = [None] * len(batch)
+    valid = []
+    for position, (key, img_pixels) in enumerate(batch):
+        if isinstance(img_pixels, Exception):
+            results[position] = report_error(key, img_pixels)
+            continue
+        if isinstance(img_pixels, tuple):
+            results[position] = img_pixels
+            continue
+
+        try:
+            np.copyto(pixels[len(valid)], np.asarray(resize_image(img_pixels)))
+            valid.append(position)
+        except Exception as e:
+            results[position] = report_error(key, e)
+
+    return results, valid
+
+
+def make_predictions(probabilities, escalated, top_k, model_name=MODEL_NAME):
+    """
+    Turn a batch of probabilities into Predictions.
+    :param probabilities: The (batch, classes) array of probabilities
+    :param escalated: The boolean array from cascade.classify() marking the images the main model answered, or None if
+                      the main model answered them all
+    :param top_k: The number of labels to return for each image
+    :param model_name: The name of the main model
+    :return: A list of Predictions, one per row of probabilities
+    """
+    batch_labels = labels.top_k(probabilities, top_k)
+    if escalated is None:
+        return [Prediction(image_labels, model_name) for image_labels in batch_labels]
+    return [Prediction(image_labels, model_name if main else FIRST_MODEL_NAME)
+            for image_labels, main in zip(batch_labels, escalated)]
+
+
+def classify_with_embeddings(pixels, inputs, backend, metrics=None):
+    """
+    Preprocess and run a batch of staged pixels through a backend, keeping the embeddings from its penultimate layer.
+    :param pixels: A uint8 array of shape (count, rows, columns, 3) of RGB pixels
+    :param inputs: A float32 array with room for at least count images to preprocess the pixels into
+    :param backend: A backend with a predict_with_embeddings() method
+    :param metrics: An optional StageMetrics to record the preprocess and inference times in
+    :return: A tuple: [0] the (count, classes) array of probabilities, [1] the (count, width) array of embeddings
+    """
+    count = len(pixels)
+    with timed(metrics, 'preprocess', count):
+        batch_inputs = preprocess_pixels(pixels, inputs[:count], backend.preprocessing)
+    with timed(metrics, 'inference', count):
+        return backend.predict_with_embeddings(batch_inputs)
+
+
+def check_store(store, pool=None):
+    """
+    Make sure the predictions can be saved to a ProbabilityStore.
+    :param store: The img_classifier.store.ProbabilityStore, or None
+    :param pool: The WorkerPool the predictions will be made on, or None
+    :return: Nothing.  Raises a ValueError if the store can't be used.
+    """
+    if store is None:
+        return
+    if store.classes != labels.CLASS_COUNT:
+        raise ValueError(f'The store holds {store.classes} classes, the model predicts {labels.CLASS_COUNT}')
+    if store.keeps_embeddings:
+        if pool is not None or cascade.is_enabled(settings):
+            raise ValueError('Embeddings can only be stored when the model runs in this process without a cascade')
+        if not backends.supports_embeddings(settings):
+            raise ValueError(f'The "{settings["backend"]}" backend can not provide embeddings')
+
+
+def predict_batch(batch, backend=None, top_k=TOP_K, metrics=None, store=None):
+    """
+    Run a single forward pass over a batch of images.
+
+    The images are copied into a reusable, preallocated input buffer and preprocessed in place, so no per-image arrays
+    are allocated along the way.
+
+    If the batch fails as a whole, each image in it is retried on its own so only the image(s) that actually caused the
+    failure are reported as errors.
+
+    :param batch: A list of (<key>, <image>) tuples, as described by stage_batch()
+    :param backend: The backend to run the batch on.  Defaults to the process-wide model, or the cascade if it is on.
+    :param top_k: The number of labels to return for each image
+    :param metrics: An optional StageMetrics to record the time spent in each stage
+    :param store: An optional ProbabilityStore to append the probabilities of the images the model ran on to
+    :return: A list of results in the same order as the batch, in the format described by predict().  Raises the
+             model's error if it can't be built.
+    """
+    stored = None
+    with buffer_pool.acquire(len(batch)) as buffer:
+        with timed(metrics, 'stage', len(batch)):
+            results, valid = stage_batch(batch, buffer.pixels)
+        if len(valid) == 0:
+            return results
+
+        # A model that can't be built is a problem with the model, not the images, so it is raised rather than reported
+        # as every image's error
+        if backend is not None:
+            main_backend, first_backend, model_name = backend, None, None
+        else:
+            main_backend = model.get()
+            first_backend = first_model.get() if first_model is not None else None
+            model_name = MODEL_NAME
+
+        try:
+            # Predict
+            embeddings = None
+            if store is not None and store.keeps_embeddings:
+                probabilities, embeddings = classify_with_embeddings(buffer.pixels[:len(valid)], buffer.inputs,
+                                                                     main_backend, metrics)
+                escalated = None
+            else:
+                probabilities, escalated = cascade.classify(buffer.pixels[:len(valid)], buffer.inputs, main_backend,
+                                                            first_backend, CASCADE_THRESHOLD, metrics)
+            if metrics is not None:
+                metrics.record_batch(len(valid))
+
+            with timed(metrics, 'topk', len(valid)):
+                predictions = make_predictions(probabilities, escalated, top_k, model_name)
+            for position, prediction in zip(valid, predictions):
+                results[position] = prediction
+            if store is not None:
+                stored = probabilities, embeddings
+        except Exception as e:
+            if len(valid) == 1:
+                results[valid[0]] = report_error(batch[valid[0]][0], e)
+            else:
+                # Find out which image(s) in the batch are the problem
+                for position in valid:
+                    results[position] = predict_batch([batch[position]], backend, top_k, metrics, store)[0]
+
+    # Failing to store the results is not a problem with the images, so it isn't caught
+    if stored is not None:
+        store.append([batch[position][0] for position in valid], *stored)
+    return results
 
 
-def predict(get_images):
+def iter_batches(get_images, batch_size):
     """
-    Make predictions on a list of images and return the labels and probabilities for the top 3 most likely
+    Group the images from an image source into batches.
+    :param get_images: The image source, as described by predict_iter()
+    :param batch_size: The maximum number of images in a batch
+    :return: Yields lists of (<key>, <image>) tuples, up to batch_size at a time
+    """
+    batch = []
+    for index, item in enumerate(get_images()):
+        batch.append(item if isinstance(item, tuple) else (index, item))
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+
+def predict_batches_on_pool(batches, pool, top_k=TOP_K, metrics=None, store=None):
+    """
+    Run batches of images through a WorkerPool.  The images are staged in this process and the batches are sent to the
+    pool's worker processes for inference, several at a time.
+
+    As with predict_batch(), if a batch fails as a whole each image in it is retried on its own so only the image(s)
+    that actually caused the failure are reported as errors.
+
+    :param batches: An iterable of batches, each a list of (<key>, <image>) tuples as described by stage_batch()
+    :param pool: The img_classifier.worker_pool.WorkerPool to run the batches on
+    :param top_k: The number of labels to return for each image
+    :param metrics: An optional StageMetrics to record the time spent in the stages run in this process
+    :param store: An optional ProbabilityStore to append the probabilities of the images the model ran on to
+    :return: Yields tuples of (<batch>, <list of results for the batch>) in the same order the batches were provided
+    """
+    def staged_batches():
+        for batch in batches:
+            # The pool sends these to the workers in the background, so each batch needs its own array
+            with timed(metrics, 'stage', len(batch)):
+                pixels = np.empty((len(batch), MODEL_IMG_SIZE, MODEL_IMG_SIZE, 3), dtype=np.uint8)
+                results, valid = stage_batch(batch, pixels)
+            yield (batch, results, valid, pixels), pixels[:len(valid)]
+
+    for (batch, results, valid, pixels), outcome in pool.map_batches(staged_batches()):
+        if isinstance(outcome, Exception):
+            if len(valid) == 1:
+                results[valid[0]] = report_error(batch[valid[0]][0], outcome)
+            else:
+                # Find out which image(s) in the batch are the problem
+                for staged, position in enumerate(valid):
+                    try:
+                        single, escalated = pool.run(pixels[staged:staged + 1])
+                        results[position] = make_predictions(single, escalated, top_k)[0]
+                    except Exception as e:
+                        results[position] = report_error(batch[position][0], e)
+                        continue
+                    if store is not None:
+                        store.append([batch[position][0]], single)
+        elif outcome is not None:
+            probabilities, escalated = outcome
+            if metrics is not None:
+                metrics.record_batch(len(valid))
+            with timed(metrics, 'topk', len(valid)):
+                predictions = make_predictions(probabilities, escalated, top_k)
+            for position, prediction in zip(valid, predictions):
+                results[position] = prediction
+            if store is not None:
+                store.append([batch[position][0] for position in valid], probabilities)
+
+        yield batch, results
+
+
+def predict_iter(get_images, batch_size=DEFAULT_BATCH_SIZE, top_k=TOP_K, pool=None, metrics=None, profiler=None,
+                 store=None):
+    """
+    Make predictions on a sequence of images, yielding the results for each image as soon as its batch is done.  Only
+    one batch of images is held in memory at a time, so this can be used on any number of images.
+
+    Results are yielded in the same order the images were provided.
+
+    :param get_images: This is a callback to get the images to make predictions for.  It should return an iterable
+                       (preferably a generator) of the images as RGB pillow images with no other pre-processing done.
+                       Each item can either be the image itself, in which case the image's key is its index in the
+                       input, or a tuple of (<key>, <image>) to use something else, like the image's file name, as the
+                       key.  If an image could not be loaded, the exception raised while loading it can be provided in
+                       the image's place and it will be reported as that image's error.  If the image's result is
+                       already known, such as from a PredictionCache, it can be provided in the image's place and it is
+                       passed through without running the model - results must be given in the (<key>, <result>) form.
+    :param batch_size: The number of images to run through the model in a single forward pass.
+    :param top_k: The number of labels to return for each image.  Defaults to the 'top_k' setting.
+    :param pool: An optional img_classifier.worker_pool.WorkerPool.  If provided, inference runs on the pool's worker
+                 processes - several batches at a time - instead of on the process-wide model.
+    :param metrics: An optional img_classifier.metrics.StageMetrics, or any object with the same record() and
+                    record_batch() methods, to receive the time spent in each stage and the size of each batch.
+    :param profiler: An optional img_classifier.metrics.Profiler to profile a sampled fraction of the batches.  It is
+                     only used when the model runs in this process, not on a pool.
+    :param store: An optional img_classifier.store.ProbabilityStore, opened for appending, to save the full probability
+                  vector of every image the model runs on to.  If the store keeps embeddings, the model must run in
+                  this process without a cascade, on a backend that provides them.
+    :return: Yields tuples of (<key>, <result>) where the result is in the format described by predict()
+    """
+    check_store(store, pool)
+    batches = iter_batches(get_images, max(1, int(batch_size)))
+
+    if pool is None:
+        for batch in batches:
+            with profiled(profiler):
+                results = predict_batch(batch, top_k=top_k, metrics=metrics, store=store)
+            yield from zip([key for key, _ in batch], results)
+    else:
+        for batch, results in predict_batches_on_pool(batches, pool, top_k, metrics, store):
+            yield from zip([key for key, _ in batch], results)
+
+
+def predict(get_images, batch_size=DEFAULT_BATCH_SIZE, top_k=TOP_K, pool=None, metrics=None, profiler=None,
+            store=None):
+    """
+    Make predictions on a list of images and return the labels and probabilities for the top 3 (or top_k) most likely
     classifications.
 
     This function uses an unmodified version of the ResNet50 model.  It is not intended for real use in a case, it is
@@ -34,45 +439,29 @@ def predict(get_images):
     The results are passed back as a list of tuples - each tuple containing the text label of prediction in position
     0, and the probability score in position 1.
 
-    Images will be processed one at a time.
+    Images will be processed batch_size at a time.  Larger batches make better use of the CPU at the cost of holding
+    more images in memory at once, and of waiting longer before the first results are available.  All results are
+    held until the last image is done - use predict_iter() to act on results as they are made.
 
     :param get_images: This is a callback to get the images to make predictions for.  It should return a list of the
                        images as pillow images, but with no other pre-processing done.  Images should be RGB - and
                        should be shaped as [columns, rows, 3] with the 3 channels in RGB.
                        It would be nice of the implementer make get_images a generator that yields one image at a time
                        instead of making it return all images to be memory-friendly.
-    :return: A list of results.  Each result is a tuple of up to 3 items, each item being the label and score:
-             [..., ( (<label1>, <score1>), (<label2>, <score2>), (<label3>, <score3>) ), ...].  The length of the list
-             matches the number of images returned from the get_images method. If there was an error processing an image
-             that image's results will instead be a tuple with the word "ERROR" in the 0th position, and the exception
-             in the second position: [..., ('ERROR', <ImproperShapeException...>), ...]
-    """
-
-    predictions = []
-    index = 0
-    for img_pixels in get_images():
-        # Resize to required images for the model
-        img_pixels = img_pixels.resize((MODEL_IMG_SIZE, MODEL_IMG_SIZE))
-        img_array = img_to_array(img_pixels)
-        img_array = img_array.reshape((1, img_array.shape[0], img_array.shape[1], img_array.shape[2]))
-
-        results = []
-        try:
-            img_array = preprocess_input(img_array)
-
-            # Predict
-            inference = model.predict(img_array)
-            labels = decode_predictions(inference, top=3)[0]  # Analyzing one image, so just look at first row
-
-            for label in labels:
-                results.append((label[1], label[2]))
-            predictions.append(tuple(results))
-        except Exception as e:
-            print(f"Error in image: {index}")
-            print(f"Error: {e}")
-            predictions.append(('ERROR', e))
-        finally:
-            index += 1
-
-    # Return the predictions
-    return predictions
+    :param batch_size: The number of images to run through the model in a single forward pass.
+    :param top_k: The number of labels to return for each image.  Defaults to the 'top_k' setting, which is 3.
+    :param pool: An optional img_classifier.worker_pool.WorkerPool to run inference on, see predict_iter()
+    :param metrics: An optional img_classifier.metrics.StageMetrics to record stage timings in, see predict_iter()
+    :param profiler: An optional img_classifier.metrics.Profiler to profile sampled batches with, see predict_iter()
+    :param store: An optional img_classifier.store.ProbabilityStore to save the probabilities to, see predict_iter()
+    :return: A list of results.  Each result is a tuple of up to 3 (or top_k) items, each item being the label and
+             score: [..., ( (<label1>, <score1>), (<label2>, <score2>), (<label3>, <score3>) ), ...].  The length of
+             the list matches the number of images returned from the get_images method. If there was an error processing
+             an image that image's results will instead be a tuple with the word "ERROR" in the 0th position, and the
+             exception in the second position: [..., ('ERROR', <ImproperShapeException...>), ...]
+             Results made by the model are Predictions, which also record the name of the model that answered in their
+             model attribute.
+    """
+    inferences = predict_iter(get_images, batch_size=batch_size, top_k=top_k, pool=pool, metrics=metrics,
+                              profiler=profiler, store=store)
+    return [result for _, result in inferences]
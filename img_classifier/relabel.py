@@ -0,0 +1,129 @@
+"""
+Python Version: 3.9
+
+Summary: Recompute the labels of every image in a ProbabilityStore without running the model.
+
+Description:
+Reads the probability vectors saved in a ProbabilityStore (see img_classifier.store) and finds the top k labels for
+each image again - with a different k, a minimum score, or after mapping the ImageNet classes onto a different set of
+categories.  The store is memory-mapped and worked through a chunk of rows at a time, so even millions of images only
+take seconds and little memory.
+
+A taxonomy maps the ImageNet classes onto categories.  It is a JSON file of {<category>: [<ImageNet label>, ...], ...}.
+Each category's score is the sum of the probabilities of its classes, and classes not in any category are ignored.
+
+The labels are written to a JSON file in the same format as the 'results' in the inference.json file made by
+cli.predict_from_folder: {"results": {<key>: [{<label>: "<score>"}, ...], ...}}.  Images with no label above the minimum
+score get an empty list.
+
+Run it from the top of the repository:
+`> python -m img_classifier.relabel C:\\Projects\\RestData\\Store C:\\Projects\\RestData\\relabel.json --top-k 5`
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from img_classifier import labels
+from img_classifier.store import ProbabilityStore
+
+DEFAULT_TOP_K = 3
+DEFAULT_CHUNK_ROWS = 65536  # rows of the store read at a time
+
+
+def load_taxonomy(taxonomy_path, label_table):
+    """
+    Build the matrix that maps the ImageNet classes onto a taxonomy's categories.
+    :param taxonomy_path: Full path to the taxonomy's JSON file
+    :param label_table: The array of ImageNet labels, indexed by class number
+    :return: A tuple: [0] the array of category names, [1] the (classes, categories) float32 matrix that sums each
+             category's class probabilities
+    """
+    with open(taxonomy_path, encoding='utf-8') as taxonomy_file:
+        taxonomy = json.load(taxonomy_file)
+
+    class_numbers = {label: number for number, label in enumerate(label_table)}
+    mapping = np.zeros((len(label_table), len(taxonomy)), dtype=np.float32)
+    for category_number, (category, category_labels) in enumerate(taxonomy.items()):
+        for label in category_labels:
+            if label not in class_numbers:
+                raise ValueError(f'The taxonomy\'s category "{category}" has an unknown ImageNet label "{label}"')
+            mapping[class_numbers[label], category_number] = 1.0
+
+    return np.array(list(taxonomy), dtype=object), mapping
+
+
+def relabel(store, top_k=DEFAULT_TOP_K, min_score=0.0, taxonomy=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Find the top labels of every image in a store.
+    :param store: The ProbabilityStore to read
+    :param top_k: The number of labels to find for each image
+    :param min_score: Labels scoring below this are left out
+    :param taxonomy: An optional (<category names>, <mapping matrix>) tuple from load_taxonomy() to label the images
+                     with categories instead of ImageNet labels
+    :param chunk_rows: The number of rows of the store to work on at a time
+    :return: Yields tuples of (<key>, <tuple of (<label>, <score>) tuples>), in the store's row order
+    """
+    probabilities = store.probabilities
+    keys = store.keys()
+    names, mapping = taxonomy if taxonomy is not None else (None, None)
+
+    for start in range(0, store.rows, chunk_rows):
+        chunk = np.asarray(probabilities[start:start + chunk_rows], dtype=np.float32)
+        if mapping is not None:
+            chunk = chunk @ mapping
+
+        for key, image_labels in zip(keys[start:start + chunk_rows], labels.top_k(chunk, top_k, names)):
+            yield key, tuple((label, score) for label, score in image_labels if score >= min_score)
+
+
+def write_results(output_path, results):
+    """
+    Write the labels to a JSON file in the inference.json results format, one image at a time.
+    :param output_path: Full path to the file to write
+    :param results: An iterable of (<key>, <labels>) tuples, as yielded by relabel()
+    :return: The number of images written
+    """
+    count = 0
+    with open(output_path, mode='w', encoding='utf-8') as output_file:
+        output_file.write('{"results": {')
+        for key, image_labels in results:
+            if count > 0:
+                output_file.write(', ')
+            output_file.write(f'{json.dumps(key)}: ')
+            json.dump([{label: str(score)} for label, score in image_labels], output_file)
+            count += 1
+        output_file.write('}}')
+    return count
+
+
+def main(store_path, output_path, top_k=DEFAULT_TOP_K, min_score=0.0, taxonomy_path=None,
+         chunk_rows=DEFAULT_CHUNK_ROWS):
+    store = ProbabilityStore(store_path)
+    taxonomy = load_taxonomy(taxonomy_path, labels.get_label_table()) if taxonomy_path else None
+
+    start = time.perf_counter()
+    count = write_results(output_path, relabel(store, top_k, min_score, taxonomy, chunk_rows))
+    print(f'Relabelled {count} images from {store_path} in {time.perf_counter() - start:.2f} seconds, '
+          f'saved to {output_path}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='relabel.py',
+                                     description='Recompute the labels of the images in a probability store.')
+    parser.add_argument('store_dir', help='Folder of the probability store')
+    parser.add_argument('output_file', help='JSON file to write the labels to')
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K,
+                        help='Number of labels to find for each image')
+    parser.add_argument('--min-score', type=float, default=0.0,
+                        help='Leave out labels scoring below this')
+    parser.add_argument('--taxonomy',
+                        help='JSON file mapping categories to lists of ImageNet labels, to label with the categories')
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS,
+                        help='Number of images to work on at a time')
+    arguments = parser.parse_args(sys.argv[1:])
+
+    main(arguments.store_dir, arguments.output_file, arguments.top_k, arguments.min_score, arguments.taxonomy,
+         max(1, arguments.chunk_rows))
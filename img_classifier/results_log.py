@@ -0,0 +1,468 @@
+"""
+Python Version: 3.9
+
+Summary: Write classification results to an append-only log, with a small status file that is updated atomically.
+
+Description:
+Rewriting one JSON file holding every result after each image makes a run write O(N^2) bytes, and anyone reading the
+file can catch it half written.  A ResultsLog keeps three files in the output folder instead:
+    inference.jsonl: One line of JSON per image, appended as each result is made and never rewritten:
+                     {"image": <image>, "results": [{<label>: "<score>"}, ...]} or
+                     {"image": <image>, "error": "<error>"}, plus "duplicate_of": <image> for near-duplicates that
+                     inherited a result, and "model": <model> when the model cascade is on.  Each line also has
+                     the identity of the image file it was made for: "size" and "mtime_ns", or "sha256".
+    status.json:     The progress of the run: {"total": <count>, "done": true|false, "progress": <percent>,
+                     "current_item": <count>, "classified": <count>, "error_count": <count>, "skipped": <count>,
+                     "discovering": true|false, "resumed": <count>, "model_id": <model>}, plus any totals added by the
+                     application when the run is done.  While "discovering" is true the files are still being found,
+                     and the total is the number found so far.  It is written to a temporary file which then replaces
+                     the status file, so readers always see a whole file.  Updates are throttled to one every
+                     status_interval seconds, except for the first and the last.
+    inference.json:  The whole run compacted into the single file the application used to write, with "status" and
+                     "results" (and "duplicates" and "models" sections if they are used) - built from the log once the
+                     run is done, for readers that want everything at once.
+
+The status file is only marked done after inference.json has been written, so a reader that waits for done can read
+either file.
+
+The log is also the run's checkpoint.  Each line is flushed as it is written, and the log is synced to disk (os.fsync)
+before each status update, so the progress in the status file is never ahead of what would survive a crash - at the cost
+of one sync every status_interval seconds rather than one per image.  A run opened with resume=True keeps the log it
+finds, drops a last line that was only partly written, and appends to it.  Its results are remembered so
+already_classified() can tell whether an image still needs to be classified: an image is only skipped if it has a
+result (not an error) and the file's identity still matches the one in the log, so files that have changed since are
+classified again.  The identity is either the file's size and modification time (cheap, the 'stat' check) or a hash of
+its content (the 'hash' check, which has to read the file).  When an image is classified again the later line in the
+log replaces the earlier one.  A log made by a different model can't be resumed.
+
+A large folder can be split into shards that are classified at the same time, by processes on one machine or on several
+machines sharing the folder.  Each shard keeps its own log and status file, named for the shard (for example
+inference.shard-0-of-4.jsonl and status.shard-0-of-4.json), and doesn't compact them.  Once every shard is done,
+merge_shards() joins their logs into inference.jsonl, writes inference.json, and then writes a status.json that adds up
+the shards' counts and lists each shard's own status under "shards".
+
+On Windows a file can't be replaced while another process has it open, so a status update that collides with a reader
+is retried briefly and otherwise skipped - the next update will write it.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+
+from img_classifier.cache import digest
+
+LOG_FILENAME = 'inference.jsonl'
+STATUS_FILENAME = 'status.json'
+COMPACT_FILENAME = 'inference.json'
+DEFAULT_STATUS_INTERVAL = 1.0  # seconds between status updates
+REPLACE_ATTEMPTS = 5
+REPLACE_RETRY_DELAY = 0.05  # seconds
+IDENTITY_CHECKS = ('stat', 'hash')
+# The status counts that are added up when shards are merged
+SHARD_COUNTS = ('total', 'current_item', 'classified', 'error_count', 'skipped', 'resumed')
+
+
+def shard_filename(filename, shard=None):
+    """
+    :param filename: The name of one of the files a ResultsLog writes, such as LOG_FILENAME
+    :param shard: The (index, count) of the shard, or None if the folder isn't sharded
+    :return: The name the shard gives the file, for example 'inference.shard-0-of-4.jsonl'
+    """
+    if shard is None:
+        return filename
+    name, extension = os.path.splitext(filename)
+    return f'{name}.shard-{shard[0]}-of-{shard[1]}{extension}'
+
+
+def format_classes(inference):
+    """
+    :param inference: A successful prediction for an image: a tuple of (<label>, <score>) tuples
+    :return: A list of single-entry dicts: [{'<class1>': '<score1>'}, {'<class2>': '<score2>'}, ...]
+    """
+    return [{label: str(score)} for label, score in inference]
+
+
+def make_entry(image, inference, duplicate_of=None, model=None):
+    """
+    Make an image's line of the log.
+    :param image: The image's name
+    :param inference: The image's result from the predictor: its labels, or ('ERROR', <exception>)
+    :param duplicate_of: The name of the image whose result was inherited, if the image is a near-duplicate
+    :param model: The name of the model that classified the image, if it should be recorded
+    :return: The entry as a dict, without the image file's identity
+    """
+    entry = {'image': image}
+    if 'ERROR' == inference[0]:
+        entry['error'] = str(inference[1])
+    else:
+        entry['results'] = format_classes(inference)
+    if duplicate_of is not None:
+        entry['duplicate_of'] = duplicate_of
+    if model is not None:
+        entry['model'] = model
+    return entry
+
+
+def remove_temporary(path):
+    """
+    Remove a temporary file that didn't replace the file it was written for.
+    :param path: Full path to the temporary file
+    :return: Nothing.  A file that was never made, or can't be removed, is left alone.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def write_atomically(path, content):
+    """
+    Write a file so readers either see the old content or the new content, never part of it.  The temporary file is
+    removed whenever it doesn't replace the file, including when an error is raised.
+    :param path: Full path to the file
+    :param content: The text to write
+    :return: True if the file was written, False if it was held open by another process and couldn't be replaced
+    """
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    replaced = False
+    try:
+        with open(temporary_path, mode='w', encoding='utf-8') as temporary_file:
+            temporary_file.write(content)
+
+        for attempt in range(REPLACE_ATTEMPTS):
+            try:
+                os.replace(temporary_path, path)
+                replaced = True
+                break
+            except PermissionError:
+                time.sleep(REPLACE_RETRY_DELAY)
+    finally:
+        if not replaced:
+            remove_temporary(temporary_path)
+    return replaced
+
+
+def file_identity(path, check='stat', image_bytes=None):
+    """
+    Identify the content of an image file, so a result made for it can be checked against the file later.
+    :param path: Full path to the image file
+    :param check: 'stat' to use the file's size and modification time, or 'hash' to use a hash of its content
+    :param image_bytes: The content of the file, if it has already been read.  Only used by the 'hash' check.
+    :return: A dict of the fields identifying the file, to add to its line in the log
+    """
+    if 'hash' == check:
+        if image_bytes is None:
+            with open(path, mode='rb') as image_file:
+                image_bytes = image_file.read()
+        return {'sha256': digest(image_bytes)}
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_log(path):
+    """
+    Read the entries of a results log.  A last line that wasn't completely written (because the writer was stopped part
+    way through it) is skipped.
+    :param path: Full path to the inference.jsonl file
+    :return: Yields each entry as a dict
+    """
+    with open(path, encoding='utf-8') as log_file:
+        for line in log_file:
+            if not line.endswith('\n'):
+                return
+            yield json.loads(line)
+
+
+def compact_log(log_path, compact_path, status, sections=()):
+    """
+    Build the compacted inference.json from a log.
+    :param log_path: Full path to the inference.jsonl file
+    :param compact_path: Full path to the inference.json file to write
+    :param status: The status to include in it
+    :param sections: The optional sections to include: 'duplicates' and/or 'models'
+    :return: False if inference.json was held open by another process and couldn't be replaced, otherwise True
+    """
+    errors = {}
+    results = {}
+    sections = {section: {} for section in sections}
+
+    # An image classified again after resuming has more than one line - the last one replaces the others
+    for entry in read_log(log_path):
+        image = entry['image']
+        if 'error' in entry:
+            errors[image] = f'{image}: {entry["error"]}'
+            results.pop(image, None)
+        else:
+            results[image] = entry['results']
+            errors.pop(image, None)
+        for section, field in (('duplicates', 'duplicate_of'), ('models', 'model')):
+            if section in sections:
+                if field in entry:
+                    sections[section][image] = entry[field]
+                else:
+                    sections[section].pop(image, None)
+
+    output_obj = {'status': dict(status, errors=list(errors.values())), 'results': results}
+    output_obj.update(sections)
+    return write_atomically(compact_path, json.dumps(output_obj))
+
+
+def merge_shards(folder, count, duplicates=False, models=False):
+    """
+    Join the output of a folder's shards into the files an unsharded run writes.  The logs are copied one after the
+    other into inference.jsonl, then inference.json is written, and finally status.json is written marked done.
+    :param folder: The folder the shards wrote their files to
+    :param count: The number of shards
+    :param duplicates: True to include the "duplicates" section in inference.json
+    :param models: True to include the "models" section in inference.json
+    :return: The merged status.  Raises ValueError if a shard isn't done, or the shards were made by different models.
+    """
+    shards = [(index, count) for index in range(count)]
+    statuses = []
+    for shard in shards:
+        try:
+            with open(os.path.join(folder, shard_filename(STATUS_FILENAME, shard)), encoding='utf-8') as status_file:
+                statuses.append(json.load(status_file))
+        except (OSError, ValueError):
+            statuses.append({'done': False})
+    unfinished = [index for index, shard_status in enumerate(statuses) if not shard_status['done']]
+    if len(unfinished) > 0:
+        raise ValueError(f'Shards {unfinished} of {count} in {folder} are not done')
+    model_ids = set(shard_status.get('model_id') for shard_status in statuses)
+    if len(model_ids) > 1:
+        raise ValueError(f'The shards in {folder} were made by different models: {sorted(map(str, model_ids))}')
+
+    log_path = os.path.join(folder, LOG_FILENAME)
+    temporary_path = f'{log_path}.{os.getpid()}.tmp'
+    try:
+        with open(temporary_path, mode='wb') as merged_log:
+            for shard in shards:
+                with open(os.path.join(folder, shard_filename(LOG_FILENAME, shard)), mode='rb') as shard_log:
+                    shutil.copyfileobj(shard_log, merged_log)
+        os.replace(temporary_path, log_path)
+    except BaseException:
+        remove_temporary(temporary_path)
+        raise
+
+    status = {count_name: sum(shard_status.get(count_name, 0) for shard_status in statuses)
+              for count_name in SHARD_COUNTS}
+    status.update({'done': True, 'progress': 100, 'discovering': False, 'model_id': model_ids.pop(),
+                   'shards': statuses})
+    sections = [section for section, used in (('duplicates', duplicates), ('models', models)) if used]
+
+    # Readers wait for these, so keep trying until they are written
+    while not compact_log(log_path, os.path.join(folder, COMPACT_FILENAME), status, sections):
+        time.sleep(REPLACE_RETRY_DELAY)
+    while not write_atomically(os.path.join(folder, STATUS_FILENAME), json.dumps(status)):
+        time.sleep(REPLACE_RETRY_DELAY)
+    return status
+
+
+class ResultsLog:
+    """
+    Writes the results of a run to the files in an output folder, as described above.
+    """
+
+    def __init__(self, folder, total, status_interval=DEFAULT_STATUS_INTERVAL, duplicates=False, models=False,
+                 resume=False, model_id=None, shard=None):
+        """
+        :param folder: The folder to write the files to
+        :param total: The number of files in the run, or None if they are still being found - give the running total to
+                      set_progress() instead
+        :param status_interval: The minimum number of seconds between status updates
+        :param duplicates: True to include the "duplicates" section in inference.json
+        :param models: True to include the "models" section in inference.json
+        :param resume: True to keep an existing log and append to it, rather than starting a new one
+        :param model_id: The identity of the model making the results.  Raises ValueError when resuming a log made by
+                         a different model.
+        :param shard: The (index, count) of the shard of the folder this run classifies, to name its files for
+        """
+        self.folder = folder
+        self.log_path = os.path.join(folder, shard_filename(LOG_FILENAME, shard))
+        self.status_path = os.path.join(folder, shard_filename(STATUS_FILENAME, shard))
+        self.compact_path = os.path.join(folder, COMPACT_FILENAME)
+        self.status_interval = max(0.0, float(status_interval))
+        self.sections = {'duplicates': duplicates, 'models': models}
+
+        self.status = {'total': total or 0, 'done': False, 'progress': 0, 'current_item': 0, 'classified': 0,
+                       'error_count': 0, 'skipped': 0, 'discovering': total is None, 'resumed': 0,
+                       'model_id': model_id}
+        self._last_status = None
+        self._lock = threading.Lock()
+        self._identities = {}
+
+        # The results already in the log, by image, when resuming
+        self.previous = {}
+        if resume and os.path.exists(self.log_path):
+            self._check_model(model_id)
+            self.previous = self._load_previous()
+        self._log = open(self.log_path, mode='a' if resume else 'w', encoding='utf-8')
+        self.write_status(force=True)
+
+    def _check_model(self, model_id):
+        """
+        Make sure the log being resumed was made by the same model, as recorded in its status file.
+        :param model_id: The identity of the model making the results
+        :return: Nothing.  Raises ValueError if the log was made by a different model.
+        """
+        try:
+            with open(self.status_path, encoding='utf-8') as status_file:
+                previous_model = json.load(status_file).get('model_id')
+        except (OSError, ValueError):
+            return
+        if model_id is not None and previous_model is not None and previous_model != model_id:
+            raise ValueError(f'{self.log_path} was made by {previous_model}, not {model_id}.  Run without resuming.')
+
+    def _load_previous(self):
+        """
+        Read the log being resumed, and cut off a last line that wasn't completely written.
+        :return: The last entry in the log for each image, by image
+        """
+        previous = {}
+        complete = 0
+        with open(self.log_path, mode='rb') as log_file:
+            for line in log_file:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                previous[entry['image']] = entry
+                complete += len(line)
+        os.truncate(self.log_path, complete)
+        return previous
+
+    def already_classified(self, image, identity):
+        """
+        Check whether the log being resumed already has a result for the image as it is now.
+        :param image: The image's name
+        :param identity: The image file's identity, from file_identity()
+        :return: True if the image has a result for a file with the same identity, so it doesn't need classifying
+        """
+        entry = self.previous.get(image)
+        if entry is None or 'results' not in entry:
+            return False
+        return all(entry.get(field) == value for field, value in identity.items())
+
+    def set_identity(self, image, identity):
+        """
+        Remember the identity of an image file, to be written with its result.  This can be called from any thread.
+        :param image: The image's name
+        :param identity: The image file's identity, from file_identity()
+        :return: Nothing
+        """
+        self._identities[image] = identity
+
+    def resumed(self, image):
+        """
+        Count an image whose result was kept from the log being resumed.
+        :param image: The image's name
+        :return: Nothing
+        """
+        self.status['resumed'] += 1
+        self.status['classified'] += 1
+
+    def write_status(self, force=False):
+        """
+        Write the status file, unless it was written less than status_interval seconds ago.
+        :param force: True to write it regardless of when it was last written
+        :return: False if the status file was held open by another process and couldn't be replaced, otherwise True
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_status is not None and now - self._last_status < self.status_interval:
+                return True
+            content = json.dumps(self.status)
+            self._last_status = now
+            self.checkpoint()
+        return write_atomically(self.status_path, content)
+
+    def checkpoint(self):
+        """
+        Make sure every line written to the log so far would survive a crash.
+        :return: Nothing
+        """
+        if getattr(self, '_log', None) is not None and not self._log.closed:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def set_progress(self, current_item, total=None, discovering=False):
+        """
+        Record how many files have been read, and update the status file if it is due.
+        :param current_item: The number of files read so far
+        :param total: The number of files found so far, if they are still being found
+        :param discovering: True if more files may still be found
+        :return: Nothing
+        """
+        if total is not None:
+            self.status['total'] = total
+            self.status['discovering'] = discovering
+        total = self.status['total']
+        self.status['current_item'] = current_item
+        self.status['progress'] = int(((current_item - 1) / total) * 100) if total else 0
+        self.write_status()
+
+    def skip(self, image):
+        """
+        Count a file that was left out of the run because it isn't an image.
+        :param image: The file's name
+        :return: Nothing
+        """
+        self.status['skipped'] += 1
+
+    def record(self, image, inference, duplicate_of=None, model=None):
+        """
+        Append an image's result to the log.
+        :param image: The image's name
+        :param inference: The image's result from the predictor: its labels, or ('ERROR', <exception>)
+        :param duplicate_of: The name of the image whose result was inherited, if the image is a near-duplicate
+        :param model: The name of the model that classified the image, if it should be recorded
+        :return: Nothing
+        """
+        entry = {'image': image}
+        entry.update(self._identities.pop(image, {}))
+        entry.update(make_entry(image, inference, duplicate_of, model))
+        if 'error' in entry:
+            self.status['error_count'] += 1
+        else:
+            self.status['classified'] += 1
+
+        self._log.write(json.dumps(entry) + '\n')
+        self._log.flush()
+
+    def compact(self):
+        """
+        Build inference.json from the log.
+        :return: False if inference.json was held open by another process and couldn't be replaced, otherwise True
+        """
+        sections = [section for section, used in self.sections.items() if used]
+        return compact_log(self.log_path, self.compact_path, self.status, sections)
+
+    def finish(self, compact=True, **totals):
+        """
+        Mark the run as done: sync and close the log, write inference.json and then the final status.
+        :param compact: True to write inference.json
+        :param totals: Anything else to add to the status, such as the cache's statistics
+        :return: Nothing
+        """
+        self.close()
+        self.status.update(totals)
+        self.status['done'] = True
+        self.status['discovering'] = False
+        self.status['progress'] = 100
+        # Readers wait for these, so keep trying until they are written
+        while compact and not self.compact():
+            time.sleep(REPLACE_RETRY_DELAY)
+        while not self.write_status(force=True):
+            time.sleep(REPLACE_RETRY_DELAY)
+
+    def close(self):
+        """
+        Close the log file.
+        :return: Nothing
+        """
+        if not self._log.closed:
+            self.checkpoint()
+            self._log.close()
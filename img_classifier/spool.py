@@ -0,0 +1,177 @@
+"""
+Python Version: 3.9
+
+Summary: Watch a spool folder for jobs of images to classify, so a long running classifier can keep its model loaded.
+
+Description:
+Starting a new Python process for every selection of images pays for importing TensorFlow and loading the model each
+time, which takes longer than classifying a small selection.  Instead a classifier can run as a daemon that loads the
+model once and takes jobs from a spool folder:
+    1. The client copies the images into a new folder in the spool, for example <spool>/job-1234
+    2. When every image is in place the client creates the job's ready marker next to it: <spool>/job-1234.ready
+    3. The daemon classifies the job's folder, writing its results into it, then creates the job's done marker:
+       <spool>/job-1234.done.  The done marker is JSON: {"job": <job name>, "error": null or <why the job failed>}
+    4. The client waits for the done marker, reads the results, and removes the job's folder and markers
+
+Jobs are taken in the order they were made ready.  A job with a ready marker but no done marker is still to do, so jobs
+made ready while the daemon wasn't running are picked up when it starts.
+
+On Linux the spool folder is watched with inotify (through ctypes, since the standard library doesn't wrap it), so a
+job is started as soon as its ready marker appears.  Elsewhere, or if inotify can't be used, the folder is checked every
+poll_interval seconds.  Either way the markers are only used to wake the daemon - it looks through the folder for jobs
+to do each time it wakes, so no job is missed if events are lost.
+"""
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import time
+
+from img_classifier.results_log import write_atomically
+
+READY_SUFFIX = '.ready'
+DONE_SUFFIX = '.done'
+DEFAULT_POLL_INTERVAL = 1.0  # seconds
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_BUFFER_SIZE = 64 * 1024
+
+
+class Inotify:
+    """
+    Wakes when a file is created, written or moved into a folder, using Linux's inotify.
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: The folder to watch.  Raises OSError if inotify isn't available or can't watch it.
+        """
+        library = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(library or 'libc.so.6', use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            raise OSError(f'inotify is not available: {e}')
+
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f'inotify_add_watch failed for {folder}')
+
+    def wait(self, timeout):
+        """
+        Wait for something to change in the folder.
+        :param timeout: The most seconds to wait
+        :return: True if something changed, False if the timeout passed first
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return False
+        # The events only wake the spool, which looks through the folder itself, so they are discarded
+        try:
+            while os.read(self.fd, EVENT_BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        """
+        Stop watching the folder.
+        :return: Nothing
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Spool:
+    """
+    The jobs in a spool folder, as described above.
+    """
+
+    def __init__(self, folder, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        """
+        :param folder: The spool folder.  It is created if it doesn't exist.
+        :param poll_interval: The most seconds between looks through the folder for jobs
+        :param use_inotify: True to watch the folder with inotify when it is available, False to only poll it
+        """
+        self.folder = folder
+        self.poll_interval = max(0.01, float(poll_interval))
+        os.makedirs(folder, exist_ok=True)
+
+        self.watcher = None
+        if use_inotify:
+            try:
+                self.watcher = Inotify(folder)
+            except OSError as e:
+                print(f'Polling the spool every {self.poll_interval} seconds: {e}')
+
+    def pending(self):
+        """
+        :return: The names of the jobs that are ready but not done, in the order they were made ready
+        """
+        ready = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith(READY_SUFFIX):
+                    continue
+                job = entry.name[:-len(READY_SUFFIX)]
+                if os.path.exists(os.path.join(self.folder, job + DONE_SUFFIX)):
+                    continue
+                try:
+                    ready.append((entry.stat().st_mtime_ns, job))
+                except OSError:
+                    # Removed by the client since it was listed
+                    continue
+        return [job for _, job in sorted(ready)]
+
+    def wait(self):
+        """
+        Wait until there may be new jobs, or poll_interval seconds have passed.
+        :return: Nothing
+        """
+        if self.watcher is not None:
+            self.watcher.wait(self.poll_interval)
+        else:
+            time.sleep(self.poll_interval)
+
+    def jobs(self):
+        """
+        Wait for jobs and provide them one at a time.  Each job should be marked done with finish() before the next is
+        asked for, or it will be provided again.  This runs until the generator is closed or the process is interrupted.
+        :return: Yields the full path to each job's folder
+        """
+        while True:
+            for job in self.pending():
+                yield os.path.join(self.folder, job)
+            self.wait()
+
+    def finish(self, job_folder, error=None):
+        """
+        Create a job's done marker.
+        :param job_folder: The full path to the job's folder, as provided by jobs()
+        :param error: Why the job failed, or None if it succeeded
+        :return: Nothing
+        """
+        job = os.path.basename(job_folder)
+        marker = {'job': job, 'error': None if error is None else str(error)}
+        while not write_atomically(os.path.join(self.folder, job + DONE_SUFFIX), json.dumps(marker)):
+            time.sleep(self.poll_interval)
+
+    def close(self):
+        """
+        Stop watching the spool folder.
+        :return: Nothing
+        """
+        if self.watcher is not None:
+            self.watcher.close()
@@ -0,0 +1,259 @@
+"""
+Python Version: 3.9
+
+Summary: An append-only, memory-mapped store of each image's full probability vector.
+
+Description:
+The predictor only keeps the top k labels for each image, so asking a different question - more labels, a confidence
+threshold, a mapping onto another taxonomy - means running the model again.  A ProbabilityStore keeps the whole 1000-way
+probability vector for every image the model runs on (and optionally the image's embedding from the model's
+penultimate layer), so those questions can be answered straight from disk (see img_classifier.relabel).
+
+A store is a folder holding:
+    meta.json:         The data type, the number of classes, the embedding width and the model id of the store
+    probabilities.f16: The probability vectors, one row of float16 values per image, with no header
+    embeddings.f16:    The embeddings, one row of float16 values per image, if the store keeps them
+    keys.jsonl:        The key of each row's image, as one JSON string per line, in row order
+
+The data files are plain arrays so they can be appended to a row at a time, and read back with numpy.memmap without
+loading them into memory.  Rows are written before their keys, so if a run is interrupted the files can only be left
+with rows that have no key.  Those rows are dropped when the store is next opened.
+
+Use it by passing a store opened for writing to the predictor's predict_iter(), then open it again for reading:
+    with ProbabilityStore(path, mode='a', model_id=predictor.PROBABILITIES_ID) as store:
+        for key, result in predictor.predict_iter(get_images, store=store):
+            ...
+    store = ProbabilityStore(path)
+    probabilities = store.probabilities  # a (rows, 1000) float16 memmap
+    row = store.index()[key]
+
+Only images the model runs on are stored - results from a PredictionCache, or inherited by near-duplicates, have no
+probabilities to store.  With a cascade, each image's probabilities are from the model that answered for it.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+DTYPE = np.float16
+META_FILE = 'meta.json'
+PROBABILITIES_FILE = 'probabilities.f16'
+EMBEDDINGS_FILE = 'embeddings.f16'
+KEYS_FILE = 'keys.jsonl'
+
+
+class ProbabilityStore:
+    """
+    A folder of probability vectors, and optionally embeddings, keyed by image.
+    """
+
+    def __init__(self, path, mode='r', model_id=None, classes=1000, embeddings=False):
+        """
+        :param path: The folder holding the store.  It is created if opened for appending and it doesn't exist.
+        :param mode: 'r' to read the store, or 'a' to append to it
+        :param model_id: The id of the model making the predictions, when appending: predictor.PROBABILITIES_ID.
+                         Appending to a store made by a different model is an error.
+        :param classes: The number of probabilities for each image, when creating a store
+        :param embeddings: True to keep embeddings as well, when creating a store.  Their width is taken from the first
+                           embeddings appended.  Asking for embeddings when appending to a store made without them is an
+                           error.
+        """
+        if mode not in ('r', 'a'):
+            raise ValueError(f'Unknown store mode "{mode}".  Expected "r" or "a".')
+
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._files = None
+
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                self.meta = json.load(meta_file)
+            if mode == 'a' and model_id is not None and self.meta['model_id'] not in (None, model_id):
+                raise ValueError(f'The store in {path} holds predictions from {self.meta["model_id"]}, not {model_id}')
+            if mode == 'a' and embeddings and not self.meta['embeddings']:
+                raise ValueError(f'The store in {path} was made without embeddings, so they can\'t be added to it.  '
+                                 f'Use a new store to keep embeddings.')
+        elif mode == 'r':
+            raise FileNotFoundError(f'No probability store found in {path}')
+        else:
+            self.meta = {'dtype': np.dtype(DTYPE).name, 'classes': int(classes), 'embeddings': bool(embeddings),
+                         'embedding_width': None, 'model_id': model_id}
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self._write_meta()
+
+        self.rows = self._repair() if mode == 'a' else self._count_rows()
+
+    @property
+    def classes(self):
+        """
+        :return: The number of probabilities stored for each image
+        """
+        return self.meta['classes']
+
+    @property
+    def keeps_embeddings(self):
+        """
+        :return: True if the store keeps embeddings as well as probabilities
+        """
+        return self.meta['embeddings']
+
+    @property
+    def embedding_width(self):
+        """
+        :return: The width of the stored embeddings, or None if the store doesn't keep them or none are stored yet
+        """
+        return self.meta['embedding_width']
+
+    def _write_meta(self):
+        with open(os.path.join(self.path, META_FILE), mode='w') as meta_file:
+            json.dump(self.meta, meta_file, indent=2)
+
+    def _file_rows(self, name, width):
+        file_path = os.path.join(self.path, name)
+        if width is None or not os.path.exists(file_path):
+            return 0
+        return os.path.getsize(file_path) // (width * np.dtype(DTYPE).itemsize)
+
+    def _read_keys(self):
+        keys_path = os.path.join(self.path, KEYS_FILE)
+        if not os.path.exists(keys_path):
+            return []
+        with open(keys_path, encoding='utf-8') as keys_file:
+            keys = []
+            for line in keys_file:
+                if not line.endswith('\n'):
+                    # A key that wasn't completely written
+                    break
+                keys.append(json.loads(line))
+            return keys
+
+    def _count_rows(self):
+        rows = min(len(self._read_keys()), self._file_rows(PROBABILITIES_FILE, self.classes))
+        if self.embedding_width is not None:
+            rows = min(rows, self._file_rows(EMBEDDINGS_FILE, self.embedding_width))
+        return rows
+
+    def _repair(self):
+        # Drop any rows an interrupted run left without a key, or keys without rows
+        rows = self._count_rows()
+        itemsize = np.dtype(DTYPE).itemsize
+        for name, width in ((PROBABILITIES_FILE, self.classes), (EMBEDDINGS_FILE, self.embedding_width)):
+            file_path = os.path.join(self.path, name)
+            if width is not None and os.path.exists(file_path):
+                os.truncate(file_path, rows * width * itemsize)
+
+        keys = self._read_keys()
+        if len(keys) != rows or self._keys_file_has_extra():
+            with open(os.path.join(self.path, KEYS_FILE), mode='w', encoding='utf-8') as keys_file:
+                keys_file.writelines(json.dumps(key) + '\n' for key in keys[:rows])
+        return rows
+
+    def _keys_file_has_extra(self):
+        keys_path = os.path.join(self.path, KEYS_FILE)
+        if not os.path.exists(keys_path) or os.path.getsize(keys_path) == 0:
+            return False
+        with open(keys_path, mode='rb') as keys_file:
+            keys_file.seek(-1, os.SEEK_END)
+            return keys_file.read(1) != b'\n'
+
+    def _open_files(self, with_embeddings):
+        if self._files is None:
+            self._files = {
+                'probabilities': open(os.path.join(self.path, PROBABILITIES_FILE), mode='ab'),
+                'keys': open(os.path.join(self.path, KEYS_FILE), mode='a', encoding='utf-8')
+            }
+        if with_embeddings and 'embeddings' not in self._files:
+            self._files['embeddings'] = open(os.path.join(self.path, EMBEDDINGS_FILE), mode='ab')
+        return self._files
+
+    def append(self, keys, probabilities, embeddings=None):
+        """
+        Add a batch of images to the store.
+        :param keys: The keys of the images
+        :param probabilities: The (len(keys), classes) array of probabilities
+        :param embeddings: The (len(keys), embedding width) array of embeddings.  Required if the store keeps them,
+                           ignored if it doesn't.
+        :return: Nothing
+        """
+        if self.mode != 'a':
+            raise ValueError('The store was not opened for appending')
+        if len(keys) == 0:
+            return
+
+        probabilities = np.ascontiguousarray(probabilities, dtype=DTYPE)
+        if probabilities.shape != (len(keys), self.classes):
+            raise ValueError(f'Expected probabilities of shape {(len(keys), self.classes)}, got {probabilities.shape}')
+
+        with self._lock:
+            if self.keeps_embeddings:
+                if embeddings is None:
+                    raise ValueError('The store keeps embeddings, but none were given')
+                embeddings = np.ascontiguousarray(embeddings, dtype=DTYPE).reshape(len(keys), -1)
+                if self.embedding_width is None:
+                    self.meta['embedding_width'] = embeddings.shape[1]
+                    self._write_meta()
+                elif embeddings.shape[1] != self.embedding_width:
+                    raise ValueError(f'Expected embeddings of width {self.embedding_width}, got {embeddings.shape[1]}')
+
+            files = self._open_files(self.keeps_embeddings)
+            files['probabilities'].write(probabilities.tobytes())
+            files['probabilities'].flush()
+            if self.keeps_embeddings:
+                files['embeddings'].write(embeddings.tobytes())
+                files['embeddings'].flush()
+            files['keys'].writelines(json.dumps(str(key)) + '\n' for key in keys)
+            files['keys'].flush()
+            self.rows += len(keys)
+
+    @property
+    def embeddings(self):
+        """
+        :return: A read-only (rows, embedding width) memmap of the embeddings, or None if the store doesn't keep them
+        """
+        if self.embedding_width is None or self.rows == 0:
+            return None
+        return np.memmap(os.path.join(self.path, EMBEDDINGS_FILE), dtype=DTYPE, mode='r',
+                         shape=(self.rows, self.embedding_width))
+
+    @property
+    def probabilities(self):
+        """
+        :return: A read-only (rows, classes) memmap of the probabilities
+        """
+        if self.rows == 0:
+            return np.empty((0, self.classes), dtype=DTYPE)
+        return np.memmap(os.path.join(self.path, PROBABILITIES_FILE), dtype=DTYPE, mode='r',
+                         shape=(self.rows, self.classes))
+
+    def keys(self):
+        """
+        :return: A list of the images' keys, in row order
+        """
+        return self._read_keys()[:self.rows]
+
+    def index(self):
+        """
+        :return: A dict of each key to its row.  If a key was stored more than once, its last row is used.
+        """
+        return {key: row for row, key in enumerate(self.keys())}
+
+    def close(self):
+        """
+        Close the files being appended to.
+        :return: Nothing
+        """
+        with self._lock:
+            if self._files is not None:
+                for open_file in self._files.values():
+                    open_file.close()
+                self._files = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,243 @@
+"""
+Python Version: 3.9
+
+Summary: A pool of worker processes, each with its own copy of the model, to spread inference over many cores.
+
+Description:
+A single TensorFlow (or ONNX Runtime) process doesn't scale linearly past a certain number of cores - the threads in one
+forward pass start to spend their time waiting on each other.  On large machines it is faster to run several processes,
+each with its own copy of the model and a few threads of its own, and hand each one whole batches.
+
+The WorkerPool starts processes worker processes.  Each one builds the backend chosen in the settings with the given
+number of intra-op and inter-op threads, and can optionally be pinned to its own share of the machine's CPUs so the
+workers don't compete for cores.
+
+The parent process still loads and stages the images (see predictor.stage_batch) and turns the probabilities back into
+labels - the workers only preprocess and run the model.  Batches are dispatched as uint8 pixels, which are a quarter of
+the size of the float32 model input, and results are gathered in the order the batches were submitted.  At most
+max_in_flight batches are outstanding at a time, so the pool never gets far ahead of the images being loaded.
+
+Use it through the predictor's usual entry point:
+    with WorkerPool(processes=4) as pool:
+        for key, result in predictor.predict_iter(get_images, pool=pool):
+            ...
+
+A worker that fails to set up - a missing model file, or a bad backend setting - keeps the error rather than exiting, so
+the pool doesn't restart it over and over.  The error is raised by every batch sent to the worker, and the pool checks a
+worker when it starts so the problem is reported straight away.
+
+CPU pinning uses os.sched_setaffinity on Linux.  On other platforms it uses the psutil package if it is installed, and
+is skipped otherwise.
+"""
+import copy
+import multiprocessing
+import os
+from collections import deque
+
+import numpy as np
+
+from img_classifier import backends
+from img_classifier import cascade
+from img_classifier.buffers import BufferPool
+from img_classifier.config import load_config
+
+# Set in each worker process by initialize_worker()
+_worker_backend = None
+_worker_first_backend = None
+_worker_threshold = 0.0
+_worker_buffers = None
+_worker_error = None
+
+
+def split_cpus(processes):
+    """
+    Divide the CPUs this process may run on between a number of worker processes.
+    :param processes: The number of worker processes
+    :return: A list with one list of CPU numbers per worker
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+
+    if len(cpus) < processes:
+        # Not enough to go around, let the workers share them all
+        return [cpus] * processes
+    return [chunk.tolist() for chunk in np.array_split(np.array(cpus), processes)]
+
+
+def pin_to_cpus(cpus):
+    """
+    Restrict the current process to the given CPUs.
+    :param cpus: A list of CPU numbers
+    :return: True if the process was pinned, False if pinning isn't supported here
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        return True
+
+    try:
+        import psutil
+    except ImportError:
+        return False
+    psutil.Process().cpu_affinity(cpus)
+    return True
+
+
+def worker_index():
+    """
+    :return: The number of the current pool worker, counting from 0.  A worker started to replace one that exited gets
+             the next number.
+    """
+    identity = multiprocessing.current_process()._identity
+    return identity[-1] - 1 if len(identity) > 0 else os.getpid()
+
+
+def initialize_worker(settings, cpu_assignments):
+    """
+    Set up a worker process: pin it to its CPUs if asked, then build its backend (and the cascade's first backend, if
+    the cascade is on).  This is run once in each worker when it starts.  If it fails, the error is kept for
+    check_worker() to raise, rather than letting the worker exit to be restarted with the same problem.
+    :param settings: The classifier settings, with the worker's thread counts filled in
+    :param cpu_assignments: A list of CPU lists, one per worker, or None to leave the workers unpinned.  Workers take
+                            them in turn by their worker_index(), so a replacement worker reuses a list.
+    :return: Nothing
+    """
+    global _worker_backend, _worker_first_backend, _worker_threshold, _worker_buffers, _worker_error
+
+    try:
+        if cpu_assignments is not None:
+            cpus = cpu_assignments[worker_index() % len(cpu_assignments)]
+            if not pin_to_cpus(cpus):
+                print(f'Worker {os.getpid()}: CPU pinning is not supported on this platform')
+
+        _worker_backend = backends.create_backend(settings)
+        if cascade.is_enabled(settings):
+            _worker_first_backend = backends.create_backend(cascade.first_settings(settings))
+            _worker_threshold = float(settings['cascade']['threshold'])
+        _worker_buffers = BufferPool(settings['image_shape'])
+    except Exception as e:
+        _worker_error = f'{type(e).__name__}: {e}'
+        print(f'Worker {os.getpid()} could not be set up: {_worker_error}')
+
+
+def check_worker():
+    """
+    Make sure the worker process was set up.  This is run in a worker process.
+    :return: Nothing.  Raises RuntimeError with the reason if initialize_worker() failed.
+    """
+    if _worker_error is not None:
+        raise RuntimeError(f'The worker process could not be set up: {_worker_error}')
+
+
+def run_batch(pixels):
+    """
+    Preprocess and run a batch of pixels through the worker's backend, or its cascade.  This is run in a worker process.
+    :param pixels: A uint8 array of shape (count, rows, columns, 3) of RGB pixels
+    :return: The result of cascade.classify(): a tuple of the (count, classes) array of probabilities, and which images
+             the main backend answered (None if there is no cascade).  Raises RuntimeError if the worker couldn't be set
+             up.
+    """
+    check_worker()
+    with _worker_buffers.acquire(len(pixels)) as buffer:
+        return cascade.classify(pixels, buffer.inputs, _worker_backend, _worker_first_backend, _worker_threshold)
+
+
+class WorkerPool:
+    """
+    A pool of processes, each running its own copy of the model.
+    """
+
+    def __init__(self, processes, intra_op_threads=1, inter_op_threads=1, pin_cpus=False, max_in_flight=None,
+                 image_shape=(224, 224, 3), settings=None):
+        """
+        :param processes: The number of worker processes
+        :param intra_op_threads: Threads each worker uses inside a single operation
+        :param inter_op_threads: Threads each worker uses to run independent operations at the same time
+        :param pin_cpus: If True, each worker is pinned to its own share of the available CPUs
+        :param max_in_flight: The most batches submitted to the pool without their results being collected.  Defaults
+                              to twice the number of processes, which keeps every worker busy.
+        :param image_shape: The shape of a single image: (rows, columns, 3)
+        :param settings: The classifier settings to build the workers' backends with.  Defaults to config.json.
+        """
+        self.processes = max(1, int(processes))
+        self.max_in_flight = max(1, int(max_in_flight or self.processes * 2))
+
+        worker_settings = copy.deepcopy(settings or load_config())
+        worker_settings['image_shape'] = tuple(image_shape)
+        for runtime in ('keras', 'onnx'):
+            worker_settings[runtime]['intra_op_threads'] = int(intra_op_threads)
+            worker_settings[runtime]['inter_op_threads'] = int(inter_op_threads)
+
+        # Spawn rather than fork so the workers don't inherit a half-initialized TensorFlow from the parent
+        context = multiprocessing.get_context('spawn')
+        cpu_assignments = split_cpus(self.processes) if pin_cpus else None
+
+        self._pool = context.Pool(self.processes, initializer=initialize_worker,
+                                  initargs=(worker_settings, cpu_assignments))
+        try:
+            # Every worker is set up the same way, so one that failed means the settings are wrong
+            self._pool.apply(check_worker)
+        except Exception:
+            self._pool.terminate()
+            self._pool.join()
+            raise
+
+    def map_batches(self, batches):
+        """
+        Run batches of pixels through the workers, keeping up to max_in_flight batches in progress at once.
+        :param batches: An iterable of tuples: [0] anything the caller wants passed back with the batch's result,
+                        [1] a uint8 array of RGB pixels for the batch
+        :return: Yields tuples of (<the batch's [0] item>, <the result of run_batch(), or the exception raised>) in the
+                 same order the batches were provided.  Empty batches are not sent to the workers and their results are
+                 None.
+        """
+        pending = deque()
+        batch_iter = iter(batches)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.max_in_flight:
+                try:
+                    context, pixels = next(batch_iter)
+                except StopIteration:
+                    exhausted = True
+                else:
+                    # Nothing to run for an empty batch, but it keeps its place in the results
+                    result = self._pool.apply_async(run_batch, (pixels,)) if len(pixels) > 0 else None
+                    pending.append((context, result))
+
+            if len(pending) == 0:
+                return
+
+            context, result = pending.popleft()
+            if result is None:
+                yield context, None
+                continue
+
+            try:
+                outcome = result.get()
+            except Exception as e:
+                outcome = e
+            yield context, outcome
+
+    def run(self, pixels):
+        """
+        Run a single batch of pixels through a worker and wait for the result.
+        :param pixels: A uint8 array of RGB pixels
+        :return: The result of run_batch() for the batch
+        """
+        return self._pool.apply(run_batch, (pixels,))
+
+    def close(self):
+        """
+        Stop the worker processes.
+        :return: Nothing
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -9,40 +9,242 @@ Description:
 This application wraps the img_classifier module into a Flask microservice so the prediction can be accessed as a
 service without the client needing to configure a Python environment.  It exposed two endpoints:
 
-GET /health: Check the service is running.  Returns 200: success: True.
+GET /health: Check the service is running.  Returns 200: success: True, along with the state of the model and how long
+             it took to load and warm up: {'success': True, 'model': {'state': 'loading', 'load_seconds': None, ...}}
+
+GET /ready: Check the model is loaded and warmed up.  Returns 200 when the service can make predictions, or 503 while
+            the model is still loading (or if it failed to load).
+
+GET /metrics: The time spent in each stage of classifying the images so far (decode, resize, stage, preprocess,
+              inference and topk) and the sizes of the batches run through the model.  See img_classifier.metrics.
 
 POST /predict/<image_guid>: Get the top 3 predictions and their scores for the provided image.  The image binary
                             needs to be provided as part of a MultiPart Form File Upload request body.  Returns
                             a JSON with the results in the format:
                             { 'results': { '<image_guid>': [{'<class1>': <score1>}, {'<class2>': <score2>}, ...]}}
 
+POST /predict: Get the top 3 predictions for a number of images in one request.  Each image is provided as a file in a
+               MultiPart Form File Upload request body, using the image's GUID as the form field name.  The results are
+               streamed back as each image is classified, as newline delimited JSON - one line per image:
+               {"guid": "<image_guid>", "results": [{"<class1>": <score1>}, ...], "model": "<model that answered>"}
+               The model is left out for results that came from the prediction cache.  If the image is a
+               near-duplicate of another image in the request and near-duplicate skipping is on in the 'dedupe'
+               settings, it inherits that image's result and the line also has "duplicate_of": "<other image_guid>".
+               If the image could not be classified:
+               {"guid": "<image_guid>", "error": "<error message>"}
+
 The application requires Flask to be configured properly.  It uses the FLASK_RUN_PORT environment variable to setup the
 HTTP port used for the service.  The FLASK_APP environment variable should be set to 'microservice.predict_service'
 before running Flask.
 
+Results are cached by the content of the image in a local SQLite database, so duplicate images are only classified
+once.  The CLASSIFIER_CACHE_PATH environment variable sets where the database is kept (set it to an empty value to turn
+the cache off), and CLASSIFIER_CACHE_MAX_ENTRIES sets how many results it holds.
+
+On machines with many cores, set the 'processes' value in the 'pool' section of the classifier settings in config.json
+to run the POST /predict endpoint's batches on that many worker processes, each with its own copy of the model (see
+img_classifier.worker_pool).  The single image endpoint, /health and /ready keep using the model in the service's own
+process.
+
+To profile the service, set the CLASSIFIER_PROFILE_RATE environment variable to the fraction of batches to profile (0.01
+profiles 1 in 100).  The profile is saved to the file named by CLASSIFIER_PROFILE_PATH after each sampled batch.  Set
+CLASSIFIER_PROFILER to 'pyinstrument' to use pyinstrument instead of cProfile.
+
+The model is loaded and warmed up on a background thread when the application starts, so the health check can answer
+right away.  Predictions requested before the model is ready will wait for it to finish loading.
+
 The Python environment this Flask application runs it should also be configred to be able to run the img_classifier
 module - it should have Keras and TensorFlow, and the application should be run from the top of the repository
 so that both the microservice and img_classifier packages are found.
 """
-from flask import Flask, request
+from flask import Flask, Response, request
 
 import json
+import os
 from io import BytesIO, BufferedReader
+from threading import Thread
 
-from PIL import Image
-
+from img_classifier import decoder
+from img_classifier import dedupe
+from img_classifier import pipeline
 from img_classifier import predictor
+from img_classifier.cache import PredictionCache, DEFAULT_CACHE_PATH, DEFAULT_MAX_ENTRIES
+from img_classifier.metrics import Profiler, StageMetrics, timed
+from img_classifier.worker_pool import WorkerPool
 
 app = Flask(__name__)
 
+# Decodes uploads straight to about the size the model needs, as set in the 'decoder' settings
+decode_image = decoder.from_settings(predictor.settings, (predictor.MODEL_IMG_SIZE, predictor.MODEL_IMG_SIZE))
+
+# Results are cached by image content so duplicate images aren't classified twice.  Set the CLASSIFIER_CACHE_PATH
+# environment variable to an empty value to turn the cache off.
+cache_path = os.environ.get('CLASSIFIER_CACHE_PATH', DEFAULT_CACHE_PATH)
+cache_max_entries = int(os.environ.get('CLASSIFIER_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+cache = PredictionCache(cache_path, predictor.MODEL_ID, cache_max_entries) if cache_path else None
+
+# Stage timings for every request, reported by /metrics.  Profiling is off unless CLASSIFIER_PROFILE_RATE is set.
+stage_metrics = StageMetrics()
+profile_rate = float(os.environ.get('CLASSIFIER_PROFILE_RATE', 0))
+profiler = None
+if profile_rate > 0:
+    profiler = Profiler(profile_rate, os.environ.get('CLASSIFIER_PROFILE_PATH', 'predict_service.prof'),
+                        engine=os.environ.get('CLASSIFIER_PROFILER', 'cprofile'))
+
+# Near-duplicate images in a request can inherit each other's results, as set in the 'dedupe' section of the settings
+dedupe_settings = predictor.settings['dedupe']
+
+# Optionally run multi-image requests on a pool of worker processes, as set in the 'pool' section of the settings
+pool_settings = predictor.settings['pool']
+worker_pool = None
+if int(pool_settings['processes']) > 0:
+    worker_pool = WorkerPool(pool_settings['processes'], intra_op_threads=pool_settings['intra_op_threads'],
+                             inter_op_threads=pool_settings['inter_op_threads'], pin_cpus=pool_settings['pin_cpus'])
+
+
+def load_model():
+    """
+    Load and warm up the prediction model.  This is run on a background thread so the service can respond to health
+    checks while the model loads.
+    :return: Nothing
+    """
+    try:
+        timings = predictor.warm_up()
+        print(f'Model ready: {timings}')
+    except Exception as e:
+        print(f'Model failed to load: {e}')
+
+
+Thread(target=load_model, name='Model Loader', daemon=True).start()
+
 
 @app.route('/health', methods=['GET'])
 def hello():
     """
-    Simple health check.
-    :return: JSON with {success: True}
+    Simple health check.  This answers as soon as the service is up, whether the model is loaded or not.
+    :return: JSON with {success: True, model: {state: <model state>, load_seconds: <time>, warm_up_seconds: <time>},
+             cache: {hits: <count>, misses: <count>, entries: <count>}}.  The cache is left out if it is turned off.
     """
-    return json.dumps({'success': True})
+    health = {'success': True, 'model': predictor.model.timings()}
+    if cache is not None:
+        health['cache'] = cache.stats()
+    return json.dumps(health)
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness check.  The service is ready when the model has been loaded and warmed up.
+    :return: JSON with {ready: True|False, model: <model state and timings>}.  The status is 200 when ready, or 503
+             when not.
+    """
+    timings = predictor.model.timings()
+    if predictor.model.is_ready:
+        return json.dumps({'ready': True, 'model': timings}), 200
+    else:
+        return json.dumps({'ready': False, 'model': timings}), 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Report the time spent in each stage of the classification, totalled over every request since the service started.
+    :return: JSON with {stages: {<stage>: {calls: <count>, images: <count>, total_seconds: <time>, ms_per_image: <time>,
+             max_call_ms: <time>}, ...}, batches: {count: <count>, images: <count>, mean_size: <size>,
+             max_size: <size>}}, plus profile: {path: <file>, samples: <count>} if profiling is turned on.
+    """
+    report = stage_metrics.summary()
+    if profiler is not None:
+        report['profile'] = {'path': profiler.output_path, 'samples': profiler.samples}
+    return json.dumps(report)
+
+
+def open_image(image_bytes):
+    """
+    Translate the bytes of an uploaded image file to an RGB PIL image.  The image is decoded straight to about the size
+    the model needs, as set in the 'decoder' settings.
+    :param image_bytes: The content of the uploaded file
+    :return: The image as an RGB PIL image
+    """
+    with timed(stage_metrics, 'decode'):
+        return decode_image(BytesIO(image_bytes))
+
+
+def format_classes(inference):
+    """
+    Turn a successful prediction into the list of classes returned to the client.
+    :param inference: The prediction made for one image
+    :return: A list of single-entry dicts: [{'<class1>': '<score1>'}, {'<class2>': '<score2>'}, ...]
+    """
+    return [{label: str(score)} for label, score in inference]
+
+
+@app.route('/predict', methods=['POST'])
+def predict_many():
+    """
+    Run predictions on all the images uploaded in the request.  Each image should be a file in a MultiPart Form File
+    Upload, with the image's GUID as the field name.  Results are streamed back to the client as each image is done.
+    :return: Newline delimited JSON, one line per image, in the format:
+             {"guid": "<image_guid>", "results": [{"<class1>": <score1>}, ...]}
+             or {"guid": "<image_guid>", "error": "<error message>"} if the image could not be classified.
+    """
+    if len(request.files) == 0:
+        return {'error': 'No image files provided.'}, 400
+
+    # Read the uploads now - the files are not available once the response starts streaming
+    uploads = [(image_guid, image_file.filename, image_file.stream.read())
+               for image_guid, image_file in request.files.items()]
+
+    def load_upload(upload):
+        # Decode and resize an upload, run on the prefetch pipeline's worker threads
+        image_guid, filename, image_bytes = upload
+        if cache is not None:
+            cached = cache.lookup(image_guid, image_bytes)
+            if cached is not None:
+                print(f'{image_guid} = {filename}: cached')
+                return cached
+
+        image_pixels = open_image(image_bytes)
+        print(f'{image_guid} = {filename}: {image_pixels.size}')
+        with timed(stage_metrics, 'resize'):
+            return predictor.resize_image(image_pixels)
+
+    def get_images():
+        # The generator for the predictor operation - yields each uploaded image along with its GUID.  Images that
+        # can't be opened are passed along as the error so they are reported with the rest of the results.
+        for upload, image_pixels in pipeline.prefetch(uploads, load_upload):
+            yield upload[0], image_pixels
+
+    def get_inferences():
+        # Near-duplicates are only looked for within the request
+        predict_arguments = {'pool': worker_pool, 'metrics': stage_metrics, 'profiler': profiler}
+        if dedupe_settings['enabled']:
+            index = dedupe.NearDuplicateIndex(dedupe_settings['max_distance'], dedupe_settings['hash_size'])
+            yield from dedupe.predict_iter(get_images, index, **predict_arguments)
+        else:
+            for image_guid, inference in predictor.predict_iter(get_images, **predict_arguments):
+                yield image_guid, inference, None
+
+    def stream_results():
+        for image_guid, inference, representative in get_inferences():
+            if cache is not None:
+                # A result inherited from a near-duplicate wasn't made from this image's content, so isn't cached
+                if representative is None:
+                    cache.record(image_guid, inference)
+                else:
+                    cache.forget(image_guid)
+
+            if 'ERROR' == inference[0]:
+                line = {'guid': image_guid, 'error': str(inference[1])}
+            else:
+                line = {'guid': image_guid, 'results': format_classes(inference)}
+            if representative is not None:
+                line['duplicate_of'] = representative
+            if getattr(inference, 'model', None) is not None:
+                line['model'] = inference.model
+            yield json.dumps(line) + '\n'
+
+    return Response(stream_results(), mimetype='application/x-ndjson')
 
 
 @app.route('/predict/<image_guid>', methods=['POST'])
@@ -67,18 +269,22 @@ def predict(image_guid):
     def get_image_for_pil():
         # Translate the image to PIL format and return it to the caller
         # This is the generator for the predictor operation.
-
         image_bytes = image_file.stream.read()
-        image_mem = BytesIO()
-        image_mem.write(image_bytes)
+        if cache is not None:
+            cached = cache.lookup(image_guid, image_bytes)
+            if cached is not None:
+                print(f'{image_guid} = {image_file.filename}: cached')
+                return [(image_guid, cached)]
 
-        image_pixels = Image.open(image_mem).convert('RGB')
+        image_pixels = open_image(image_bytes)
         print(f'{image_guid} = {image_file.filename}: {image_pixels.size}')
-        return [image_pixels]
+        return [(image_guid, image_pixels)]
 
     # Doing just one image at a time
-    inference = predictor.predict(get_image_for_pil)[0]
+    inference = predictor.predict(get_image_for_pil, metrics=stage_metrics, profiler=profiler)[0]
     print(f'Inference Return: {inference}')
+    if cache is not None:
+        cache.record(image_guid, inference)
 
     # if an error
     if 'ERROR' == inference[0]:
@@ -86,9 +292,7 @@ def predict(image_guid):
         return {'error': inference[1]}, 500
     else:
         # Handle success
-        image_classes = []
-        for results in inference:
-            image_classes.append({results[0]: str(results[1])})
+        image_classes = format_classes(inference)
 
         results = {'results': {image_guid: image_classes}}
         print(f'{results}')
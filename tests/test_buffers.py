@@ -0,0 +1,110 @@
+"""
+Python Version: 3.9
+
+Summary: Check that the predictor's batches reuse their preallocated buffers, so memory stays flat from batch to batch.
+
+Description:
+The model is replaced by a stub backend that returns fixed probabilities, so these run without TensorFlow or a model
+download, and the ImageNet label table is replaced by generated labels.  Run with:
+    python -m pytest tests
+"""
+import tracemalloc
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from img_classifier import labels
+from img_classifier import predictor
+from img_classifier.buffers import BufferPool
+
+BATCH_SIZE = 8
+BATCHES = 20
+IMAGE_SHAPE = (predictor.MODEL_IMG_SIZE, predictor.MODEL_IMG_SIZE, 3)
+# A quarter of one batch's float32 input tensor, so reallocating the buffer for any batch fails the check
+MAX_GROWTH = BATCH_SIZE * int(np.prod(IMAGE_SHAPE)) * np.dtype(np.float32).itemsize // 4
+
+
+class StubBackend:
+    """
+    Stands in for a model: every image gets the same probabilities.
+    """
+    preprocessing = 'caffe'
+
+    def __init__(self):
+        self.probabilities = np.full((BATCH_SIZE, labels.CLASS_COUNT), 1.0 / labels.CLASS_COUNT, dtype=np.float32)
+        self.probabilities[:, 0] = 0.5
+
+    def predict_on_batch(self, inputs):
+        return self.probabilities[:len(inputs)]
+
+
+@pytest.fixture
+def label_table(monkeypatch):
+    table = np.array([f'class {index}' for index in range(labels.CLASS_COUNT)], dtype=object)
+    monkeypatch.setattr(labels, '_label_table', table)
+    return table
+
+
+def make_batch():
+    return [(f'image-{position}', Image.new('RGB', IMAGE_SHAPE[:2], (position, position, position)))
+            for position in range(BATCH_SIZE)]
+
+
+def test_buffer_pool_reuses_buffers():
+    pool = BufferPool(IMAGE_SHAPE)
+    with pool.acquire(BATCH_SIZE) as first:
+        pixels, inputs = first.pixels, first.inputs
+
+    with pool.acquire(BATCH_SIZE) as second:
+        assert second.pixels is pixels
+        assert second.inputs is inputs
+
+    # A smaller batch fits in the same buffer
+    with pool.acquire(BATCH_SIZE // 2) as smaller:
+        assert smaller.pixels is pixels
+        assert smaller.inputs is inputs
+
+
+def test_buffer_pool_does_not_share_buffers():
+    pool = BufferPool(IMAGE_SHAPE)
+    with pool.acquire(BATCH_SIZE) as first, pool.acquire(BATCH_SIZE) as second:
+        assert first.pixels is not second.pixels
+        assert first.inputs is not second.inputs
+
+
+def test_predict_batch_memory_is_flat(label_table):
+    backend = StubBackend()
+    batch = make_batch()
+
+    # The first batch allocates the pooled buffer, and anything else that is only made once
+    results = predictor.predict_batch(batch, backend)
+    assert [result[0][0] for result in results] == ['class 0'] * BATCH_SIZE
+
+    tracemalloc.start()
+    try:
+        predictor.predict_batch(batch, backend)
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for _ in range(BATCHES):
+            predictor.predict_batch(batch, backend)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert current - baseline < MAX_GROWTH
+    assert peak - baseline < MAX_GROWTH
+
+
+def test_predict_batch_reuses_the_same_arrays(label_table):
+    backend = StubBackend()
+    batch = make_batch()
+    predictor.predict_batch(batch, backend)
+
+    with predictor.buffer_pool.acquire(BATCH_SIZE) as buffer:
+        pixels, inputs = buffer.pixels, buffer.inputs
+    for _ in range(3):
+        predictor.predict_batch(batch, backend)
+    with predictor.buffer_pool.acquire(BATCH_SIZE) as buffer:
+        assert buffer.pixels is pixels
+        assert buffer.inputs is inputs
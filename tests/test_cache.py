@@ -0,0 +1,96 @@
+"""
+Summary: Check the prediction cache's lookups, records and least recently used eviction.
+"""
+import itertools
+import os
+import sqlite3
+
+from img_classifier import cache as cache_module
+from img_classifier.cache import PredictionCache
+
+RESULT = (('tabby', 0.75), ('tiger cat', 0.125))
+
+
+def open_cache(tmp_path, model_id='model', max_entries=100):
+    return PredictionCache(os.path.join(str(tmp_path), 'predictions.sqlite'), model_id, max_entries)
+
+
+def test_record_then_lookup(tmp_path):
+    cache = open_cache(tmp_path)
+    assert cache.lookup('a.jpg', b'image') is None
+    cache.record('a.jpg', RESULT)
+
+    # Any copy of the same content is a hit, whatever its key
+    assert cache.lookup('copy of a.jpg', b'image') == RESULT
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'errors': 0, 'entries': 1}
+    cache.close()
+
+
+def test_results_are_kept_between_runs_for_the_same_model(tmp_path):
+    cache = open_cache(tmp_path)
+    cache.lookup('a.jpg', b'image')
+    cache.record('a.jpg', RESULT)
+    cache.close()
+
+    assert open_cache(tmp_path).lookup('a.jpg', b'image') == RESULT
+    assert open_cache(tmp_path, model_id='other model').lookup('a.jpg', b'image') is None
+
+
+def test_errors_forgotten_and_unlooked_images_are_not_recorded(tmp_path):
+    cache = open_cache(tmp_path)
+    cache.record('never looked up', RESULT)
+    cache.lookup('failed.jpg', b'broken')
+    cache.record('failed.jpg', ('ERROR', ValueError('bad image')))
+    cache.lookup('inherited.jpg', b'near-duplicate')
+    cache.forget('inherited.jpg')
+    cache.record('inherited.jpg', RESULT)
+
+    assert cache.stats()['entries'] == 0
+    assert cache.lookup('again', b'broken') is None
+    assert cache.lookup('again', b'near-duplicate') is None
+
+
+def test_copies_that_missed_together_add_one_entry(tmp_path):
+    cache = open_cache(tmp_path)
+    for key in ('a.jpg', 'b.jpg', 'c.jpg'):
+        cache.lookup(key, b'same content')
+    for key in ('a.jpg', 'b.jpg', 'c.jpg'):
+        cache.record(key, RESULT)
+    assert cache.stats()['entries'] == 1
+
+
+def test_least_recently_used_are_evicted(tmp_path, monkeypatch):
+    # A clock that always moves on, so no two uses share a time
+    clock = itertools.count()
+    monkeypatch.setattr(cache_module.time, 'time', lambda: float(next(clock)))
+    cache = open_cache(tmp_path, max_entries=10)
+    for number in range(10):
+        cache.lookup(number, bytes([number]))
+        cache.record(number, RESULT)
+    # Use the oldest entry, so it is no longer the least recently used
+    assert cache.lookup('again', bytes([0])) == RESULT
+
+    cache.lookup(10, bytes([10]))
+    cache.record(10, RESULT)
+
+    # One tenth of the entries are evicted to make room
+    assert cache.stats()['entries'] == 9
+    assert cache.lookup('again', bytes([0])) == RESULT
+    assert cache.lookup('again', bytes([10])) == RESULT
+    assert cache.lookup('again', bytes([1])) is None
+    assert cache.lookup('again', bytes([2])) is None
+
+
+def test_a_locked_database_is_counted_not_raised(tmp_path):
+    cache = open_cache(tmp_path)
+    cache._connection.execute('PRAGMA busy_timeout = 10')
+    other = sqlite3.connect(cache.path, timeout=0)
+    other.execute('BEGIN IMMEDIATE')
+    try:
+        cache.lookup('a.jpg', b'image')
+        cache.record('a.jpg', RESULT)
+    finally:
+        other.rollback()
+        other.close()
+    assert cache.stats()['errors'] == 1
+    assert cache.stats()['entries'] == 0
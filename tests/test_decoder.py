@@ -0,0 +1,62 @@
+"""
+Summary: Check that decoded images are turned upright by their EXIF orientation, and are decoded big enough.
+"""
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from img_classifier import decoder
+
+RED = (255, 0, 0)
+BLUE = (0, 0, 255)
+
+
+def make_jpeg(orientation=None, size=(800, 400)):
+    """
+    :return: The bytes of a JPEG whose left half is red and right half blue, as stored
+    """
+    img = Image.new('RGB', size, BLUE)
+    img.paste(RED, (0, 0, size[0] // 2, size[1]))
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[decoder.ORIENTATION_TAG] = orientation
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=95, exif=exif.tobytes())
+    return output.getvalue()
+
+
+def is_close(pixel, colour):
+    return all(abs(channel - expected) < 40 for channel, expected in zip(pixel, colour))
+
+
+def test_an_upright_image_is_unchanged():
+    img = decoder.decode(BytesIO(make_jpeg()), target_size=(100, 100))
+    assert img.size[0] > img.size[1]
+    assert is_close(img.getpixel((img.size[0] // 8, img.size[1] // 2)), RED)
+
+
+@pytest.mark.parametrize('orientation, top_colour', [(6, RED), (8, BLUE)])
+def test_sideways_images_are_turned_upright(orientation, top_colour):
+    # Stored on its side: turned a quarter clockwise (6) the stored left edge ends up at the top, anticlockwise (8)
+    # the stored right edge does
+    img = decoder.decode(BytesIO(make_jpeg(orientation)), target_size=(100, 100))
+    assert img.size[1] > img.size[0]
+    assert is_close(img.getpixel((img.size[0] // 2, img.size[1] // 8)), top_colour)
+
+
+def test_upside_down_images_are_turned_upright():
+    img = decoder.decode(BytesIO(make_jpeg(3)), target_size=(100, 100))
+    assert is_close(img.getpixel((img.size[0] // 8, img.size[1] // 2)), BLUE)
+
+
+def test_orientation_can_be_turned_off():
+    img = decoder.decode(BytesIO(make_jpeg(6)), target_size=(100, 100), orientation=False)
+    assert img.size[0] > img.size[1]
+
+
+def test_draft_decodes_at_least_the_target_size():
+    img = decoder.decode(BytesIO(make_jpeg(6)), target_size=(100, 100))
+    # Smaller than the stored image, but never smaller than the target, once turned upright
+    assert img.size[0] >= 100 and img.size[1] >= 100
+    assert img.size[1] < 800
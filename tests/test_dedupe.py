@@ -0,0 +1,113 @@
+"""
+Summary: Check the BK-tree's search, and that near-duplicates inherit their representative's result.
+
+Description:
+The model is replaced by a fake predictor.predict_iter() that answers a batch at a time, like the real one, so results
+come back some time after their images were taken.  Images are plain colours with a pattern drawn on them, and
+near-duplicates are the same picture with a pixel changed.
+"""
+import itertools
+import random
+
+import pytest
+from PIL import Image
+
+from img_classifier import dedupe
+from img_classifier import predictor
+
+
+def make_image(seed, changed=False):
+    generator = random.Random(seed)
+    img = Image.new('RGB', (64, 64))
+    img.putdata([(generator.randrange(256),) * 3 for _ in range(64 * 64)])
+    img = img.resize((9, 8), Image.BOX).resize((64, 64), Image.NEAREST)
+    if changed:
+        img.putpixel((0, 0), (0, 0, 0))
+    return img
+
+
+class FakePredictor:
+    """
+    Stands in for predictor.predict_iter(): each image's result names its key, except for the keys set to fail.
+    """
+
+    def __init__(self, fail=(), batch_size=3):
+        self.fail = set(fail)
+        self.batch_size = batch_size
+        self.classified = []
+
+    def predict_iter(self, get_images, **predict_arguments):
+        images = iter(get_images())
+        while True:
+            batch = list(itertools.islice(images, self.batch_size))
+            if len(batch) == 0:
+                return
+            for key, img_pixels in batch:
+                self.classified.append(key)
+                if key in self.fail:
+                    yield key, ('ERROR', ValueError(f'{key} failed'))
+                else:
+                    yield key, ((f'label of {key}', 0.9),)
+
+
+@pytest.fixture
+def fake_predictor(monkeypatch):
+    fake = FakePredictor()
+    monkeypatch.setattr(predictor, 'predict_iter', fake.predict_iter)
+    return fake
+
+
+def test_bk_tree_search_matches_brute_force():
+    generator = random.Random(1)
+    hashes = [generator.getrandbits(16) for _ in range(300)]
+    tree = dedupe.BKTree()
+    for position, item_hash in enumerate(hashes):
+        tree.add(item_hash, position)
+
+    for item_hash in hashes[:30] + [generator.getrandbits(16) for _ in range(30)]:
+        expected = sorted((dedupe.hamming_distance(item_hash, other), position)
+                          for position, other in enumerate(hashes)
+                          if dedupe.hamming_distance(item_hash, other) <= 3)
+        assert sorted(tree.search(item_hash, 3)) == expected
+
+
+def test_near_duplicates_inherit_in_order(fake_predictor):
+    images = [('a', make_image(1)), ('b', make_image(2)), ('a2', make_image(1, changed=True)), ('c', make_image(3)),
+              ('b2', make_image(2, changed=True))]
+    results = list(dedupe.predict_iter(lambda: images))
+
+    assert [key for key, _, _ in results] == ['a', 'b', 'a2', 'c', 'b2']
+    assert dict((key, representative) for key, _, representative in results) == \
+        {'a': None, 'b': None, 'a2': 'a', 'c': None, 'b2': 'b'}
+    assert results[2][1] == results[0][1]
+    assert fake_predictor.classified == ['a', 'b', 'c']
+
+
+def test_reused_index_gives_earlier_results(fake_predictor):
+    index = dedupe.NearDuplicateIndex()
+    list(dedupe.predict_iter(lambda: [make_image(1), make_image(2)], index))
+
+    # Every image is a near-duplicate of the first call's, and the keys are positions again
+    results = list(dedupe.predict_iter(lambda: [make_image(2, changed=True), make_image(1, changed=True)], index))
+    assert results == [(0, (('label of 1', 0.9),), 1), (1, (('label of 0', 0.9),), 0)]
+    assert fake_predictor.classified == [0, 1]
+    assert index.groups == 2
+
+
+def test_duplicates_of_a_failed_representative_are_classified(fake_predictor):
+    fake_predictor.fail = {'a'}
+    images = [('a', make_image(1)), ('a2', make_image(1, changed=True)), ('a3', make_image(1, changed=True)),
+              ('b', make_image(2))]
+    index = dedupe.NearDuplicateIndex()
+    results = list(dedupe.predict_iter(lambda: images, index))
+
+    assert [key for key, _, _ in results] == ['a', 'a2', 'a3', 'b']
+    assert results[0][1][0] == 'ERROR'
+    assert results[1] == ('a2', (('label of a2', 0.9),), None)
+    assert results[2] == ('a3', (('label of a3', 0.9),), None)
+    assert sorted(fake_predictor.classified) == ['a', 'a2', 'a3', 'b']
+
+    # Later copies are matched to a group that has a result, not to the failed one
+    later = list(dedupe.predict_iter(lambda: [('a4', make_image(1, changed=True))], index))
+    assert later[0][2] in ('a2', 'a3')
+    assert later[0][1] == (('label of ' + later[0][2], 0.9),)
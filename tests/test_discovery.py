@@ -0,0 +1,64 @@
+"""
+Summary: Check that image files are identified by their content, not their names, and how a folder is sharded.
+"""
+import os
+
+import pytest
+
+from img_classifier import discovery
+
+JPEG = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00'
+PNG = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR'
+TIFF_INTEL = b'II*\x00\x08\x00\x00\x00'
+TIFF_MOTOROLA = b'MM\x00*\x00\x00\x00\x08'
+
+
+@pytest.mark.parametrize('header, image_format', [
+    (JPEG, 'jpeg'), (PNG, 'png'), (TIFF_INTEL, 'tiff'), (TIFF_MOTOROLA, 'tiff')
+])
+def test_each_format_is_recognised(header, image_format):
+    assert discovery.sniff(header, discovery.IMAGE_FORMATS) == image_format
+
+
+def test_only_the_accepted_formats_are_recognised():
+    assert discovery.sniff(JPEG) == 'jpeg'
+    assert discovery.sniff(PNG) is None
+    assert discovery.sniff(PNG, ('jpeg', 'png')) == 'png'
+
+
+@pytest.mark.parametrize('header', [b'', b'\xff\xd8', b'GIF89a', b'%PDF-1.7\n', b'PK\x03\x04'])
+def test_short_and_other_files_are_not_images(header):
+    assert discovery.sniff(header, discovery.IMAGE_FORMATS) is None
+
+
+def test_files_are_read_by_content_whatever_their_name(tmp_path):
+    renamed = os.path.join(str(tmp_path), 'photo.dat')
+    with open(renamed, mode='wb') as image_file:
+        image_file.write(JPEG + b'rest of the image')
+    assert discovery.read_image_file(renamed) == JPEG + b'rest of the image'
+
+    misnamed = os.path.join(str(tmp_path), 'document.jpg')
+    with open(misnamed, mode='wb') as other_file:
+        other_file.write(b'%PDF-1.7\n')
+    with pytest.raises(discovery.NotAnImage):
+        discovery.read_image_file(misnamed)
+
+
+def test_every_file_is_in_exactly_one_shard(tmp_path):
+    for folder in ('a', os.path.join('a', 'b'), 'c'):
+        os.makedirs(os.path.join(str(tmp_path), folder), exist_ok=True)
+        for number in range(10):
+            with open(os.path.join(str(tmp_path), folder, f'{number}.jpg'), mode='wb') as image_file:
+                image_file.write(JPEG)
+    everything = sorted(discovery.FileDiscovery(str(tmp_path)))
+
+    shards = [sorted(discovery.FileDiscovery(str(tmp_path), shard=(index, 4))) for index in range(4)]
+    assert sorted(path for shard in shards for path in shard) == everything
+    assert all(len(shard) > 0 for shard in shards)
+
+
+def test_shards_agree_wherever_the_folder_is_and_whatever_the_separator():
+    assert discovery.shard_of('a/b/c.jpg', 7) == discovery.shard_of(os.path.join('a', 'b', 'c.jpg'), 7)
+    assert all(0 <= discovery.shard_of(f'{number}.jpg', 3) < 3 for number in range(100))
+    # A hash of the path alone, so it is the same in every process and on every machine
+    assert discovery.shard_of('a/b/c.jpg', 1000) == 729
@@ -0,0 +1,51 @@
+"""
+Summary: Check that frames written to a stream are read back whole, and that a cut off stream is reported.
+"""
+from io import BytesIO
+
+import pytest
+
+from img_classifier import framing
+
+FRAMES = [('guid-1', b'\xff\xd8\xff first image'), ('ключ', b''), ('guid-3', bytes(range(256)) * 300)]
+
+
+def framed(frames):
+    stream = BytesIO()
+    for key, data in frames:
+        framing.write_frame(stream, key, data)
+    return stream.getvalue()
+
+
+class Trickle:
+    """
+    A stream that returns at most a few bytes from each read, like a pipe the writer is slow to fill.
+    """
+
+    def __init__(self, data, chunk=3):
+        self.stream = BytesIO(data)
+        self.chunk = chunk
+
+    def read(self, size):
+        return self.stream.read(min(size, self.chunk))
+
+
+def test_frames_round_trip():
+    assert list(framing.read_frames(BytesIO(framed(FRAMES)))) == FRAMES
+
+
+def test_frames_are_read_whole_from_short_reads():
+    assert list(framing.read_frames(Trickle(framed(FRAMES)))) == FRAMES
+
+
+def test_an_empty_stream_has_no_frames():
+    assert list(framing.read_frames(BytesIO(b''))) == []
+
+
+@pytest.mark.parametrize('cut', [1, 2, 5, 10, len(framed(FRAMES[:1])) - 1])
+def test_a_truncated_stream_raises_after_the_whole_frames(cut):
+    data = framed(FRAMES[:1]) + framed(FRAMES[:1])[:cut]
+    frames = framing.read_frames(BytesIO(data))
+    assert next(frames) == FRAMES[0]
+    with pytest.raises(ValueError, match='part way through a frame'):
+        next(frames)
@@ -0,0 +1,43 @@
+"""
+Summary: Check the vectorized top-k decoding against a full sort of each row.
+"""
+import numpy as np
+import pytest
+
+from img_classifier import labels
+
+NAMES = np.array([f'class {index}' for index in range(labels.CLASS_COUNT)], dtype=object)
+
+
+def sorted_top_k(probabilities, k):
+    expected = []
+    for row in probabilities:
+        order = sorted(range(len(row)), key=lambda index: -row[index])[:k]
+        expected.append(tuple((NAMES[index], row[index]) for index in order))
+    return expected
+
+
+@pytest.mark.parametrize('k', [1, 3, 5])
+def test_top_k_matches_a_full_sort(k):
+    generator = np.random.default_rng(8)
+    probabilities = generator.random((16, labels.CLASS_COUNT), dtype=np.float32)
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+    assert labels.top_k(probabilities, k, names=NAMES) == sorted_top_k(probabilities, k)
+
+
+def test_top_k_uses_the_label_table(monkeypatch):
+    monkeypatch.setattr(labels, '_label_table', NAMES)
+    probabilities = np.zeros((2, labels.CLASS_COUNT), dtype=np.float32)
+    probabilities[0, 281], probabilities[0, 282] = 0.75, 0.25
+    probabilities[1, 7] = 1.0
+
+    results = labels.top_k(probabilities, 2)
+    assert [label for label, _ in results[0]] == ['class 281', 'class 282']
+    assert results[1][0] == ('class 7', 1.0)
+
+
+def test_k_is_limited_to_the_number_of_classes():
+    probabilities = np.array([[0.5, 0.25, 0.25]], dtype=np.float32)
+    assert len(labels.top_k(probabilities, 10, names=['a', 'b', 'c'])[0]) == 3
+    assert len(labels.top_k(probabilities, 0, names=['a', 'b', 'c'])[0]) == 1
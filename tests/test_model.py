@@ -0,0 +1,38 @@
+"""
+Summary: Check that a model that fails to build is only tried once.
+"""
+import pytest
+from PIL import Image
+
+from img_classifier import predictor
+from img_classifier.model import ModelHolder
+
+
+class FailingBuild:
+    def __init__(self):
+        self.attempts = 0
+
+    def __call__(self):
+        self.attempts += 1
+        raise OSError('The model file is missing')
+
+
+def test_failed_build_is_remembered():
+    build = FailingBuild()
+    holder = ModelHolder(build, (224, 224, 3))
+    for _ in range(3):
+        with pytest.raises(OSError, match='missing'):
+            holder.get()
+    assert build.attempts == 1
+    assert holder.state == 'failed'
+
+
+def test_predict_batch_raises_a_failed_build_once(monkeypatch):
+    build = FailingBuild()
+    monkeypatch.setattr(predictor, 'model', ModelHolder(build, (224, 224, 3)))
+    monkeypatch.setattr(predictor, 'first_model', None)
+    batch = [(f'image-{position}', Image.new('RGB', (224, 224))) for position in range(4)]
+
+    with pytest.raises(OSError, match='missing'):
+        predictor.predict_batch(batch)
+    assert build.attempts == 1
@@ -0,0 +1,72 @@
+"""
+Summary: Check reading images from a pack, and which index lines are ignored.
+"""
+import os
+
+import pytest
+
+from img_classifier import discovery, pack
+from img_classifier.pack import ImagePack
+
+JPEG = b'\xff\xd8\xff\xe0'
+
+
+def write_pack(tmp_path, images, index_extra=''):
+    """
+    :param images: (key, bytes) pairs to write to the pack, in order
+    :param index_extra: Text to add to the end of the index
+    :return: The path to the pack's data file
+    """
+    path = os.path.join(str(tmp_path), pack.PACK_FILENAME)
+    lines = []
+    with open(path, mode='wb') as data_file:
+        for key, image_bytes in images:
+            lines.append(f'{key}\t{data_file.tell()}\t{len(image_bytes)}\n')
+            data_file.write(image_bytes)
+    with open(path + pack.INDEX_SUFFIX, mode='w', encoding='utf-8') as index_file:
+        index_file.write(''.join(lines) + index_extra)
+    return path
+
+
+def test_images_are_read_in_the_order_they_were_written(tmp_path):
+    path = write_pack(tmp_path, [('b', JPEG + b'first'), ('a', JPEG + b'second'), ('empty', b'')])
+    assert pack.find_pack(str(tmp_path)) == path
+
+    with ImagePack(path) as image_pack:
+        assert list(image_pack) == ['b', 'a', 'empty']
+        assert image_pack.found == 3 and image_pack.finished
+        assert bytes(image_pack.read_image('a')) == JPEG + b'second'
+        assert bytes(image_pack.view('empty')) == b''
+        assert image_pack.identity('b')['size'] == len(JPEG) + 5
+        with pytest.raises(discovery.NotAnImage):
+            image_pack.read_image('empty')
+        with pytest.raises(KeyError):
+            image_pack.view('missing')
+
+
+@pytest.mark.parametrize('bad_line', [
+    'too\tfew\n', 'not\ta\tnumber\n', 'negative\t-1\t4\n', 'past the end\t4\t100\n', 'torn\t0\t4'
+])
+def test_bad_index_lines_are_ignored(tmp_path, bad_line):
+    path = write_pack(tmp_path, [('a', JPEG + b'image')], index_extra=bad_line)
+    with ImagePack(path) as image_pack:
+        assert list(image_pack) == ['a']
+
+
+def test_an_empty_pack_has_no_images(tmp_path):
+    with ImagePack(write_pack(tmp_path, [])) as image_pack:
+        assert len(image_pack) == 0
+
+
+def test_a_folder_without_a_pack_is_not_one(tmp_path):
+    assert pack.find_pack(str(tmp_path)) is None
+
+
+def test_the_shards_of_a_pack_hold_every_image_once(tmp_path):
+    keys = [f'{number:08d}' for number in range(40)]
+    path = write_pack(tmp_path, [(key, JPEG) for key in keys])
+    shards = []
+    for index in range(3):
+        with ImagePack(path, shard=(index, 3)) as image_pack:
+            shards.append(list(image_pack))
+    assert sorted(key for shard in shards for key in shard) == keys
@@ -0,0 +1,123 @@
+"""
+Summary: Check resuming a results log, including one whose last line was only partly written, and merging shards.
+"""
+import json
+import os
+
+import pytest
+
+from img_classifier import results_log
+from img_classifier.results_log import ResultsLog
+
+RESULT = (('tabby', 0.75), ('tiger cat', 0.125))
+
+
+def log_path(tmp_path, shard=None):
+    return os.path.join(str(tmp_path), results_log.shard_filename(results_log.LOG_FILENAME, shard))
+
+
+def write_run(tmp_path, images, model_id='model', shard=None):
+    log = ResultsLog(str(tmp_path), len(images), model_id=model_id, shard=shard)
+    for image in images:
+        log.set_identity(image, {'size': 10})
+        log.record(image, RESULT)
+    return log
+
+
+def test_a_torn_last_line_is_cut_off_when_resuming(tmp_path):
+    write_run(tmp_path, ['a.jpg', 'b.jpg']).close()
+    complete_size = os.path.getsize(log_path(tmp_path))
+    with open(log_path(tmp_path), mode='a', encoding='utf-8') as log_file:
+        log_file.write('{"image": "c.jpg", "resu')
+
+    log = ResultsLog(str(tmp_path), 3, resume=True, model_id='model')
+    assert sorted(log.previous) == ['a.jpg', 'b.jpg']
+    assert os.path.getsize(log_path(tmp_path)) == complete_size
+
+    log.record('c.jpg', RESULT)
+    log.close()
+    assert [entry['image'] for entry in results_log.read_log(log_path(tmp_path))] == ['a.jpg', 'b.jpg', 'c.jpg']
+
+
+def test_a_garbled_line_and_everything_after_it_are_cut_off(tmp_path):
+    write_run(tmp_path, ['a.jpg']).close()
+    with open(log_path(tmp_path), mode='a', encoding='utf-8') as log_file:
+        log_file.write('not json\n{"image": "b.jpg", "results": []}\n')
+
+    log = ResultsLog(str(tmp_path), 2, resume=True, model_id='model')
+    log.close()
+    assert list(log.previous) == ['a.jpg']
+    assert [entry['image'] for entry in results_log.read_log(log_path(tmp_path))] == ['a.jpg']
+
+
+def test_only_unchanged_images_with_results_are_skipped(tmp_path):
+    log = write_run(tmp_path, ['a.jpg', 'b.jpg'])
+    log.set_identity('c.jpg', {'size': 10})
+    log.record('c.jpg', ('ERROR', ValueError('bad image')))
+    log.close()
+
+    log = ResultsLog(str(tmp_path), 3, resume=True, model_id='model')
+    log.close()
+    assert log.already_classified('a.jpg', {'size': 10})
+    assert not log.already_classified('b.jpg', {'size': 11})
+    assert not log.already_classified('c.jpg', {'size': 10})
+    assert not log.already_classified('d.jpg', {'size': 10})
+
+
+def test_a_log_from_another_model_is_not_resumed(tmp_path):
+    write_run(tmp_path, ['a.jpg']).finish()
+    with pytest.raises(ValueError, match='was made by model'):
+        ResultsLog(str(tmp_path), 1, resume=True, model_id='other model')
+
+
+def test_the_compacted_file_keeps_the_last_result_of_each_image(tmp_path):
+    log = write_run(tmp_path, ['a.jpg'])
+    log.record('a.jpg', ('ERROR', ValueError('bad image')))
+    log.finish()
+
+    with open(os.path.join(str(tmp_path), results_log.COMPACT_FILENAME), encoding='utf-8') as compact_file:
+        compacted = json.load(compact_file)
+    assert compacted['results'] == {}
+    assert compacted['status']['errors'] == ['a.jpg: bad image']
+
+
+def test_shards_are_merged_once_all_are_done(tmp_path):
+    write_run(tmp_path, ['a.jpg', 'b.jpg'], shard=(0, 2)).finish(compact=False)
+    second = write_run(tmp_path, ['c.jpg'], shard=(1, 2))
+    with pytest.raises(ValueError, match=r'Shards \[1\] of 2'):
+        results_log.merge_shards(str(tmp_path), 2)
+    second.finish(compact=False)
+
+    status = results_log.merge_shards(str(tmp_path), 2)
+    assert status['done'] and status['total'] == 3 and status['classified'] == 3
+    assert status['model_id'] == 'model'
+    assert [shard_status['total'] for shard_status in status['shards']] == [2, 1]
+    assert [entry['image'] for entry in results_log.read_log(log_path(tmp_path))] == ['a.jpg', 'b.jpg', 'c.jpg']
+    with open(os.path.join(str(tmp_path), results_log.STATUS_FILENAME), encoding='utf-8') as status_file:
+        assert json.load(status_file)['done']
+    with open(os.path.join(str(tmp_path), results_log.COMPACT_FILENAME), encoding='utf-8') as compact_file:
+        assert sorted(json.load(compact_file)['results']) == ['a.jpg', 'b.jpg', 'c.jpg']
+
+
+def test_shards_from_different_models_are_not_merged(tmp_path):
+    write_run(tmp_path, ['a.jpg'], shard=(0, 2)).finish(compact=False)
+    write_run(tmp_path, ['b.jpg'], model_id='other model', shard=(1, 2)).finish(compact=False)
+    with pytest.raises(ValueError, match='different models'):
+        results_log.merge_shards(str(tmp_path), 2)
+
+
+def test_a_failed_atomic_write_leaves_no_temporary_file(tmp_path, monkeypatch):
+    path = os.path.join(str(tmp_path), 'status.json')
+    results_log.write_atomically(path, 'old')
+
+    def fail(source, destination):
+        raise OSError('disk gone')
+    monkeypatch.setattr(results_log.os, 'replace', fail)
+    with pytest.raises(OSError, match='disk gone'):
+        results_log.write_atomically(path, 'new')
+    with pytest.raises(TypeError):
+        results_log.write_atomically(path, b'not text')
+
+    assert os.listdir(str(tmp_path)) == ['status.json']
+    with open(path, encoding='utf-8') as status_file:
+        assert status_file.read() == 'old'
@@ -0,0 +1,76 @@
+"""
+Summary: Check that the console script's ResultsTail reads each line of a growing results log once, and only when it is
+complete.
+
+cli/predict_selected.py runs in Nuix Workstation's Jython and imports Java classes, so only the ResultsTail class is
+taken from its source to test here.
+"""
+import ast
+import json
+import os
+import warnings
+
+import pytest
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cli', 'predict_selected.py')
+
+
+def load_results_tail():
+    with open(SCRIPT_PATH, encoding='utf-8') as script_file, warnings.catch_warnings():
+        # Its docstring has Windows paths in it, which aren't valid escapes in Python 3
+        warnings.simplefilter('ignore')
+        script = ast.parse(script_file.read())
+    class_def = next(node for node in script.body if isinstance(node, ast.ClassDef) and node.name == 'ResultsTail')
+    namespace = {'os': os, 'json': json, 'results_log_filename': 'inference.jsonl'}
+    exec(compile(ast.Module(body=[class_def], type_ignores=[]), SCRIPT_PATH, 'exec'), namespace)
+    return namespace['ResultsTail']
+
+
+class Applier:
+    def __init__(self):
+        self.entries = []
+
+    def apply(self, entry):
+        self.entries.append(entry['image'])
+
+
+@pytest.fixture
+def tail(tmp_path):
+    return load_results_tail()(str(tmp_path), Applier())
+
+
+def append(tail, text):
+    with open(tail.log_path, mode='a', encoding='utf-8') as log_file:
+        log_file.write(text)
+
+
+def line(image):
+    return json.dumps({'image': image, 'results': [{'tabby': '0.75'}]}) + '\n'
+
+
+def test_nothing_is_read_before_the_log_exists(tail):
+    assert tail.read_new() == 0
+    assert tail.position == 0
+
+
+def test_each_line_is_read_once(tail):
+    append(tail, line('a') + line('b'))
+    assert tail.read_new() == 2
+    append(tail, line('c'))
+    assert tail.read_new() == 1
+    assert tail.read_new() == 0
+    assert tail.applier.entries == ['a', 'b', 'c']
+    assert tail.position == os.path.getsize(tail.log_path)
+
+
+def test_a_partly_written_line_is_read_once_it_is_finished(tail):
+    whole = line('a') + line('ключ')
+    append(tail, whole[:-10])
+    assert tail.read_new() == 1
+    assert tail.position == len(line('a').encode('utf-8'))
+
+    append(tail, whole[-10:] + '\n')
+    assert tail.read_new() == 1
+    assert tail.applier.entries == ['a', 'ключ']
+    # The position counts bytes, not characters, so it stays right after lines that aren't ASCII
+    assert tail.position == os.path.getsize(tail.log_path)
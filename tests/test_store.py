@@ -0,0 +1,60 @@
+"""
+Summary: Check the probability store's appends, its repair after an interrupted append, and what it refuses to open.
+"""
+import os
+
+import numpy as np
+import pytest
+
+from img_classifier import store
+from img_classifier.store import ProbabilityStore
+
+CLASSES = 10
+
+
+def probabilities_for(count, start=0):
+    return np.arange(start * CLASSES, (start + count) * CLASSES, dtype=np.float32).reshape(count, CLASSES) / 1000
+
+
+def test_append_and_read(tmp_path):
+    with ProbabilityStore(str(tmp_path), mode='a', model_id='model', classes=CLASSES) as writer:
+        writer.append(['a', 'b'], probabilities_for(2))
+        writer.append(['c'], probabilities_for(1, start=2))
+
+    reader = ProbabilityStore(str(tmp_path))
+    assert reader.rows == 3
+    assert reader.keys() == ['a', 'b', 'c']
+    np.testing.assert_allclose(reader.probabilities[reader.index()['c']], probabilities_for(1, start=2)[0], rtol=1e-3)
+
+
+def test_torn_append_is_repaired(tmp_path):
+    with ProbabilityStore(str(tmp_path), mode='a', model_id='model', classes=CLASSES) as writer:
+        writer.append(['a', 'b'], probabilities_for(2))
+
+    # An interrupted append: a row and a half written, and only part of a key
+    with open(os.path.join(str(tmp_path), store.PROBABILITIES_FILE), mode='ab') as probabilities_file:
+        probabilities_file.write(probabilities_for(2, start=2).astype(store.DTYPE).tobytes()[:CLASSES * 3])
+    with open(os.path.join(str(tmp_path), store.KEYS_FILE), mode='a', encoding='utf-8') as keys_file:
+        keys_file.write('"c')
+
+    with ProbabilityStore(str(tmp_path), mode='a', model_id='model') as writer:
+        assert writer.rows == 2
+        writer.append(['d'], probabilities_for(1, start=3))
+
+    reader = ProbabilityStore(str(tmp_path))
+    assert reader.keys() == ['a', 'b', 'd']
+    assert os.path.getsize(os.path.join(str(tmp_path), store.PROBABILITIES_FILE)) == \
+        3 * CLASSES * np.dtype(store.DTYPE).itemsize
+    np.testing.assert_allclose(reader.probabilities[2], probabilities_for(1, start=3)[0], rtol=1e-3)
+
+
+def test_other_models_are_refused(tmp_path):
+    ProbabilityStore(str(tmp_path), mode='a', model_id='model', classes=CLASSES).close()
+    with pytest.raises(ValueError, match='holds predictions from model'):
+        ProbabilityStore(str(tmp_path), mode='a', model_id='other model')
+
+
+def test_embeddings_cannot_be_added_to_a_store_without_them(tmp_path):
+    ProbabilityStore(str(tmp_path), mode='a', model_id='model', classes=CLASSES).close()
+    with pytest.raises(ValueError, match='without embeddings'):
+        ProbabilityStore(str(tmp_path), mode='a', model_id='model', embeddings=True)